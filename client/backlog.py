@@ -0,0 +1,128 @@
+#
+# Queue of lines waiting to be sent, with a policy for when input
+# arrives faster than the link drains it
+#
+# max_depth - keep at most this many lines, the oldest are dropped (0 = no limit)
+# ttl - drop lines that have been ready to go for longer than this many seconds
+#       when they come up (0 = no limit). Time spent waiting on their host
+#       (a hold from an earlier line) doesn't count, lines behind a hold still run
+# collapse - fold identical consecutive lines into one line with a repeat count
+#
+# Entries carry the host their line is for, so one busy host doesn't hold
+# up lines for the others, see pop.
+#
+
+from __future__ import absolute_import, print_function
+
+from collections import deque
+
+from client.scheduler import monotonic
+
+
+class Entry():
+    __slots__ = ('line', 'ack', 'arrived', 'host', 'count', 'eligible')
+
+    def __init__(self, line, ack, arrived, host=None):
+        self.line = line
+        self.ack = ack
+        self.arrived = arrived
+        self.host = host
+        self.count = 1
+
+        # When the line could have gone, None while its host is busy
+        self.eligible = arrived
+
+
+class Backlog():
+    def __init__(self, max_depth=0, ttl=0, collapse=False, on_drop=None):
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self.collapse = collapse
+        self.on_drop = on_drop
+        self.entries = deque()
+
+        self.dropped_depth = 0
+        self.dropped_stale = 0
+        self.collapsed = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # arrived - monotonic time the line was read, defaults to now
+    # host - host the line is for
+    def push(self, line, ack=None, arrived=None, host=None):
+        line = line.strip()
+        if arrived is None:
+            arrived = monotonic()
+
+        # Lines waiting on an ack are never folded, each gets its own answer
+        if self.collapse and ack is None and len(self.entries) > 0:
+            last = self.entries[-1]
+            if last.ack is None and last.line == line and last.host == host:
+                last.count += 1
+                self.collapsed += 1
+                return
+
+        self.entries.append(Entry(line, ack, arrived, host))
+
+        if self.max_depth > 0:
+            while len(self.entries) > self.max_depth:
+                self.dropped_depth += 1
+                self.drop(self.entries.popleft(), 'depth')
+
+    # Next entry that isn't stale, or None
+    # ready - if given, only take entries whose host it returns True for,
+    #         entries for other hosts keep their place and their ttl starts
+    #         once their host is ready
+    def pop(self, ready=None):
+        now = monotonic()
+        i = 0
+        while i < len(self.entries):
+            entry = self.entries[i]
+            if ready is not None and not ready(entry.host):
+                entry.eligible = None
+                i += 1
+                continue
+            if entry.eligible is None:
+                entry.eligible = now
+            if self.ttl > 0 and now - entry.eligible > self.ttl:
+                del self.entries[i]
+                self.dropped_stale += 1
+                self.drop(entry, 'stale')
+                continue
+            del self.entries[i]
+            return entry
+        return None
+
+    # Whether pop(ready) would find something to take
+    def has_ready(self, ready):
+        for entry in self.entries:
+            if ready(entry.host):
+                return True
+        return False
+
+    def drop(self, entry, reason):
+        if self.on_drop is not None:
+            self.on_drop(entry, reason)
+
+    def clear(self):
+        while len(self.entries) > 0:
+            self.drop(self.entries.popleft(), 'flushed')
+
+    # Drop only the entries for one host
+    def clear_host(self, host):
+        keep = deque()
+        for entry in self.entries:
+            if entry.host == host:
+                self.drop(entry, 'flushed')
+            else:
+                keep.append(entry)
+        self.entries = keep
+
+    def stats(self):
+        return {
+            'depth': len(self.entries),
+            'dropped_depth': self.dropped_depth,
+            'dropped_stale': self.dropped_stale,
+            'collapsed': self.collapsed
+        }
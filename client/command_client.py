@@ -0,0 +1,67 @@
+#
+# Client for the command socket, see command_socket.py
+#
+# Long lived producers can keep a CommandClient open and send lines with it.
+# Run as a script to send one line and wait for its ack:
+#   python command_client.py [--socket /tmp/btkb.cmd.sock] KEY_ENTER ACT_RELEASE
+#
+
+from __future__ import absolute_import, print_function
+
+import socket
+import sys
+
+# Seconds to wait for an ack by default, lines with long holds need more
+DEFAULT_TIMEOUT = 30
+
+
+class CommandClient():
+    # timeout - seconds to wait on the socket, None to wait forever
+    def __init__(self, path='/tmp/btkb.cmd.sock', timeout=DEFAULT_TIMEOUT):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile('r')
+
+    # Send a line, if ack is set wait until its reports are sent
+    # and return the ms it took from the service's point of view
+    # Raises if the line was dropped instead, or socket.timeout if no answer
+    # came in time (a late answer would be taken for the next line's, close after that)
+    def send(self, line, ack=False):
+        if ack:
+            # Ahead of the line, after an ACT_TYPE it would be typed
+            line = 'ACT_ACK ' + line
+        self.sock.sendall((line + '\n').encode('utf-8'))
+        if not ack:
+            return None
+
+        reply = self.reader.readline()
+        if not reply:
+            raise Exception("[BTKB:CMDCLIENT] Connection closed before the ack")
+        if not reply.startswith('OK'):
+            raise Exception("[BTKB:CMDCLIENT] Line not sent", reply.strip())
+        return float(reply.split()[1])
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    path = '/tmp/btkb.cmd.sock'
+    if len(args) > 1 and args[0] == '--socket':
+        path = args[1]
+        args = args[2:]
+
+    try:
+        client = CommandClient(path)
+    except socket.error as e:
+        sys.exit("btkb: could not connect to " + path + ": " + str(e))
+
+    try:
+        client.send(' '.join(args), ack=True)
+    except socket.timeout:
+        sys.exit("btkb: no answer from " + path + " within %ds" % DEFAULT_TIMEOUT)
+    finally:
+        client.close()
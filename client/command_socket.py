@@ -0,0 +1,146 @@
+#
+# Unix socket command endpoint
+#
+# Takes the same line grammar as the fifo, from any number of clients
+# that can keep their connection open. A line containing ACT_ACK is
+# answered with "OK <ms>\n" once all of its reports have been sent,
+# where ms is the time since the line was read, or "DROPPED <reason>\n"
+# if the backlog policy dropped it or it was cancelled (ACT_CANCEL, or the
+# host reconnecting) before it was done. ACT_ACK after ACT_TYPE is text.
+#
+
+from __future__ import absolute_import, print_function
+
+import errno
+import os
+import socket
+
+from client.scheduler import monotonic
+from client.line_compiler import split_type_text
+
+
+# The line with its ACT_ACK tokens taken out, None if it has none
+# Text after ACT_TYPE is left as it is
+def strip_ack(line):
+    head, text = split_type_text(line)
+    tokens = head.split()
+    if 'ACT_ACK' not in tokens:
+        return None
+    head = ' '.join([k for k in tokens if k != 'ACT_ACK'])
+    if text is None:
+        return head
+    return (head + ' ' if head else '') + 'ACT_TYPE ' + text
+
+
+class Connection():
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class CommandSocket():
+    def __init__(self, path='/tmp/btkb.cmd.sock'):
+        print("[BTKB:CMDSOCKET] Making command socket at path: " + path)
+
+        self.path = path
+        self.conns = {}
+
+        self.remove_socket()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+
+    def remove_socket(self):
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != 2:
+                raise e
+
+    def fds(self):
+        return [self.sock.fileno()] + list(self.conns.keys())
+
+    # Handle a readable fd, returns a list of (line, conn to ack or None)
+    def handle(self, fd):
+        if fd == self.sock.fileno():
+            self.accept()
+            return []
+
+        conn = self.conns.get(fd)
+        if conn is None:
+            return []
+
+        try:
+            data = conn.sock.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            data = None
+
+        if not data:
+            self.drop(conn)
+            return []
+
+        if not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        conn.buf += data
+        if '\n' not in conn.buf:
+            return []
+
+        parts = conn.buf.split('\n')
+        conn.buf = parts.pop()
+
+        lines = []
+        for line in parts:
+            stripped = strip_ack(line)
+            if stripped is not None:
+                lines.append((stripped, conn))
+            else:
+                lines.append((line, None))
+        return lines
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print("[BTKB:CMDSOCKET] accept failed: ", e)
+                return
+            sock.setblocking(False)
+            self.conns[sock.fileno()] = Connection(sock)
+
+    def drop(self, conn):
+        conn.closed = True
+        self.conns.pop(conn.fileno(), None)
+        conn.sock.close()
+
+    # Tell a client its line is done, started is when the line was read
+    def ack(self, conn, started):
+        if conn.closed:
+            return
+        try:
+            conn.sock.send(('OK %.3f\n' % ((monotonic() - started) * 1000)).encode('utf-8'))
+        except socket.error:
+            self.drop(conn)
+
+    # Tell a client its line was dropped and never sent
+    def nack(self, conn, reason):
+        if conn.closed:
+            return
+        try:
+            conn.sock.send(('DROPPED %s\n' % reason).encode('utf-8'))
+        except socket.error:
+            self.drop(conn)
+
+    def close(self):
+        for conn in list(self.conns.values()):
+            self.drop(conn)
+        self.sock.close()
+        self.remove_socket()
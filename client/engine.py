@@ -0,0 +1,211 @@
+#
+# Single process engine
+#
+# Runs FifoClient inside the service's GLib main loop instead of in a
+# process of its own. Fifo and command socket input, parsing, scheduling
+# and the socket writes all happen on that one loop: lines reach the
+# service with a plain method call rather than a dbus round trip, and
+# state changes arrive the same way instead of over a multiprocessing
+# queue. The service keeps its dbus interface for other callers, and its
+# profiler (see client/profiler.py) covers the whole process.
+#
+# Usage, with the main loop set up for dbus:
+#   engine = Engine(shutdown_flag, ...)
+#   service = BTKbService(engine, shutdown_flag, ...)
+#   engine.attach(service, loop)
+#   loop.run()
+#
+
+from __future__ import absolute_import, print_function
+
+import math
+import os
+
+from gi.repository import GLib
+
+from client.fifo_client import FifoClient
+from client.macros import POLL_INTERVAL
+from client.scheduler import monotonic
+from client.transport import LocalTransport
+
+
+class Engine(FifoClient):
+    # Same options as FifoClient, less the ones for talking to another process
+    # owner_uid, owner_gid - given to the fifo and command socket with chown,
+    #                        the service needs to keep running as root
+    def __init__(self, shutdown_flag, fifo_path='/tmp/btkb.fifo', owner_uid=None, owner_gid=None, cache_size=64, stats=False, stats_interval=10, command_socket=None, backlog_max_depth=0, backlog_ttl=0, backlog_collapse=False, backlog_max_repeat=1, host_aliases=None, default_host=None, macro_file=None, lirc_socket=None, lirc_buttons=None, lirc_repeats=False, trace_file=None):
+        FifoClient.__init__(self, None, shutdown_flag, fifo_path=fifo_path, cache_size=cache_size,
+            batch=True, reader_mode='select', stats=stats, stats_interval=stats_interval,
+            command_socket=command_socket, backlog_max_depth=backlog_max_depth, backlog_ttl=backlog_ttl,
+            backlog_collapse=backlog_collapse, backlog_max_repeat=backlog_max_repeat,
+            host_aliases=host_aliases, default_host=default_host, macro_file=macro_file,
+            lirc_socket=lirc_socket, lirc_buttons=lirc_buttons, lirc_repeats=lirc_repeats,
+            trace_file=trace_file, blocking=False)
+
+        for path in (fifo_path, command_socket):
+            if path is not None and (owner_uid is not None or owner_gid is not None):
+                os.chown(path,
+                    owner_uid if owner_uid is not None else -1,
+                    owner_gid if owner_gid is not None else -1)
+
+        self.service = None
+        self.loop = None
+        self.watches = {}
+        self.timer = None
+
+    # Start taking input, reports go straight to the service
+    # loop - the main loop, quit if sending fails, see handle_error
+    def attach(self, service, loop=None):
+        print("[BTKB:ENGINE] Attached to service")
+        self.service = service
+        self.loop = loop
+        self.transport = LocalTransport(service)
+
+        self.watch(self.fifo_reader.fd, self.on_fifo)
+        if self.command_socket is not None:
+            self.watch_commands()
+        if self.macros is not None and not self.macros.polling():
+            self.watch(self.macros.fileno(), self.on_macros)
+        if self.lirc is not None:
+            self.watch_lirc()
+        self.pump()
+
+    def watch(self, fd, callback):
+        self.watches[fd] = GLib.io_add_watch(fd, GLib.IO_IN, callback)
+
+    # Keep a watch on each command socket connection, they come and go
+    def watch_commands(self):
+        fds = set(self.command_socket.fds())
+        keep = (self.fifo_reader.fd,
+            self.macros.fileno() if self.macros is not None else None,
+            self.lirc.fileno() if self.lirc is not None else None)
+        for fd in list(self.watches.keys()):
+            if fd not in keep and fd not in fds:
+                GLib.source_remove(self.watches.pop(fd))
+        for fd in fds:
+            if fd not in self.watches:
+                self.watch(fd, self.on_command)
+
+    # Watch lircd's socket once connected, pump() retries the connection
+    def watch_lirc(self):
+        self.lirc.connect()
+        fd = self.lirc.fileno()
+        if fd is not None and fd not in self.watches:
+            self.watch(fd, self.on_lirc)
+
+    def on_lirc(self, fd, condition):
+        for arrived, line in self.lirc.handle():
+            self.take_line(line, None, arrived)
+        if self.lirc.fileno() != fd:
+            self.watches.pop(fd, None)
+            self.pump()
+            return False
+        self.pump()
+        return True
+
+    # Stands in for the multiprocessing queue, the service puts its state here
+    def put(self, msg, block=True, timeout=None):
+        if msg['topic'] == 'update_state':
+            self.set_state(msg['value'])
+
+    def set_state(self, state):
+        print("[BTKB:ENGINE] State: ", state)
+        if state == 'CONNECTED' and self.state != 'CONNECTED':
+            # Same as FifoClient, nothing queued while disconnected is replayed
+            self.fifo_reader.flush()
+            self.backlog.clear()
+            self.scheduler.cancel_all()
+        self.state = state
+        if self.service is not None:
+            self.pump()
+
+    # Lines that come in while no host is connected are dropped,
+    # like the fifo flush FifoClient does on connecting
+    def take_line(self, line, ack=None, arrived=None):
+        if self.state == 'CONNECTED':
+            self.queue_line(line, ack, arrived)
+        elif ack is not None:
+            self.command_socket.nack(ack, 'disconnected')
+
+    def on_fifo(self, fd, condition):
+        for arrived, line in self.fifo_reader.read_lines():
+            self.take_line(line, None, arrived)
+        # The fifo is reopened on EOF, follow its new fd
+        if self.fifo_reader.fd != fd:
+            self.watches.pop(fd, None)
+            self.watch(self.fifo_reader.fd, self.on_fifo)
+            self.pump()
+            return False
+        self.pump()
+        return True
+
+    def on_command(self, fd, condition):
+        for line, ack in self.command_socket.handle(fd):
+            self.take_line(line, ack)
+        self.watch_commands()
+        self.pump()
+        return fd in self.watches
+
+    # The macro file changed, macros are swapped in between lines
+    def on_macros(self, fd, condition):
+        self.macros.handle()
+        return True
+
+    # Send whatever can go now, then sleep until the next timer
+    def pump(self):
+        if self.state == 'SHUTDOWN':
+            return
+        while self.state == 'CONNECTED' and self.backlog.has_ready(self.scheduler.is_idle):
+            self.next_line()
+        self.scheduler.run_due()
+        if self.state == 'SHUTDOWN':
+            return
+        if self.stats.enabled and monotonic() >= self.next_stats_push:
+            self.push_stats()
+        if self.macros is not None:
+            self.macros.check()
+        if self.lirc is not None:
+            self.watch_lirc()
+
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        timeout = self.scheduler.timeout(None)
+        if self.stats.enabled:
+            timeout = max(0, min(100 if timeout is None else timeout, self.next_stats_push - monotonic()))
+        if self.macros is not None and self.macros.polling():
+            timeout = min(POLL_INTERVAL if timeout is None else timeout, POLL_INTERVAL)
+        if self.lirc is not None and self.lirc.timeout() is not None:
+            timeout = self.lirc.timeout() if timeout is None else min(timeout, self.lirc.timeout())
+        if timeout is not None:
+            # Rounded up, waking early would only mean waking again
+            self.timer = GLib.timeout_add(int(math.ceil(timeout * 1000)), self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.pump()
+        return False
+
+    # A send failed for some other reason than a lost host, the service has given up.
+    # Raised out of a GLib callback it would only take that watch or timer away and
+    # leave the loop running without input, so stop everything, as the client process
+    # does by exiting, rather than FifoClient's handling for a separate process
+    def handle_error(self, err):
+        print("[BTKB:ENGINE] Send failed, shutting down: ", err)
+        self.state = 'SHUTDOWN'
+        self.shutdown_flag.set()
+        self.scheduler.cancel_all()
+        self.close()
+        if self.service is not None:
+            self.service.close()
+        if self.loop is not None:
+            self.loop.quit()
+
+    def close(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        for watch in self.watches.values():
+            GLib.source_remove(watch)
+        self.watches.clear()
+        self.shutdown()
@@ -1,29 +1,50 @@
 
 from __future__ import print_function
 
-from fifo_keymap import keymap
+from line_compiler import LineCompiler, RELEASE_REPORT, CONSUMER_RELEASE_REPORT, line_host, line_typematic
+from hosts import resolve_host
+from scheduler import Scheduler, monotonic
+from stats import Stats
+from command_socket import CommandSocket
+from backlog import Backlog
+from macros import MacroLibrary, POLL_INTERVAL
+from lirc import LircSocket
+from tracefile import Trace
+from profiler import Profiler, is_interrupted
+from transport import DbusTransport, FastPathTransport
 from time import sleep
-import dbus
 import signal
 import os
 import Queue
+import errno
 import multiprocessing as mp
+from collections import deque
 from threading import Thread
 import select
 import subprocess
 
 
-# Reads from a fifo using a thread, puts lines onto a queue
+# Reads lines from a fifo
+# Modes:
+# process - a separate process reads the fifo and puts lines onto a queue
+# select - the fifo is opened non-blocking and read in the caller's loop
 class FifoReader():
-    def __init__(self, shutdown_flag, fifo_path='/tmp/btkb.fifo', owner_uid=None, owner_gid=None):
+    def __init__(self, shutdown_flag, fifo_path='/tmp/btkb.fifo', owner_uid=None, owner_gid=None, mode='process', stats=None):
         print("[BTKB:FIFOREADER] FifoReader setting up with owner (uid, gid): ", (owner_uid, owner_gid))
         
         self.shutdown_flag = shutdown_flag
         self.fifo_path = fifo_path
+        self.mode = mode
+        self.stats = stats if stats is not None else Stats()
         self.queue = mp.Queue()
         self.make_fifo(owner_uid, owner_gid)
         self.proc = None
 
+        # select mode state
+        self.fd = None
+        self.buf = ''
+        self.lines = deque()
+
         signal.signal(signal.SIGINT, self.shutdown)
 
     def make_fifo(self, uid=None, gid=None, retry=False):
@@ -47,37 +68,110 @@ class FifoReader():
             raise Exception("[BTKB:FIFOREADER] Could not make fifo", e)
     
     def run(self):
+        if self.mode == 'select':
+            self.open_fifo()
+            return
+
         self.proc = mp.Process(target=self.read_loop)
         self.proc.start()
 
+    # Open the fifo non-blocking, it is reopened once its writers have all
+    # closed it (EOF). The new fd is opened before the old one is closed,
+    # so a writer never finds the fifo without a reader
+    def open_fifo(self):
+        old = self.fd
+        self.fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        if old is not None:
+            os.close(old)
+
+    def close_fifo(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    # Read whatever is available, split complete lines off the buffer
+    def read_available(self):
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise e
+
+            # EOF, the writers have closed the fifo. Text they left without
+            # a newline is a line of its own, like in process mode, rather
+            # than the start of the next writer's line
+            if not data:
+                if self.buf and not self.buf.endswith('\n'):
+                    self.buf += '\n'
+                self.open_fifo()
+                break
+
+            if not isinstance(data, str):
+                data = data.decode('utf-8', 'replace')
+            self.buf += data
+
+        if '\n' in self.buf:
+            parts = self.buf.split('\n')
+            self.buf = parts.pop()
+            self.lines.extend(parts)
+
     # Repeatedly read from fifo
     def read_loop(self):
         try:
             while not self.shutdown_flag.is_set():
                 with open(self.fifo_path, 'r') as fifo:
                     for data in fifo:
-                        self.queue.put_nowait(data)
+                        self.queue.put_nowait((monotonic(), data))
         finally:
             return
 
         print("[BTKB:FIFOREADER] after queue run loop")
 
     def empty(self):
+        if self.mode == 'select':
+            return len(self.lines) == 0
         return self.queue.empty()
 
-    # Get a line from the fifo
-    # If timeout elapses with no data, signal to update state
-    def get_line(self, timeout=100):
-        # print("[BTKB:FIFO] get_line() ", timeout)
-        # TODO: notify of needing state update
+    # Wait up to timeout for input, then return every complete line
+    # that is available as (monotonic time it was read, line)
+    def read_lines(self, timeout=0):
+        if self.mode == 'select':
+            if len(self.lines) == 0 and timeout > 0:
+                try:
+                    readable, _, _ = select.select([self.fd], [], [], timeout)
+                except select.error as e:
+                    if not is_interrupted(e):
+                        raise
+                    return []
+                if not readable:
+                    return []
+            t0 = monotonic()
+            self.read_available()
+            if self.stats.enabled:
+                self.stats.since('fifo_read', t0)
+
+            lines = [(t0, line) for line in self.lines]
+            self.lines.clear()
+            return lines
+
+        lines = []
         try:
-            return self.queue.get(True, timeout), False
+            lines.append(self.queue.get(True, timeout) if timeout > 0 else self.queue.get_nowait())
+            while True:
+                lines.append(self.queue.get_nowait())
         except Queue.Empty:
-            return None, True
+            pass
+        except (IOError, OSError) as e:
+            if not is_interrupted(e):
+                raise
 
-        if self.queue.empty():
-            return None, False
-        return self.queue.get(block=False, timeout=timeout), False
+        # Time spent passing through the queue from the reader process
+        if self.stats.enabled:
+            for t, _ in lines:
+                self.stats.since('fifo_queue', t)
+        return lines
 
      # Remove the fifo
     def remove_fifo(self):
@@ -94,16 +188,23 @@ class FifoReader():
             self.proc.terminate()
             self.proc.join()
             self.proc = None
+        self.close_fifo()
         self.remove_fifo()
 
     def flush(self):
+        if self.mode == 'select':
+            self.read_available()
+            self.lines.clear()
+            self.buf = ''
+            return
+
         while not self.queue.empty():
             self.queue.get()
 
 # Class to process and send lines of actions from a fifo
 # to series of actions and keyboard HID bytestrings.
 class  FifoClient():
-    def __init__(self, in_queue, shutdown_flag, fifo_path='/tmp/btkb.fifo', owner_uid=None, owner_gid=None):
+    def __init__(self, in_queue, shutdown_flag, fifo_path='/tmp/btkb.fifo', owner_uid=None, owner_gid=None, cache_size=64, batch=True, fast_path=None, reader_mode='process', stats=False, stats_interval=10, command_socket=None, backlog_max_depth=0, backlog_ttl=0, backlog_collapse=False, backlog_max_repeat=1, host_aliases=None, default_host=None, macro_file=None, lirc_socket=None, lirc_buttons=None, lirc_repeats=False, trace_file=None, profile_dir=None, blocking=True):
         print("[BTKB:FIFO] Setting up FifoClient")
         
         self.queue = in_queue
@@ -119,33 +220,95 @@ class  FifoClient():
         # TODO: Allow sleep time to be modified by messages on FIFO
         self.control_sleep = 0.5
 
+        # Optional hot path instrumentation, pushed to the service every stats_interval
+        self.stats = Stats(stats)
+        self.stats_interval = stats_interval
+        self.next_stats_push = 0
+
+        # The command socket and lircd are read in the same select as the fifo
+        if (command_socket is not None or lirc_socket is not None) and reader_mode != 'select':
+            print("[BTKB:FIFO] Command socket and lirc need the select reader mode, using it")
+            reader_mode = 'select'
+
         # FIFO setup
-        self.fifo_reader = FifoReader(shutdown_flag, fifo_path, owner_uid, owner_gid)
+        self.fifo_reader = FifoReader(shutdown_flag, fifo_path, owner_uid, owner_gid, reader_mode, self.stats)
         self.fifo_reader.run()
 
-        self.bus = None
-        self.service = None
-        self.interface = None
-
-        self.modifier = {
-            'RIGHTMETA': 0,
-            'RIGHTALT': 0,
-            'RIGHTSHIFT': 0,
-            'RIGHTCTRL': 0,
-            'LEFTMETA': 0,
-            'LEFTALT': 0,
-            'LEFTSHIFT': 0,
-            'LEFTCTRL': 0
-        }
-        self.modifier_byte = 0x00
+        # Optional unix socket for long lived clients, made after the fifo
+        # so it has the same owner
+        self.command_socket = None
+        if command_socket is not None:
+            self.command_socket = CommandSocket(command_socket)
+
+        # Optional lircd connection, its buttons are mapped to lines
+        self.lirc = None
+        if lirc_socket is not None:
+            self.lirc = LircSocket(lirc_socket, lirc_buttons, lirc_repeats)
+
+        # Lines read but not yet sent, with the policy for when input
+        # comes in faster than it can be sent
+        self.backlog = Backlog(backlog_max_depth, backlog_ttl, backlog_collapse, self.drop_line)
+        self.backlog_max_repeat = backlog_max_repeat
+
+        # Reports go over dbus, or the fast path socket if given
+        self.fast_path = fast_path
+        self.transport = None
+
+        # Key state per host, (modifier byte, held keys, consumer bits)
+        # Modifiers are toggled by MOD_ labels, keys held by DOWN_/UP_ actions,
+        # consumer keys stay pressed until an ACT_RELEASE
+        self.key_states = {}
+
+        # Lines without a HOST_ token go to the default host, or all hosts
+        self.host_aliases = host_aliases or {}
+        self.default_host = resolve_host(default_host, self.host_aliases)
+
+        # Cache of compiled lines
+        self.compiler = LineCompiler(cache_size)
+
+        # Optional trace of the lines coming in, see tracefile.py
+        self.trace = Trace(trace_file) if trace_file else None
+
+        # Named macros for MACRO_ tokens, the file is watched in the same
+        # select as the fifo, or polled when the fifo is read by a process
+        self.macros = None
+        if macro_file is not None:
+            self.macros = MacroLibrary(macro_file, reader_mode == 'select')
+
+        # Send reports between holds in a single send_reports call
+        self.batch = batch
+
+        # Runs holds and delayed reports at their deadlines
+        self.scheduler = Scheduler()
+
+        # Optional cProfile and tracemalloc on SIGUSR1/SIGUSR2, the service
+        # sends them from its start_profiling and stop_profiling methods
+        self.profiler = None
+        if profile_dir is not None:
+            self.profiler = Profiler('btkb-client', profile_dir)
+            signal.signal(signal.SIGUSR1, self.profiler.on_signal)
+            signal.signal(signal.SIGUSR2, self.profiler.on_signal)
 
         signal.signal(signal.SIGINT, self.shutdown)
 
-        self.run()
+        # Otherwise the caller drives it, see engine.py
+        if blocking:
+            self.run()
 
     def shutdown(self, sig_num=None, frame=None):
         print("[BTKB:FIFO] shutdown")
+        print("[BTKB:FIFO] Line cache stats: ", self.compiler.stats())
+        print("[BTKB:FIFO] Scheduler stats: ", self.scheduler.stats())
+        print("[BTKB:FIFO] Backlog stats: ", self.backlog.stats())
         self.fifo_reader.shutdown()
+        if self.command_socket is not None:
+            self.command_socket.close()
+        if self.macros is not None:
+            self.macros.close()
+        if self.lirc is not None:
+            self.lirc.close()
+        if self.profiler is not None:
+            self.profiler.stop()
 
     def handle_error(self, err):
         print("[BTKB:FIFO] Handling error: ", err)
@@ -154,101 +317,235 @@ class  FifoClient():
             return
         raise err
 
-    def init_dbus(self):
-        print("[BTKB:FIFO] Set up dbus interface")
-        self.bus = dbus.SystemBus()
-        self.service = self.bus.get_object('org.max.btkb', "/org/max/btkb")
-        self.interface = dbus.Interface(self.service, 'org.max.btkb')
-
-    # Toggle persistent modifier
-    # Note: MOD_ is stripped before reaching this fn
-    # Valid labels for modifiers: 
-    # MOD_RIGHTMETA - right GUI/windows key
-    # MOD_RIGHTALT
-    # MOD_RIGHTSHIFT
-    # MOD_RIGHTCTRL
-    # MOD_LEFTMETA - left GUI/windows key
-    # MOD_LEFTALT
-    # MOD_LEFTSHIFT
-    # MOD_LEFTCTRL
-    # MOD_RESET
-    def set_modifier(self, mod = None):
-        # print("[BTKB:FIFO] set_modifier(): ", mod)
-        if mod is None or mod == 'RESET':
-            if all([ v == 0 for v in self.modifier ]):
-                return
-            self.modifier = dict.fromkeys(self.modifier, 0)
-        elif mod not in self.modifier:
-            return
+    def init_transport(self):
+        if self.fast_path is not None:
+            self.transport = FastPathTransport(self.fast_path)
         else:
-            self.modifier[mod] = 1 - self.modifier[mod]         
-
-        self.modifier_byte = int(''.join([str(bit) for bit in self.modifier.values()]), 2)
-        # print("[BTKB:FIFO] set modifier byte: ", self.modifier_byte)
-
-    # Send a list of key labels
-    # sample input: ['KEY_ENTER', 'KEY_CTRL']
-    def send_keys(self, keys):
-        #print("[BTKB:FIFO] send_keys(): ", keys, self.modifier_byte)
-        cmd = []
-        cmd.append(0xA1)
-        cmd.append(0x01)
-        cmd.append(self.modifier_byte)
-        cmd.append(0x00)
-
-        count=0
-        for key in keys:
-            if(count>5):
-                break
-            if key not in keymap:
-                continue
-            cmd.append(keymap[key])
-            count+=1
+            self.transport = DbusTransport()
+
+        # Our dbus calls are made for lines already in the trace
+        if self.trace is not None:
+            self.trace.client(self.transport.bus.get_unique_name())
+
+    # Schedule a compiled program, reports are sent from the scheduler
+    # so holds don't block reading the next line
+    # done - optional (fn, args) to call once the program has finished
+    # dropped - optional (fn, args) to call instead if the program is cancelled first
+    # host - address to send to, None for all hosts
+    def run_program(self, program, host=None, done=None, dropped=None):
+        if program.cancel:
+            self.cancel(host)
+
+        for delay, reports in program.segments:
+            self.scheduler.schedule(delay, self.send_segment, (reports, host), host)
+        if done is not None:
+            self.scheduler.schedule(program.tail, done[0], done[1], host, dropped)
+        elif program.tail > 0:
+            self.scheduler.reserve(program.tail, host)
+
+        self.key_states[host] = (program.modifier_byte, program.held, program.consumer)
+
+        # Send whatever doesn't need to wait
+        self.scheduler.run_due()
+
+    # Cancel pending holds and reports for a host, release its keys and consumer keys
+    # Cancelling for all hosts cancels everything
+    def cancel(self, host=None):
+        if host is None:
+            pending = self.scheduler.stats()['pending']
+            self.scheduler.cancel_all()
+        else:
+            pending = self.scheduler.cancel_host(host)
+
+        # Nothing is held after a cancel, modifiers stay toggled
+        pressed = False
+        for h, (modifier_byte, held, consumer) in list(self.key_states.items()):
+            if host is None or h == host:
+                pressed = pressed or len(held) > 0 or consumer != 0
+                self.key_states[h] = (modifier_byte, (), 0)
+
+        if pending > 0 or pressed:
+            self.send_segment((RELEASE_REPORT, CONSUMER_RELEASE_REPORT), host)
 
+    # Send reports back to back, in one send_reports call if batching
+    def send_segment(self, reports, host=None):
+        t0 = monotonic() if self.stats.enabled else 0
         try:
-            self.interface.send_bytes(cmd)
+            if self.batch:
+                self.transport.send_reports(reports, [0.0] * len(reports), host)
+            else:
+                for report in reports:
+                    self.transport.send_bytes(report, host)
         except Exception as e:
             self.handle_error(e)
+        if self.stats.enabled:
+            self.stats.since('send', t0)
 
-    # Do some action, like releasing all keys or holding for a while
-    # Valid actions:
-    # ACT_HOLD_<# seconds>
-    # ACT_RELEASE
-    def do_action(self, action):
-        #print("[BTKB:FIFO] do_action(): ", action)
-        if action == 'RELEASE':
-            try:
-                self.interface.release_keys()
-            except Exception as e:
-                self.handle_error(e)
+    # Press or extend typematic keys on the service, in order with the host's other reports
+    # modifier_byte - MOD_ modifiers to hold along, keys held with DOWN_ the service already knows
+    def send_typematic(self, labels, modifier_byte=0x00, host=None):
+        try:
+            for label in labels:
+                self.transport.typematic_key(label, modifier_byte, host)
+        except Exception as e:
+            self.handle_error(e)
+
+    # Push our histograms and counters to the service, for get_stats
+    def push_stats(self):
+        self.next_stats_push = monotonic() + self.stats_interval
+        self.stats.set_values('line_cache_', self.compiler.stats())
+        self.stats.set_values('scheduler_', self.scheduler.stats())
+        self.stats.set_values('backlog_', self.backlog.stats())
+        if self.macros is not None:
+            self.stats.set_values('macros_', self.macros.stats())
+        if self.lirc is not None:
+            self.stats.set_values('lirc_', self.lirc.stats())
+        histograms, values = self.stats.snapshot()
+        try:
+            self.transport.push_stats('client.', histograms, values)
+        except Exception as e:
+            print("[BTKB:FIFO] Failed to push stats: ", e)
+
+    # How long to wait for input before something else needs doing
+    def loop_timeout(self):
+        timeout = self.scheduler.timeout(100)
+        if self.stats.enabled:
+            timeout = max(0, min(timeout, self.next_stats_push - monotonic()))
+        if self.macros is not None and self.macros.polling():
+            timeout = min(timeout, POLL_INTERVAL)
+        if self.lirc is not None and self.lirc.timeout() is not None:
+            timeout = min(timeout, self.lirc.timeout())
+        return timeout
 
-        elif action.startswith('HOLD'):
-            d = 0
-            try:
-                parts = action.split("_")
-                d = float(parts[1]) if len(parts) > 1 else 0
-            except:
-                pass
-            sleep(d)
-    
     # Send a line of keys and actions
+    # Lines are compiled once per modifier state and cached, see line_compiler
     # Sample 1: KEY_ENTER ACT_HOLD_1 ACT_RELEASE
     # =>: "press down enter key", "hold for 1 second", "release all keys"
     # Sample 2: KEY_CTRL+KEY_ALT+KEY_DELETE ACT_RELEASE
     # =>: "press down control alt and delete", "release all keys"
     # Sample 3: KEY_CTRL KEY_ALT KEY_DELETE
     # =>: "press down control alt and delete" (if auto_release is true, similar as sample 2)
-    def send_line(self, line):
+    # Sample 4: DOWN_KEY_LEFTSHIFT DOWN_KEY_A UP_KEY_A DOWN_KEY_B ACT_RELEASE
+    # =>: "hold shift, press and release a, press b", "release all keys"
+    # Sample 5: HOST_bedroom KEY_HOME ACT_RELEASE
+    # =>: "press and release home", on the host aliased bedroom only
+    # Sample 6: HOST_bedroom MACRO_captions
+    # =>: "run the lines of the captions macro", on the host aliased bedroom only
+    # Sample 7: TYPEMATIC_KEY_DOWN
+    # =>: "press and hold down", released once the line stops coming (a remote's repeats)
+    # ack - command socket connection to answer once the line is done
+    # started - when the line was read, for timing the ack
+    def send_line(self, line, ack=None, started=None):
         #print("[BTKB:FIFO] send_line(): ", line)
-        keys_and_acts = line.split()
+        t0 = monotonic() if self.stats.enabled else 0
+        host = self.target_host(line)
+        modifier_byte, held, consumer = self.key_states.get(host, (0x00, (), 0))
+        if self.macros is not None and 'MACRO_' in line:
+            programs = self.macros.compile(line, self.compiler.compile, modifier_byte, held, consumer)
+        else:
+            programs = [self.compiler.compile(line, modifier_byte, held, consumer)]
+        if self.stats.enabled:
+            self.stats.since('parse', t0)
+
+        done = None
+        dropped = None
+        if ack is not None:
+            done = (self.command_socket.ack, (ack, started if started is not None else monotonic()))
+            dropped = (self.command_socket.nack, (ack, 'cancelled'))
+        if 'TYPEMATIC_' in line:
+            labels = line_typematic(line)
+            if labels:
+                modifiers = programs[-1].modifier_byte if programs else modifier_byte
+                self.scheduler.schedule(0, self.send_typematic, (labels, modifiers, host), host)
+
+        if not programs:
+            if done is not None:
+                done[0](*done[1])
+            return
 
-        for k in keys_and_acts:
-            if k.startswith('ACT_'):
-                self.do_action(k[4:])
-            elif k.startswith('MOD_'):
-                self.set_modifier(k[4:])
+        # The ack waits for the last program, they run in order
+        for program in programs[:-1]:
+            self.run_program(program, host)
+        self.run_program(programs[-1], host, done, dropped)
+
+    # Address a line is for, None for all hosts
+    def target_host(self, line):
+        name = line_host(line)
+        if name is None:
+            return self.default_host
+        return resolve_host(name, self.host_aliases)
+
+    # Queue a line on the backlog
+    # A cancel takes effect as soon as it arrives, along with everything queued before it for its host
+    def queue_line(self, line, ack=None, arrived=None):
+        if self.trace is not None:
+            self.trace.line(line)
+        host = self.target_host(line)
+        if 'ACT_CANCEL' in line.split():
+            if host is None:
+                self.backlog.clear()
+            else:
+                self.backlog.clear_host(host)
+            self.cancel(host)
+        self.backlog.push(line, ack, arrived, host)
+
+    def drop_line(self, entry, reason):
+        if entry.ack is not None:
+            self.command_socket.nack(entry.ack, reason)
+
+    # Wait up to timeout for lines from the fifo or the command socket
+    # and queue them on the backlog, returns False if the timeout elapsed
+    def wait_input(self, timeout):
+        extra = []
+        if self.command_socket is not None:
+            extra.extend(self.command_socket.fds())
+        if self.macros is not None and not self.macros.polling():
+            extra.append(self.macros.fileno())
+        if self.lirc is not None:
+            self.lirc.connect()
+            if self.lirc.fileno() is not None:
+                extra.append(self.lirc.fileno())
+
+        if len(extra) == 0 and self.lirc is None:
+            lines = self.fifo_reader.read_lines(timeout)
+            for arrived, line in lines:
+                self.queue_line(line, None, arrived)
+            if self.macros is not None:
+                self.macros.check()
+            return len(lines) > 0
+
+        fds = [self.fifo_reader.fd] + extra
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except select.error as e:
+            if not is_interrupted(e):
+                raise
+            readable = []
+        if not readable:
+            return False
+
+        for fd in readable:
+            if fd == self.fifo_reader.fd:
+                for arrived, line in self.fifo_reader.read_lines():
+                    self.queue_line(line, None, arrived)
+            elif self.macros is not None and fd == self.macros.fileno():
+                self.macros.handle()
+            elif self.lirc is not None and fd == self.lirc.fileno():
+                for arrived, line in self.lirc.handle():
+                    self.queue_line(line, None, arrived)
             else:
-                self.send_keys(k.split('+'))
+                for line, ack in self.command_socket.handle(fd):
+                    self.queue_line(line, ack)
+        return True
+
+    # Take the next line off the backlog once the previous one for its host is scheduled out,
+    # so lines wait on the backlog (where the policy applies) rather than the scheduler
+    def next_line(self):
+        entry = self.backlog.pop(self.scheduler.is_idle)
+        if entry is None:
+            return
+        for _ in range(min(entry.count, self.backlog_max_repeat)):
+            self.send_line(entry.line, entry.ack, entry.arrived)
 
     # Read from the queue, looking for an update status message
     def update_state(self, block=False, timeout=0):
@@ -269,6 +566,10 @@ class  FifoClient():
                 self.state = msg['value']
         except Queue.Empty:
             pass
+        except (IOError, OSError) as e:
+            # A profiling signal cut the wait short
+            if not is_interrupted(e):
+                raise
 
     # Kick off main loop
     def run(self):
@@ -281,22 +582,32 @@ class  FifoClient():
 
         # dbus service is ready
         if not self.shutdown_flag.is_set():
-            self.init_dbus()
+            self.init_transport()
 
         while self.state != 'SHUTDOWN' and not self.shutdown_flag.is_set():
             # Now wait until a connection is made
             while self.state == 'DISCONNECTED':
-                self.update_state(block=True, timeout=0.5)
-                sleep(self.control_sleep)            
+                self.update_state(block=True, timeout=self.control_sleep)
 
             # Reset the fifo in case a bunch of command were queued up,
             # don't want them all to replay once the connection is made
             self.fifo_reader.flush()
+            if self.lirc is not None and self.lirc.fileno() is not None:
+                self.lirc.handle()
+            self.backlog.clear()
+            self.scheduler.cancel_all()
 
             while self.state == 'CONNECTED':
-                line, update = self.fifo_reader.get_line()
-                if line is not None:
-                    self.send_line(line)
+                # Keep reading while lines are queued, so the backlog policy sees them
+                if self.backlog.has_ready(self.scheduler.is_idle):
+                    timeout = 0
+                else:
+                    timeout = self.loop_timeout()
+                update = not self.wait_input(timeout) and timeout > 0
+                self.next_line()
+                self.scheduler.run_due()
+                if self.stats.enabled and monotonic() >= self.next_stats_push:
+                    self.push_stats()
                 if update:
                     self.update_state(False)
 
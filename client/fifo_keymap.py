@@ -214,4 +214,28 @@ keymap = {
     'KEY_MEDIA_REFRESH': 0xfa,
     'KEY_MEDIA_CALC': 0xfb,
 
-}
\ No newline at end of file
+}
+
+
+#
+# Consumer control label => bit in the consumer report (report ID 3)
+#
+# Bits are in the order of the usages in the report descriptor,
+# see attribute 0x0206 in server/sdp_record.xml
+#
+
+consumer_keymap = {
+    'CC_HOME': 1 << 0, # AC Home (0x223)
+    'CC_SEARCH': 1 << 1, # AC Search (0x221)
+    'CC_SCREENSAVER': 1 << 2, # AL Screen Saver (0x1b1)
+    'CC_EJECT': 1 << 3, # Eject (0xb8)
+    'CC_PREVIOUS': 1 << 4, # Scan Previous Track (0xb6)
+    'CC_PLAYPAUSE': 1 << 5, # Play/Pause (0xcd)
+    'CC_NEXT': 1 << 6, # Scan Next Track (0xb5)
+    'CC_MUTE': 1 << 7, # Mute (0xe2)
+    'CC_VOLUMEDOWN': 1 << 8, # Volume Decrement (0xea)
+    'CC_VOLUMEUP': 1 << 9, # Volume Increment (0xe9)
+    'CC_POWER': 1 << 10, # Power (0x30)
+    'CC_BACK': 1 << 11, # AC Back (0x224)
+    'CC_MENU': 1 << 12, # Menu (0x40)
+}
@@ -0,0 +1,31 @@
+#
+# Host targeting, shared by FifoClient and the service
+#
+# A host is named by its bluetooth address or an alias from the [Hosts]
+# section of the config. No host, or HOST_ALL, means every connected host.
+#
+
+from __future__ import absolute_import, print_function
+
+ALL = 'ALL'
+
+
+# Address for a host name, or None for all hosts
+# aliases - {alias: address}, aliases are matched case-insensitively
+def resolve_host(name, aliases=None):
+    if not name or name.upper() == ALL:
+        return None
+    if aliases:
+        addr = aliases.get(name.lower())
+        if addr is not None:
+            return addr.upper()
+    return name.upper()
+
+
+# {alias: address} from a config section, or its items
+def read_aliases(items):
+    aliases = {}
+    for alias, addr in items:
+        if addr.strip():
+            aliases[alias.lower()] = addr.strip().upper()
+    return aliases
@@ -0,0 +1,83 @@
+#
+# Keyboard state engine, shared by the line compiler and the service
+#
+# Tracks the modifier byte as a bitmask and the held keys in the order
+# they went down. Modifier keys (KEY_LEFTCTRL etc.) held as keys are
+# reported as modifier bits, not in the key slots. When more keys are
+# held than the report has slots for, every slot reports ErrorRollOver
+# until enough keys are released, as the HID spec asks.
+#
+
+from __future__ import absolute_import, print_function
+
+# Key slots in a keyboard report
+SLOTS = 6
+
+# Usage reported in every slot when too many keys are held
+ERROR_ROLLOVER = 0x01
+
+# Modifier key usages, KEY_LEFTCTRL to KEY_RIGHTMETA => modifier bit
+FIRST_MODIFIER_KEY = 0xe0
+LAST_MODIFIER_KEY = 0xe7
+
+
+def is_modifier_key(code):
+    return FIRST_MODIFIER_KEY <= code <= LAST_MODIFIER_KEY
+
+
+def modifier_bit(code):
+    return 1 << (code - FIRST_MODIFIER_KEY)
+
+
+class KeyState():
+    __slots__ = ('modifier_byte', 'held')
+
+    # modifier_byte - modifiers toggled on with MOD_ labels
+    # held - key codes held down, oldest first
+    def __init__(self, modifier_byte=0x00, held=()):
+        self.modifier_byte = modifier_byte
+        self.held = list(held)
+
+    # Modifier bits in the report, toggled ones plus held modifier keys
+    def modifiers(self):
+        mods = self.modifier_byte
+        for code in self.held:
+            if is_modifier_key(code):
+                mods |= modifier_bit(code)
+        return mods
+
+    def slots(self):
+        keys = [code for code in self.held if not is_modifier_key(code)]
+        if len(keys) > SLOTS:
+            return [ERROR_ROLLOVER] * SLOTS
+        return keys
+
+    def report(self):
+        return bytes(bytearray([0xA1, 0x01, self.modifiers(), 0x00] + self.slots()))
+
+    # Press a key, returns False if it was already down
+    def down(self, code):
+        if code == 0 or code in self.held:
+            return False
+        self.held.append(code)
+        return True
+
+    # Release a key, returns False if it wasn't down
+    def up(self, code):
+        if code not in self.held:
+            return False
+        self.held.remove(code)
+        return True
+
+    # Hold exactly these keys, releasing anything else
+    def chord(self, codes):
+        self.held = []
+        for code in codes:
+            self.down(code)
+
+    def release(self):
+        self.held = []
+
+    # Hashable snapshot, KeyState(*snapshot) restores it
+    def snapshot(self):
+        return (self.modifier_byte, tuple(self.held))
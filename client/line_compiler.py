@@ -0,0 +1,274 @@
+#
+# Compiles lines of FIFO grammar into immutable programs of prebuilt
+# HID reports, so repeated lines skip parsing entirely.
+#
+
+from __future__ import absolute_import, print_function
+
+from collections import OrderedDict, namedtuple
+
+from client.fifo_keymap import keymap, consumer_keymap
+from client.text_encoder import encode_text
+from client.key_state import KeyState
+
+# Program op codes
+OP_SEND = 'SEND'       # arg: prebuilt HID report bytestring
+OP_RELEASE = 'RELEASE' # arg: prebuilt release report
+OP_HOLD = 'HOLD'       # arg: seconds to wait
+
+# Modifier label => bit in the HID modifier byte
+MODIFIER_BITS = {
+    'LEFTCTRL': 0x01,
+    'LEFTSHIFT': 0x02,
+    'LEFTALT': 0x04,
+    'LEFTMETA': 0x08,
+    'RIGHTCTRL': 0x10,
+    'RIGHTSHIFT': 0x20,
+    'RIGHTALT': 0x40,
+    'RIGHTMETA': 0x80
+}
+
+# Same bytes the service sends for release_keys
+RELEASE_REPORT = bytes(bytearray([0xA1, 0x01, 0x00]))
+
+# Consumer report with nothing pressed
+CONSUMER_RELEASE_REPORT = bytes(bytearray([0xA1, 0x03, 0x00, 0x00, 0x00]))
+
+# ops - tuple of (op, arg) pairs
+# modifier_byte - modifier state after the program has run
+# held - keys still held down after the program has run, see key_state
+# segments - tuple of (delay, reports), reports are sent back to back
+#            delay seconds after the previous segment
+# tail - seconds to hold after the last segment
+# cancel - drop anything still pending for the host before running
+# consumer - consumer key bits still pressed after the program has run
+Program = namedtuple('Program', ['ops', 'modifier_byte', 'segments', 'tail', 'cancel', 'held', 'consumer'])
+
+
+# HID codes for key labels, unknown labels are skipped
+def key_codes(labels):
+    return [keymap[label] for label in labels if label in keymap]
+
+
+# Consumer key bits for a set of CC_ labels, None if none are known
+# Unknown labels are skipped
+def consumer_bits(labels):
+    bits = None
+    for label in labels:
+        if label not in consumer_keymap:
+            print("[BTKB:COMPILER] Unknown consumer key: ", label)
+            continue
+        bits = (bits or 0) | consumer_keymap[label]
+    return bits
+
+
+def consumer_report(bits):
+    return bytes(bytearray([0xA1, 0x03, bits & 0xff, (bits >> 8) & 0xff, (bits >> 16) & 0xff]))
+
+
+# Build the consumer control report for a set of CC_ labels
+# Unknown labels are skipped
+def build_consumer_report(labels):
+    return consumer_report(consumer_bits(labels) or 0)
+
+
+# Toggle or reset a modifier bit
+# Note: MOD_ is stripped before reaching this fn
+# Valid labels for modifiers:
+# MOD_RIGHTMETA - right GUI/windows key
+# MOD_RIGHTALT
+# MOD_RIGHTSHIFT
+# MOD_RIGHTCTRL
+# MOD_LEFTMETA - left GUI/windows key
+# MOD_LEFTALT
+# MOD_LEFTSHIFT
+# MOD_LEFTCTRL
+# MOD_RESET
+def apply_modifier(modifier_byte, mod=None):
+    if mod is None or mod == 'RESET':
+        return 0x00
+    if mod not in MODIFIER_BITS:
+        return modifier_byte
+    return modifier_byte ^ MODIFIER_BITS[mod]
+
+
+# Parse the seconds out of a HOLD_<# seconds> action
+def parse_hold(action):
+    try:
+        parts = action.split("_")
+        return float(parts[1]) if len(parts) > 1 else 0
+    except:
+        return 0
+
+
+# Host named by a HOST_<address|alias> token, or None if the line has none
+# HOST_ALL names every host
+def line_host(line):
+    line, _ = split_type_text(line)
+    for k in line.split():
+        if k.startswith('HOST_'):
+            return k[5:]
+    return None
+
+
+# KEY_ labels of the line's TYPEMATIC_KEY_<a> tokens, held by the service
+# for as long as the line keeps coming, see server/typematic.py
+def line_typematic(line):
+    line, _ = split_type_text(line)
+    return [k[10:] for k in line.split() if k.startswith('TYPEMATIC_')]
+
+
+# Split a line into its tokens and the text following ACT_TYPE, if any
+def split_type_text(line):
+    head, sep, text = line.partition('ACT_TYPE')
+    if not sep or (len(head) > 0 and not head[-1].isspace()):
+        return line, None
+    if text.startswith(' '):
+        text = text[1:]
+    return head, text
+
+
+# Compile a line into a Program, starting from a modifier state, held keys
+# and pressed consumer keys, as the line before left them
+# KEY_<a>+KEY_<b> - hold exactly these keys, releasing any others
+# DOWN_KEY_<a> - press a key, keeping the others held
+# UP_KEY_<a> - release one key
+# DOWN_ and UP_ only send a report when what the host sees changes
+# Valid actions:
+# ACT_HOLD_<# seconds>
+# ACT_RELEASE - release keyboard keys, and consumer keys if any are pressed
+# ACT_CANCEL - cancel holds and reports still pending from earlier lines
+# ACT_TYPE <text> - type the rest of the line as text
+# HOST_ and TYPEMATIC_ tokens are skipped, see line_host and line_typematic
+def compile_line(line, modifier_byte=0x00, held=(), consumer=0):
+    ops = []
+    cancel = False
+
+    state = KeyState(modifier_byte, held)
+    last = None
+
+    # What is pressed, so a release only sends the reports it needs to
+    keys_down = len(state.held) > 0
+
+    line, text = split_type_text(line)
+
+    for k in line.split():
+        if k.startswith('ACT_'):
+            action = k[4:]
+            if action == 'CANCEL':
+                cancel = True
+            elif action == 'RELEASE':
+                if consumer:
+                    ops.append((OP_RELEASE, CONSUMER_RELEASE_REPORT))
+                if keys_down or not consumer:
+                    ops.append((OP_RELEASE, RELEASE_REPORT))
+                    last = RELEASE_REPORT
+                state.release()
+                keys_down = False
+                consumer = 0
+            elif action.startswith('HOLD'):
+                ops.append((OP_HOLD, float(parse_hold(action))))
+        elif k.startswith('MOD_'):
+            state.modifier_byte = apply_modifier(state.modifier_byte, k[4:])
+        elif k.startswith('DOWN_') or k.startswith('UP_'):
+            down, label = k.split('_', 1)
+            if label not in keymap:
+                continue
+            changed = state.down(keymap[label]) if down == 'DOWN' else state.up(keymap[label])
+            report = state.report()
+            if changed and report != last:
+                ops.append((OP_SEND, report))
+                last = report
+                keys_down = True
+        elif k.startswith('HOST_') or k.startswith('TYPEMATIC_'):
+            continue
+        elif k.startswith('CC_'):
+            bits = consumer_bits(k.split('+'))
+            if bits is not None:
+                ops.append((OP_SEND, consumer_report(bits)))
+                consumer = bits
+        else:
+            state.chord(key_codes(k.split('+')))
+            last = state.report()
+            ops.append((OP_SEND, last))
+            keys_down = True
+
+    # Typing ends with everything released
+    if text is not None:
+        for report in encode_text(text, state.modifiers()):
+            ops.append((OP_SEND, report))
+        state.release()
+
+    segments, tail = build_segments(ops)
+    return Program(tuple(ops), state.modifier_byte, segments, tail, cancel, tuple(state.held), consumer)
+
+
+# Group ops into runs of reports separated by holds
+def build_segments(ops):
+    segments = []
+    reports = []
+    delay = 0.0
+    wait = 0.0
+
+    for op, arg in ops:
+        if op == OP_HOLD:
+            wait += arg
+            continue
+        if wait > 0 and len(reports) > 0:
+            segments.append((delay, tuple(reports)))
+            reports = []
+            delay = 0.0
+        delay += wait
+        wait = 0.0
+        reports.append(arg)
+
+    if len(reports) > 0:
+        segments.append((delay, tuple(reports)))
+
+    return tuple(segments), wait
+
+
+# Bounded LRU cache of compiled programs,
+# keyed by line text and the key state the line starts from
+class LineCompiler():
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def compile(self, line, modifier_byte=0x00, held=(), consumer=0):
+        key = (line.rstrip('\r\n'), modifier_byte, held, consumer)
+
+        program = self.cache.pop(key, None)
+        if program is not None:
+            self.hits += 1
+            self.cache[key] = program
+            return program
+
+        self.misses += 1
+        program = compile_line(key[0], modifier_byte, held, consumer)
+
+        # Typed text is mostly one-off (search terms, passwords),
+        # keep it from evicting the lines that do repeat
+        if self.max_size > 0 and 'ACT_TYPE' not in key[0]:
+            self.cache[key] = program
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+        return program
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.cache),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
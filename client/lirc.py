@@ -0,0 +1,162 @@
+#
+# LIRC input, read straight from the lircd socket
+#
+# lircd writes one line per decoded button event to every client of its
+# socket:
+#
+#   <code> <repeat count> <button> <remote>
+#
+# with the code and repeat count in hex. Buttons are mapped to lines of
+# FIFO grammar through the [LircButtons] section of the config, so a
+# press costs a socket read instead of irexec spawning btkb.
+# A <remote>.<button> entry takes precedence over a <button> one.
+# Replies to commands (BEGIN ... END blocks) are skipped, none are sent.
+# Repeat events always go through for lines with TYPEMATIC_ keys, the
+# service holds those keys for as long as the repeats keep coming.
+#
+# lircd may start after us or restart, the socket is reconnected every
+# RECONNECT_INTERVAL seconds while it is down.
+#
+
+from __future__ import absolute_import, print_function
+
+import errno
+import socket
+
+from client.scheduler import monotonic
+
+RECONNECT_INTERVAL = 2.0
+
+
+# Parse an event line into (code, repeat, button, remote), None if it isn't one
+def parse_event(line):
+    parts = line.split()
+    if len(parts) != 4:
+        return None
+    try:
+        return int(parts[0], 16), int(parts[1], 16), parts[2], parts[3]
+    except ValueError:
+        return None
+
+
+# {button: line} from a config section, or its items
+# Keys are lowercased, configparser does it anyway
+def read_buttons(items):
+    buttons = {}
+    for button, line in items:
+        if line.strip():
+            buttons[button.lower()] = line.strip()
+    return buttons
+
+
+class LircSocket():
+    # path - lircd socket
+    # buttons - {button or remote.button: line}, see read_buttons
+    # repeats - send the line again for repeat events, otherwise only the first press does
+    def __init__(self, path='/var/run/lirc/lircd', buttons=None, repeats=False):
+        print("[BTKB:LIRC] Reading lircd socket at path: " + path)
+
+        self.path = path
+        self.buttons = buttons or {}
+        self.repeats = repeats
+
+        self.sock = None
+        self.buf = ''
+        self.next_connect = 0
+
+        self.events = 0
+        self.unmapped = 0
+        self.reconnects = 0
+
+        self.connect()
+
+    def connect(self):
+        if self.sock is not None or monotonic() < self.next_connect:
+            return False
+        self.next_connect = monotonic() + RECONNECT_INTERVAL
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            sock.close()
+            if self.reconnects == 0:
+                print("[BTKB:LIRC] Can't connect to lircd, retrying: ", e)
+            self.reconnects += 1
+            return False
+
+        print("[BTKB:LIRC] Connected to lircd")
+        sock.setblocking(False)
+        self.sock = sock
+        self.buf = ''
+        self.reconnects = 0
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # fd to wait on, None while disconnected
+    def fileno(self):
+        return self.sock.fileno() if self.sock is not None else None
+
+    # Seconds until the next connect attempt, None while connected
+    def timeout(self):
+        if self.sock is not None:
+            return None
+        return max(0, self.next_connect - monotonic())
+
+    # Read what lircd has sent, returns a list of (monotonic time it was read, line)
+    def handle(self):
+        arrived = monotonic()
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                data = None
+
+            if not data:
+                print("[BTKB:LIRC] lircd closed the connection")
+                self.close()
+                break
+
+            if not isinstance(data, str):
+                data = data.decode('utf-8', 'replace')
+            self.buf += data
+
+        lines = []
+        if '\n' in self.buf:
+            parts = self.buf.split('\n')
+            self.buf = parts.pop()
+            for part in parts:
+                line = self.map_event(part)
+                if line is not None:
+                    lines.append((arrived, line))
+        return lines
+
+    # Line for an event, None if it is unmapped or a repeat we skip
+    def map_event(self, text):
+        event = parse_event(text)
+        if event is None:
+            return None
+        _, repeat, button, remote = event
+        self.events += 1
+
+        line = self.buttons.get((remote + '.' + button).lower())
+        if line is None:
+            line = self.buttons.get(button.lower())
+        if line is None:
+            self.unmapped += 1
+        elif repeat > 0 and not self.repeats and 'TYPEMATIC_' not in line:
+            return None
+        return line
+
+    def stats(self):
+        return {
+            'connected': 1 if self.sock is not None else 0,
+            'events': self.events,
+            'unmapped': self.unmapped
+        }
@@ -0,0 +1,267 @@
+#
+# Named macros, loaded from the file set as MacroFile in the config
+#
+# Each macro is one or more lines of FIFO grammar, run one after the
+# other as if they had been written to the fifo:
+#
+#   # comments and blank lines are skipped
+#   home = CC_HOME ACT_RELEASE
+#   captions = KEY_DOWN ACT_RELEASE ACT_HOLD_0.3
+#       KEY_ENTER ACT_RELEASE
+#       MACRO_home
+#
+# Indented lines continue the macro above them. A line invokes a macro
+# with MACRO_<name>, macros can invoke each other but not themselves.
+# Every macro is compiled into programs when the file is loaded, so
+# invoking one from the idle key state costs a dict lookup.
+#
+# The file is watched with inotify and reloaded when it changes, without
+# touching the connection. A file that fails to load leaves the macros
+# from the last good one in place. Without inotify the file's mtime is
+# polled instead, see check().
+#
+
+from __future__ import absolute_import, print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+from client.line_compiler import compile_line, split_type_text
+from client.scheduler import monotonic
+
+# inotify_init1 flags
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events on the directory that mean the file was written or replaced,
+# editors often write a new file and rename it over the old one
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event, the name follows padded with NULs
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds between mtime checks when inotify isn't available
+POLL_INTERVAL = 1.0
+
+# Deepest chain of macros invoking macros
+MAX_DEPTH = 8
+
+# Key state a macro starts from, (modifier byte, held keys, consumer bits)
+IDLE_STATE = (0x00, (), 0)
+
+
+class MacroError(Exception):
+    pass
+
+
+# Key state a program leaves, for compiling the next line from
+def end_state(program):
+    return (program.modifier_byte, program.held, program.consumer)
+
+
+# Parse a macro file into {name: [lines]}
+def parse_macros(text):
+    macros = {}
+    name = None
+    for number, raw in enumerate(text.splitlines(), 1):
+        line = raw.strip()
+        if not line or line.startswith('#'):
+            continue
+        if raw[0].isspace():
+            if name is None:
+                raise MacroError("line %d: continues no macro" % number)
+            macros[name].append(line)
+            continue
+
+        name, sep, body = line.partition('=')
+        name = name.strip()
+        if not sep or not name or len(name.split()) > 1:
+            raise MacroError("line %d: expected <name> = <line>" % number)
+        if name in macros:
+            raise MacroError("line %d: %s is defined twice" % (number, name))
+        macros[name] = [body.strip()] if body.strip() else []
+    return macros
+
+
+# Split a line around its MACRO_ tokens
+# Returns a list of lines and ('MACRO', name) entries in order, a HOST_ token
+# is left on the lines but applies to the whole thing, see FifoClient.target_host
+def split_macros(line):
+    head, text = split_type_text(line.rstrip('\r\n'))
+    parts = []
+    tokens = []
+    for k in head.split():
+        if k.startswith('MACRO_'):
+            if any(not t.startswith('HOST_') for t in tokens):
+                parts.append(' '.join(tokens))
+            parts.append(('MACRO', k[6:]))
+            tokens = [t for t in tokens if t.startswith('HOST_')]
+        else:
+            tokens.append(k)
+    if text is not None:
+        tokens.extend(['ACT_TYPE', text])
+    if any(not t.startswith('HOST_') for t in tokens):
+        parts.append(' '.join(tokens))
+    return parts
+
+
+# Watch a directory with inotify, None if inotify isn't there
+def inotify_watch(path):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode('utf-8'), WATCH_MASK) < 0:
+        print("[BTKB:MACROS] Can't watch ", path, ": ", os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+class MacroLibrary():
+    # path - macro file
+    # watch - watch the file with inotify, otherwise check() polls its mtime
+    def __init__(self, path, watch=True):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+
+        # name => lines, and name => {start state: programs}
+        self.macros = {}
+        self.programs = {}
+
+        self.loads = 0
+        self.failed_loads = 0
+        self.mtime = None
+        self.next_poll = 0
+
+        self.fd = inotify_watch(os.path.dirname(self.path)) if watch else None
+        self.load()
+
+    # fd to wait on for changes, None if the mtime is polled
+    def fileno(self):
+        return self.fd
+
+    def polling(self):
+        return self.fd is None
+
+    def load(self):
+        try:
+            self.mtime = os.stat(self.path).st_mtime
+            with open(self.path) as f:
+                macros = parse_macros(f.read())
+            programs = {}
+            for name in macros:
+                programs[name] = {IDLE_STATE: self.compile_macro(macros, name, IDLE_STATE)}
+        except (IOError, OSError, MacroError) as e:
+            self.failed_loads += 1
+            print("[BTKB:MACROS] Failed to load ", self.path, ": ", e)
+            return False
+
+        self.macros = macros
+        self.programs = programs
+        self.loads += 1
+        print("[BTKB:MACROS] Loaded macros: ", sorted(macros.keys()))
+        return True
+
+    # Compile a macro's lines, each starting from the key state the one before left
+    def compile_macro(self, macros, name, state, depth=0):
+        if name not in macros:
+            raise MacroError("unknown macro %s" % name)
+        if depth > MAX_DEPTH:
+            raise MacroError("%s nests too deep, does it invoke itself?" % name)
+
+        programs = []
+        for line in macros[name]:
+            for part in split_macros(line):
+                if isinstance(part, tuple):
+                    programs.extend(self.compile_macro(macros, part[1], state, depth + 1))
+                else:
+                    programs.append(compile_line(part, *state))
+                if programs:
+                    state = end_state(programs[-1])
+        return tuple(programs)
+
+    # Programs for a line invoking macros, starting from a key state
+    # Plain parts of the line are compiled with compile_part, e.g. LineCompiler.compile
+    # Unknown macros are skipped
+    def compile(self, line, compile_part, modifier_byte=0x00, held=(), consumer=0):
+        state = (modifier_byte, held, consumer)
+        programs = []
+        for part in split_macros(line):
+            if isinstance(part, tuple):
+                programs.extend(self.macro_programs(part[1], state))
+            else:
+                programs.append(compile_part(part, *state))
+            if programs:
+                state = end_state(programs[-1])
+        return programs
+
+    # Compiled on first use from any state but the idle one
+    def macro_programs(self, name, state):
+        compiled = self.programs.get(name)
+        if compiled is None:
+            print("[BTKB:MACROS] Unknown macro: ", name)
+            return ()
+        if state not in compiled:
+            compiled[state] = self.compile_macro(self.macros, name, state)
+        return compiled[state]
+
+    # Read pending inotify events, reload if any were for the file
+    def handle(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise e
+            if not data:
+                break
+
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += length
+                if name == self.name:
+                    changed = True
+
+        if changed:
+            self.load()
+        return changed
+
+    # Reload if the mtime changed, at most every POLL_INTERVAL seconds
+    def check(self):
+        if not self.polling() or monotonic() < self.next_poll:
+            return False
+        self.next_poll = monotonic() + POLL_INTERVAL
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        return self.load()
+
+    def stats(self):
+        return {
+            'count': len(self.macros),
+            'loads': self.loads,
+            'failed_loads': self.failed_loads
+        }
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,102 @@
+#
+# Profiling on demand, for looking inside a running daemon
+#
+# cProfile, and tracemalloc where the python has it (3.4 and up), are
+# started and stopped at runtime, through the service's start_profiling
+# and stop_profiling dbus methods or with SIGUSR1 (start) and SIGUSR2
+# (stop). Stopping writes what was gathered to out_dir:
+#
+#   <name>-<time>.pstats    - python -m pstats <file>, or pstats.Stats(file)
+#   <name>-<time>.snapshot  - tracemalloc.Snapshot.load(file)
+#
+# cProfile only sees the thread that started it, the main loop's.
+#
+# Nothing is hooked while stopped, so it can stay available in production.
+#
+
+from __future__ import absolute_import, print_function
+
+import cProfile
+import errno
+import os
+import signal
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Frames kept per allocation by tracemalloc, more costs more memory
+DEFAULT_FRAMES = 10
+
+
+# An exception from a blocking call cut short by a signal (EINTR),
+# python 2 doesn't retry those, select.error keeps the errno in args
+def is_interrupted(err):
+    code = getattr(err, 'errno', None)
+    if code is None and getattr(err, 'args', None):
+        code = err.args[0]
+    return code == errno.EINTR
+
+
+class Profiler():
+    # name - prefix of the files written, e.g. btkb-server
+    # out_dir - where to write them
+    # frames - frames kept per allocation, 0 leaves tracemalloc off
+    def __init__(self, name, out_dir='/tmp', frames=DEFAULT_FRAMES):
+        self.name = name
+        self.out_dir = out_dir
+        self.frames = frames
+
+        self.profile = None
+        self.started = None
+        self.tracing = False
+
+    def running(self):
+        return self.profile is not None
+
+    # Start profiling, returns False if it already is
+    def start(self):
+        if self.profile is not None:
+            return False
+        print("[BTKB:PROFILE] Profiling %s" % self.name)
+        self.started = time.time()
+        if tracemalloc is not None and self.frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.tracing = True
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return True
+
+    # Stop profiling and write the results, returns the paths written
+    def stop(self):
+        if self.profile is None:
+            return []
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+
+        base = os.path.join(self.out_dir, '%s-%s' % (self.name, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))))
+        paths = []
+        try:
+            profile.dump_stats(base + '.pstats')
+            paths.append(base + '.pstats')
+            if self.tracing:
+                tracemalloc.take_snapshot().dump(base + '.snapshot')
+                paths.append(base + '.snapshot')
+        except (IOError, OSError) as e:
+            print("[BTKB:PROFILE] Failed to write profile: ", e)
+        finally:
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+
+        print("[BTKB:PROFILE] Profiled %s for %.1fs: %s" % (self.name, time.time() - self.started, ', '.join(paths)))
+        return paths
+
+    # SIGUSR1 starts, SIGUSR2 stops
+    def on_signal(self, sig_num, frame=None):
+        if sig_num == signal.SIGUSR1:
+            self.start()
+        elif sig_num == signal.SIGUSR2:
+            self.stop()
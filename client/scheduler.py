@@ -0,0 +1,153 @@
+#
+# Timer heap for running holds, releases and delayed reports at their
+# deadlines without blocking the loop that reads new input.
+#
+
+from __future__ import absolute_import, print_function
+
+import heapq
+import time
+
+# Python 2 has no monotonic clock in the time module
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+# End of a reserved hold, see Scheduler.reserve
+def hold_done():
+    pass
+
+
+# A scheduled call, cancelled timers stay in the heap and are skipped
+# dropped - optional (fn, args) called instead if the timer is cancelled
+class Timer():
+    __slots__ = ('deadline', 'seq', 'host', 'fn', 'args', 'cancelled', 'dropped')
+
+    def __init__(self, deadline, seq, host, fn, args, dropped=None):
+        self.deadline = deadline
+        self.seq = seq
+        self.host = host
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.dropped = dropped
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+# Ordering guarantees:
+# - timers for the same host run in the order they were scheduled,
+#   a timer never runs before one scheduled earlier for that host
+# - delays are relative to the host's previous timer,
+#   or to now if the host has nothing pending
+# - timers for different hosts don't wait on each other
+class Scheduler():
+    def __init__(self, late_threshold=0.005):
+        self.heap = []
+        self.seq = 0
+
+        # Deadline of the last timer scheduled per host
+        self.host_deadline = {}
+        self.pending = {}
+
+        # Deadline-miss stats
+        self.late_threshold = late_threshold
+        self.runs = 0
+        self.misses = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.cancelled = 0
+
+    def host_cursor(self, host, now):
+        return max(now, self.host_deadline.get(host, now))
+
+    # Run fn(*args) delay seconds after the host's previous timer
+    # dropped - optional (fn, args) to call if the timer is cancelled instead
+    def schedule(self, delay, fn, args=(), host=None, dropped=None):
+        deadline = self.host_cursor(host, monotonic()) + delay
+        self.seq += 1
+
+        timer = Timer(deadline, self.seq, host, fn, args, dropped)
+        heapq.heappush(self.heap, timer)
+
+        self.host_deadline[host] = deadline
+        self.pending[host] = self.pending.get(host, 0) + 1
+        return timer
+
+    # Push the host's cursor forward, used for holds at the end of a line
+    # A timer that does nothing marks the hold's end, so the host isn't idle
+    # and the lines after it wait where the backlog can still act on them
+    def reserve(self, delay, host=None):
+        return self.schedule(delay, hold_done, (), host)
+
+    def cancel(self, timer):
+        if timer.cancelled:
+            return
+        timer.cancelled = True
+        self.cancelled += 1
+        self.pending[timer.host] -= 1
+        if timer.dropped is not None:
+            timer.dropped[0](*timer.dropped[1])
+
+    # Cancel everything pending for a host, returns how many were cancelled
+    def cancel_host(self, host=None):
+        count = 0
+        for timer in self.heap:
+            if timer.host == host and not timer.cancelled:
+                self.cancel(timer)
+                count += 1
+        self.host_deadline.pop(host, None)
+        return count
+
+    def cancel_all(self):
+        for timer in self.heap:
+            if not timer.cancelled:
+                self.cancel(timer)
+        self.heap = []
+        self.host_deadline.clear()
+
+    def is_idle(self, host=None):
+        return self.pending.get(host, 0) == 0
+
+    # Seconds until the next timer is due, or default if there is none
+    def timeout(self, default=None):
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return default
+        return max(0, self.heap[0].deadline - monotonic())
+
+    # Run every timer that is due
+    def run_due(self):
+        while self.heap:
+            timer = self.heap[0]
+            if timer.cancelled:
+                heapq.heappop(self.heap)
+                continue
+
+            now = monotonic()
+            if timer.deadline > now:
+                return
+
+            heapq.heappop(self.heap)
+            self.pending[timer.host] -= 1
+            self.record(now - timer.deadline)
+            timer.fn(*timer.args)
+
+    def record(self, lateness):
+        self.runs += 1
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        if lateness > self.late_threshold:
+            self.misses += 1
+
+    def stats(self):
+        return {
+            'pending': sum(self.pending.values()),
+            'runs': self.runs,
+            'cancelled': self.cancelled,
+            'deadline_misses': self.misses,
+            'mean_lateness': self.total_lateness / self.runs if self.runs else 0.0,
+            'max_lateness': self.max_lateness
+        }
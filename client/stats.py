@@ -0,0 +1,137 @@
+#
+# Hot path latency histograms and counters
+#
+# Call sites check `stats.enabled` before taking timestamps, so with
+# instrumentation off the cost is one attribute lookup per stage.
+#
+
+from __future__ import absolute_import, print_function
+
+import os
+
+from client.scheduler import monotonic
+
+# Bucket i counts durations below 2^i microseconds, the last one is overflow
+BUCKETS = 25
+
+
+def bucket_bound(i):
+    return (1 << i) / 1000000.0
+
+
+# Fixed-size log2 histogram of durations in seconds
+class Histogram():
+    __slots__ = ('count', 'sum', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds):
+        i = int(seconds * 1000000).bit_length()
+        self.buckets[i if i < BUCKETS else BUCKETS - 1] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Upper bound of the bucket holding the p-th percentile
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for i in range(BUCKETS - 1):
+            seen += self.buckets[i]
+            if seen >= target:
+                return min(bucket_bound(i), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': float(self.count),
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+    def load(self, count, total, buckets, maximum):
+        self.count = count
+        self.sum = total
+        self.buckets = list(buckets)
+        self.max = maximum
+
+
+class Stats():
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.values = {}
+
+    # Record the time since t0 under stage
+    def since(self, stage, t0):
+        self.record(stage, monotonic() - t0)
+
+    def record(self, stage, seconds):
+        h = self.histograms.get(stage)
+        if h is None:
+            h = self.histograms[stage] = Histogram()
+        h.record(seconds)
+
+    def set_value(self, name, value):
+        self.values[name] = float(value)
+
+    def set_values(self, prefix, values):
+        for name, value in values.items():
+            self.values[prefix + name] = float(value)
+
+    # Plain types, for passing over dbus
+    # histograms: {stage: (count, sum, buckets, max)}
+    def snapshot(self):
+        histograms = {}
+        for stage, h in self.histograms.items():
+            histograms[stage] = (h.count, h.sum, list(h.buckets), h.max)
+        return histograms, dict(self.values)
+
+    # Replace what we have for a source with its snapshot
+    def load(self, source, histograms, values):
+        for stage, (count, total, buckets, maximum) in histograms.items():
+            h = self.histograms.get(source + stage)
+            if h is None:
+                h = self.histograms[source + stage] = Histogram()
+            h.load(count, total, buckets, maximum)
+        self.set_values(source, values)
+
+    # {stage: {count, mean, p50, p95, p99, max}}, values under 'values'
+    def summary(self):
+        out = {}
+        for stage, h in self.histograms.items():
+            out[stage] = h.summary()
+        out['values'] = dict(self.values)
+        return out
+
+    # Write a prometheus textfile, for node_exporter's textfile collector
+    def write_prometheus(self, path, prefix='btkb'):
+        lines = ['# TYPE %s_stage_seconds histogram' % prefix]
+        for stage in sorted(self.histograms.keys()):
+            h = self.histograms[stage]
+            seen = 0
+            for i in range(BUCKETS - 1):
+                seen += h.buckets[i]
+                lines.append('%s_stage_seconds_bucket{stage="%s",le="%g"} %d' % (prefix, stage, bucket_bound(i), seen))
+            lines.append('%s_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (prefix, stage, h.count))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (prefix, stage, h.sum))
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (prefix, stage, h.count))
+
+        lines.append('# TYPE %s_value gauge' % prefix)
+        for name in sorted(self.values.keys()):
+            lines.append('%s_value{name="%s"} %f' % (prefix, name, self.values[name]))
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        os.rename(tmp, path)
@@ -0,0 +1,102 @@
+#
+# Encodes text into HID keyboard reports for a US layout
+#
+# Keys are pressed one report at a time and stay held while the next
+# ones go down, using the 6 key slots, so the host sees the presses in
+# order. A release is only sent when a key repeats, the shift state
+# changes or all 6 slots are in use.
+#
+
+from __future__ import absolute_import, print_function
+
+from client.fifo_keymap import keymap
+
+LEFTSHIFT = 0x02
+
+# Characters that aren't a letter or digit => (key label, shifted)
+SYMBOLS = {
+    ' ': ('KEY_SPACE', False),
+    '\n': ('KEY_ENTER', False),
+    '\t': ('KEY_TAB', False),
+    '-': ('KEY_MINUS', False),
+    '_': ('KEY_MINUS', True),
+    '=': ('KEY_EQUAL', False),
+    '+': ('KEY_EQUAL', True),
+    '[': ('KEY_LEFTBRACE', False),
+    '{': ('KEY_LEFTBRACE', True),
+    ']': ('KEY_RIGHTBRACE', False),
+    '}': ('KEY_RIGHTBRACE', True),
+    '\\': ('KEY_BACKSLASH', False),
+    '|': ('KEY_BACKSLASH', True),
+    ';': ('KEY_SEMICOLON', False),
+    ':': ('KEY_SEMICOLON', True),
+    '\'': ('KEY_APOSTROPHE', False),
+    '"': ('KEY_APOSTROPHE', True),
+    '`': ('KEY_GRAVE', False),
+    '~': ('KEY_GRAVE', True),
+    ',': ('KEY_COMMA', False),
+    '<': ('KEY_COMMA', True),
+    '.': ('KEY_DOT', False),
+    '>': ('KEY_DOT', True),
+    '/': ('KEY_SLASH', False),
+    '?': ('KEY_SLASH', True),
+    '!': ('KEY_1', True),
+    '@': ('KEY_2', True),
+    '#': ('KEY_3', True),
+    '$': ('KEY_4', True),
+    '%': ('KEY_5', True),
+    '^': ('KEY_6', True),
+    '&': ('KEY_7', True),
+    '*': ('KEY_8', True),
+    '(': ('KEY_9', True),
+    ')': ('KEY_0', True)
+}
+
+
+# Build char => (HID key code, shifted) for everything we can type
+def build_charmap():
+    charmap = {}
+    for c in 'abcdefghijklmnopqrstuvwxyz':
+        charmap[c] = (keymap['KEY_' + c.upper()], False)
+        charmap[c.upper()] = (keymap['KEY_' + c.upper()], True)
+    for c in '0123456789':
+        charmap[c] = (keymap['KEY_' + c], False)
+    for c, (label, shifted) in SYMBOLS.items():
+        charmap[c] = (keymap[label], shifted)
+    return charmap
+
+charmap = build_charmap()
+
+
+def build_report(modifier_byte, keys):
+    return bytes(bytearray([0xA1, 0x01, modifier_byte, 0x00] + keys))
+
+
+# Encode text into a list of reports, ending with everything released
+# Characters without a key on a US layout are skipped
+# modifier_byte - modifiers held for the whole text, shift is added as needed
+def encode_text(text, modifier_byte=0x00):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+
+    reports = []
+    held = []
+    shift = False
+
+    for c in text:
+        if c not in charmap:
+            continue
+        code, shifted = charmap[c]
+
+        if len(held) > 0 and (code in held or shifted != shift or len(held) == 6):
+            reports.append(build_report(modifier_byte, []))
+            held = []
+
+        shift = shifted
+        held.append(code)
+        reports.append(build_report(modifier_byte | (LEFTSHIFT if shift else 0), held))
+
+    if len(held) > 0:
+        reports.append(build_report(modifier_byte, []))
+
+    return reports
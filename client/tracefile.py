@@ -0,0 +1,100 @@
+#
+# Input and report traces, for reproducing bugs and replaying load
+#
+# With TraceFile set, the fifo client and the service append events to
+# the same file as they happen, one JSON array per line:
+#
+#   [t, "L", line]                      - a line read from the fifo, command socket or lircd
+#   [t, "D", sender, method, args]      - a call to the service's dbus API
+#   [t, "C", sender]                    - the fifo client's own bus name, its dbus calls
+#                                         come from its lines and aren't inputs of their own
+#   [t, "R", host, report]              - a report written to a host's interrupt channel
+#
+# t is the monotonic clock in seconds, reports are hex. Lines are short
+# enough that appends from both processes don't interleave.
+# See tools/replay.py to feed a trace back in and compare the reports.
+#
+
+from __future__ import absolute_import, print_function
+
+import binascii
+import json
+import numbers
+import os
+
+from client.scheduler import monotonic
+
+LINE = 'L'
+DBUS = 'D'
+CLIENT = 'C'
+REPORT = 'R'
+
+
+def to_hex(data):
+    return binascii.hexlify(bytes(bytearray(data))).decode('ascii')
+
+
+def from_hex(text):
+    return bytes(bytearray(binascii.unhexlify(text)))
+
+
+# dbus arguments as plain JSON types, byte arrays as hex
+def plain(value):
+    if isinstance(value, bytearray) or type(value).__name__ == 'ByteArray' or (bytes is not str and isinstance(value, bytes)):
+        return to_hex(value)
+    if isinstance(value, dict):
+        return dict([(plain(k), plain(v)) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        # An array of bytes from dbus-python is a list of dbus.Byte
+        if value and all(type(v).__name__ == 'Byte' for v in value):
+            return to_hex([int(v) for v in value])
+        return [plain(v) for v in value]
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    return u'%s' % value
+
+
+class Trace():
+    def __init__(self, path):
+        print("[BTKB:TRACE] Tracing to: " + path)
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def event(self, kind, *fields):
+        data = json.dumps([round(monotonic(), 6), kind] + list(fields), separators=(',', ':')) + '\n'
+        os.write(self.fd, data.encode('utf-8'))
+
+    def line(self, line):
+        self.event(LINE, line.rstrip('\r\n'))
+
+    def dbus_call(self, sender, method, *args):
+        self.event(DBUS, sender, method, [plain(arg) for arg in args])
+
+    def client(self, sender):
+        self.event(CLIENT, sender)
+
+    def report(self, host, report):
+        self.event(REPORT, host, to_hex(report))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Events of a trace file, as lists, skipping lines that don't parse
+# (a write cut short when the daemon stopped)
+def read_trace(path, offset=0):
+    with open(path, 'r') as fh:
+        fh.seek(offset)
+        for text in fh:
+            try:
+                event = json.loads(text)
+            except ValueError:
+                continue
+            if isinstance(event, list) and len(event) >= 2:
+                yield event
@@ -0,0 +1,144 @@
+#
+# Transports used by FifoClient to get reports to the service
+#
+
+from __future__ import absolute_import, print_function
+
+import socket
+from time import sleep, time
+
+import dbus
+
+from client.line_compiler import RELEASE_REPORT
+
+
+# Everything goes over the org.max.btkb dbus interface
+class DbusTransport():
+    def __init__(self):
+        print("[BTKB:TRANSPORT] Set up dbus interface")
+        self.bus = dbus.SystemBus()
+        self.service = self.bus.get_object('org.max.btkb', "/org/max/btkb")
+        self.interface = dbus.Interface(self.service, 'org.max.btkb')
+
+    # host - address to send to, None for all hosts
+    def send_bytes(self, report, host=None):
+        if host is None:
+            self.interface.send_bytes(report)
+        else:
+            self.interface.send_bytes_to(host, report)
+
+    def release_keys(self, host=None):
+        if host is None:
+            self.interface.release_keys()
+        else:
+            self.interface.release_keys_to(host)
+
+    # A press or repeat of a held key by KEY_ label, with modifiers held along, see server/typematic.py
+    def typematic_key(self, label, modifier_byte=0x00, host=None):
+        if host is None:
+            self.interface.typematic_key(modifier_byte, label)
+        else:
+            self.interface.typematic_key_to(host, modifier_byte, label)
+
+    def send_reports(self, reports, delays, host=None):
+        if host is None:
+            self.interface.send_reports(reports, delays)
+        else:
+            self.interface.send_reports_to(host, reports, delays)
+
+    # histograms: {stage: (count, sum, buckets, max)}, see client.stats
+    def push_stats(self, source, histograms, values):
+        self.interface.push_stats(source, histograms, values)
+
+
+# Reports are written to the service's fast path socket,
+# one report per packet, behind a host header if sent to one host.
+# Falls back to dbus whenever the socket can't be used.
+class FastPathTransport(DbusTransport):
+    def __init__(self, path='/tmp/btkb.sock', retry_interval=5):
+        DbusTransport.__init__(self)
+
+        self.path = path
+        self.retry_interval = retry_interval
+        self.sock = None
+        self.last_attempt = 0
+
+    def connect(self):
+        if self.sock is not None:
+            return True
+
+        now = time()
+        if now - self.last_attempt < self.retry_interval:
+            return False
+        self.last_attempt = now
+
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sock.connect(self.path)
+        except socket.error as e:
+            print("[BTKB:TRANSPORT] Fast path unavailable, using dbus: ", e)
+            return False
+
+        print("[BTKB:TRANSPORT] Connected to fast path: ", self.path)
+        self.sock = sock
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # Write reports to the socket, returns how many were sent
+    def write(self, reports, delays=(), host=None):
+        if not self.connect():
+            return 0
+
+        header = b'' if host is None else ('@' + host + '\n').encode('utf-8')
+        sent = 0
+        try:
+            for i in range(len(reports)):
+                if i < len(delays) and delays[i] > 0:
+                    sleep(delays[i])
+                self.sock.send(header + reports[i])
+                sent += 1
+        except socket.error as e:
+            print("[BTKB:TRANSPORT] Fast path failed, using dbus: ", e)
+            self.close()
+
+        return sent
+
+    def send_bytes(self, report, host=None):
+        if self.write((report,), (), host) == 0:
+            DbusTransport.send_bytes(self, report, host)
+
+    def release_keys(self, host=None):
+        if self.write((RELEASE_REPORT,), (), host) == 0:
+            DbusTransport.release_keys(self, host)
+
+    # Whatever couldn't go over the socket is sent over dbus
+    def send_reports(self, reports, delays, host=None):
+        sent = self.write(reports, delays, host)
+        if sent < len(reports):
+            DbusTransport.send_reports(self, reports[sent:], delays[sent:], host)
+
+
+# Calls straight into a BTKbService in the same process, used by the
+# single process engine. Hosts are addresses, None for all hosts.
+class LocalTransport():
+    def __init__(self, service):
+        self.service = service
+
+    def send_bytes(self, report, host=None):
+        self.service.send_reports_to(host or '', [report], [0.0])
+
+    def release_keys(self, host=None):
+        self.service.release_keys_to(host or '')
+
+    def typematic_key(self, label, modifier_byte=0x00, host=None):
+        self.service.typematic_key_to(host or '', modifier_byte, label)
+
+    def send_reports(self, reports, delays, host=None):
+        self.service.send_reports_to(host or '', reports, delays)
+
+    def push_stats(self, source, histograms, values):
+        self.service.push_stats(source, histograms, values)
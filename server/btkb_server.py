@@ -11,7 +11,12 @@
 from __future__ import absolute_import, print_function
 
 from optparse import OptionParser, make_option
+from collections import deque
+import errno
+import math
 import os
+import signal
+import socket
 import sys
 import dbus
 import dbus.service
@@ -19,6 +24,33 @@ import dbus.mainloop.glib
 from bluetooth import *
 from dbus.mainloop.glib import DBusGMainLoop
 import xml.etree.ElementTree as ET
+from server.fast_path import FastPathServer
+from server import hidp
+from server.typematic import Typematic
+from server.pacer import Pacer, DEFAULT_KEY, DEFAULT_PROFILE
+from client.text_encoder import encode_text
+from client.line_compiler import build_consumer_report, RELEASE_REPORT, CONSUMER_RELEASE_REPORT
+from client.key_state import KeyState, ERROR_ROLLOVER
+from client.stats import Stats
+from client.tracefile import Trace
+from client.profiler import Profiler
+from client.scheduler import monotonic
+from client.hosts import resolve_host
+from client.fifo_keymap import keymap
+from gi.repository import GLib
+
+# Connection reset by peer, transport error or not connected
+DISCONNECT_ERRNOS = (errno.ECONNRESET, errno.ENOTCONN, errno.EPIPE, errno.ECONNABORTED, errno.EHOSTDOWN)
+
+def is_disconnect(err):
+    if getattr(err, 'errno', None) in DISCONNECT_ERRNOS:
+        return True
+    return "104" in str(err) or "107" in str(err)
+
+def would_block(err):
+    if getattr(err, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return True
+    return "temporarily unavailable" in str(err)
 
 # Define a bluez 5 profile object for our keyboard
 class BTKbBluezProfile(dbus.service.Object):
@@ -61,8 +93,24 @@ class BTKbBluezProfile(dbus.service.Object):
 class BTKbDevice():  
     PROFILE_DBUS_PATH = "/bluez/max/btkb_profile" # dbus path of the bluez profile we will create
     SDP_RECORD_PATH = os.path.dirname(os.path.abspath(__file__)) + '/sdp_record.xml' # path to SDP record to load
+    RECONNECT_MIN = 0.5 # seconds before the first outbound reconnect retry
+    RECONNECT_MAX = 30 # most seconds between retries, input for an absent host dials it at once, see wake
+    SDP_RECORD = None # (xml text, parsed root) once read and validated, see read_sdp_service_record
+    SDP_REQUIRED = ('0x0001', '0x0004', '0x0009', '0x0206') # attributes a HID record can't go without
+    QUEUE_OVERFLOW = ('drop-oldest', 'drop-newest', 'block') # policies for a full outbound queue
  
-    def __init__(self, bd_addr, name, uuid, dev_class = '0x002540', p_control = 17, p_interrupt = 19):
+    # on_connect(addr) and on_disconnect(addr) are called from the main loop as hosts come and go
+    # last_host_file - where the last connected hosts are kept, for reconnecting to them
+    # max_hosts - how many hosts can be connected at once
+    # on_leds(addr, leds) is called when a host sets its keyboard LEDs
+    # on_connectable() is called once the adapter is set up and we're listening
+    # pacing - {address: pacer Profile}, see server/pacer.py
+    # queue_max_depth - most reports queued per host for its interrupt channel, 0 for no limit
+    # queue_overflow - what to do with a report for a full queue, one of QUEUE_OVERFLOW
+    # stats - Stats to record time spent in the queue to
+    # trace - Trace to record reports to as they go out, see client/tracefile.py
+    # on_room(addr) is called when a full queue has room again, for the block policy
+    def __init__(self, bd_addr, name, uuid, dev_class = '0x002540', p_control = 17, p_interrupt = 19, last_host_file=None, on_connect=None, on_disconnect=None, max_hosts=1, on_leds=None, on_connectable=None, pacing=None, queue_max_depth=0, queue_overflow='drop-oldest', stats=None, trace=None, on_room=None):
         print("[BTKB] Setting up BT device")
         print("     bd_addr: ", bd_addr)
         print("     name: ", name)
@@ -81,21 +129,99 @@ class BTKbDevice():
         self.p_ctrl = p_control
         self.p_intr = p_interrupt
 
+        # Known hosts by address, connected or being reconnected
+        self.hosts = {}
+        self.max_hosts = max_hosts
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.on_leds = on_leds
+        self.last_host_file = last_host_file
+        self.pacing = pacing or {}
+
+        # Outbound report queues, see write()
+        if queue_overflow not in BTKbDevice.QUEUE_OVERFLOW:
+            raise Exception("Unknown queue overflow policy: " + str(queue_overflow))
+        self.queue_max_depth = queue_max_depth
+        self.queue_overflow = queue_overflow
+        self.stats = stats if stats is not None else Stats()
+        self.queue_dropped = 0
+        self.queue_blocked = 0
+        self.queue_max_seen = 0
+        self.trace = trace
+        self.on_room = on_room
+
+        # Steps left before hosts can connect
+        self.on_connectable = on_connectable
+        self.pending_setup = set(['adapter', 'listen'])
+
         self.init_bt_device()
         self.init_bluez_profile()
                     
-
-    # Configure the bluetooth hardware device
+    # A setup step is done, the last one makes us connectable
+    def setup_done(self, step):
+        if step not in self.pending_setup:
+            return
+        self.pending_setup.discard(step)
+        if not self.pending_setup and self.on_connectable is not None:
+            self.on_connectable()
+
+    # Configure the bluetooth adapter through its bluez Adapter1 properties,
+    # only the ones that need changing, sent together without waiting on each reply
     def init_bt_device(self):
         print("[BTKB] Configuring for name " + self.device_name + ", and class: " + self.device_class)
 
-        # Set the device class to a keybord and set the name
+        bus = dbus.SystemBus()
+        path, current = self.find_adapter(bus)
+        if path is None:
+            print("[BTKB] No bluez adapter with address " + self.device_addr + ", leaving it as it is")
+            self.setup_done('adapter')
+            return
+
+        props = dbus.Interface(bus.get_object("org.bluez", path), "org.freedesktop.DBus.Properties")
+
+        # Discoverable needs the adapter on
+        if not current.get('Powered', False):
+            props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(True))
+
+        # Discoverable for good, so the timeout goes first
+        wanted = [
+            ('Alias', dbus.String(self.device_name)),
+            ('Pairable', dbus.Boolean(True)),
+            ('DiscoverableTimeout', dbus.UInt32(0)),
+            ('Discoverable', dbus.Boolean(True))
+        ]
+        changes = [(name, value) for name, value in wanted if current.get(name) != value]
+
+        # Class is read-only on Adapter1, it takes an hciconfig when the major/minor class is off
         # Device class 0x002540 is a HID keyboard
-        os.system("hciconfig hcio class " + self.device_class)
-        os.system("hciconfig hcio name " + self.device_name)
-
-        # Make the device discoverable
-        os.system("hciconfig hcio piscan")
+        if int(current.get('Class', 0)) & 0x1ffc != int(self.device_class, 16) & 0x1ffc:
+            os.system("hciconfig " + path.split('/')[-1] + " class " + self.device_class)
+
+        if not changes:
+            self.setup_done('adapter')
+            return
+
+        pending = [len(changes)]
+        def replied(name, err=None):
+            if err is not None:
+                print("[BTKB] Could not set adapter " + name + ": ", err)
+            pending[0] -= 1
+            if pending[0] == 0:
+                self.setup_done('adapter')
+
+        for name, value in changes:
+            props.Set("org.bluez.Adapter1", name, value,
+                reply_handler=lambda name=name: replied(name),
+                error_handler=lambda err, name=name: replied(name, err))
+
+    # Object path and properties of the bluez adapter with our address, or (None, {})
+    def find_adapter(self, bus):
+        manager = dbus.Interface(bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
+        for path, interfaces in manager.GetManagedObjects().items():
+            adapter = interfaces.get("org.bluez.Adapter1")
+            if adapter is not None and str(adapter.get('Address', '')).upper() == self.device_addr.upper():
+                return str(path), adapter
+        return None, {}
 
 
     # Set up a bluez profile to advertise device capabilities from a loaded service record.
@@ -122,7 +248,11 @@ class BTKbDevice():
 
 
     # Read and return an sdp record from a file
+    # The record is validated and kept parsed, so it's only read once per process
     def read_sdp_service_record(self):
+        if BTKbDevice.SDP_RECORD is not None:
+            return BTKbDevice.SDP_RECORD[0]
+
         print("[BTKB] Reading service record from path: ", BTKbDevice.SDP_RECORD_PATH)
 
         try:
@@ -130,13 +260,26 @@ class BTKbDevice():
         except:
             sys.exit("Could not open the SDP record. Exiting...")
 
-        return fh.read()   
+        record = fh.read()
+        fh.close()
 
+        try:
+            root = ET.fromstring(record)
+        except ET.ParseError as e:
+            sys.exit("Could not parse the SDP record: " + str(e) + ". Exiting...")
+
+        ids = set([attr.get('id', '').lower() for attr in root.findall('attribute')])
+        missing = [attr for attr in BTKbDevice.SDP_REQUIRED if attr not in ids]
+        if root.tag != 'record' or missing:
+            sys.exit("SDP record is missing attributes " + ', '.join(missing) + ". Exiting...")
 
+        BTKbDevice.SDP_RECORD = (record, root)
+        return record
 
     # Listen for incoming client connections.
     # Ideally this would be handled by the Bluez 5 profile,
     # but that didn't seem to work.
+    # Connections are accepted from the GLib main loop, nothing here blocks.
     def listen(self):
         print("[BTKB] listen()")
 
@@ -149,59 +292,680 @@ class BTKbDevice():
 
         # Start listening on the server sockets
         print("[BTKB] Waiting for connections: "+ self.device_addr, self.p_ctrl, self.p_intr)
-        self.scontrol.listen(1) # Limit of 1 connection
-        self.sinterrupt.listen(1)
+        self.scontrol.listen(self.max_hosts)
+        self.sinterrupt.listen(self.max_hosts)
+        self.scontrol.setblocking(False)
+        self.sinterrupt.setblocking(False)
+
+        GLib.io_add_watch(self.scontrol.fileno(), GLib.IO_IN, self.on_accept, 'control')
+        GLib.io_add_watch(self.sinterrupt.fileno(), GLib.IO_IN, self.on_accept, 'interrupt')
+
+        # Meanwhile, try to get back to the hosts we had last
+        for addr in self.load_last_hosts():
+            self.host(addr)
+        self.reconnect()
+
+        self.setup_done('listen')
 
-        self.ccontrol, cinfo = self.scontrol.accept()
-        print ("[BTKB] Got a connection on the control channel from " + cinfo[0])
+    def on_accept(self, fd, condition, channel):
+        server = self.scontrol if channel == 'control' else self.sinterrupt
+        try:
+            client, cinfo = server.accept()
+        except Exception as e:
+            print("[BTKB] accept failed on the " + channel + " channel: ", e)
+            return True
+
+        addr = cinfo[0].upper()
+        if addr not in self.hosts and len(self.connected_hosts()) >= self.max_hosts:
+            print("[BTKB] Already have %d hosts, refusing %s" % (self.max_hosts, addr))
+            self.close_socket(client)
+            return True
+
+        print("[BTKB] Got a connection on the " + channel + " channel from " + addr)
+        host = self.host(addr)
+        if host.ccontrol is None and host.cinterrupt is None:
+            host.connect_started = monotonic()
+        self.set_channel(host, channel, client)
+        return True
+
+    # Known host by address, added if new
+    def host(self, addr):
+        host = self.hosts.get(addr)
+        if host is None:
+            host = self.hosts[addr] = HostConnection(addr)
+            host.pacer = Pacer(self.pacing.get(addr, self.pacing.get(DEFAULT_KEY, DEFAULT_PROFILE)))
+        return host
+
+    def connected_hosts(self):
+        return [host for host in self.hosts.values() if host.connected]
+
+    # Take a connected socket for one of a host's channels, replacing any old one
+    def set_channel(self, host, channel, sock):
+        if channel == 'control':
+            # Requests are answered from the main loop as they come in
+            sock.setblocking(False)
+            if host.control_watch is not None:
+                GLib.source_remove(host.control_watch)
+            self.close_socket(host.ccontrol)
+            host.ccontrol = sock
+            host.control_watch = GLib.io_add_watch(sock.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_control, host)
+
+            # Every connection starts out in report protocol
+            host.protocol = hidp.PROTOCOL_REPORT
+            host.suspended = False
+        else:
+            # Interrupt sends never block, a slow host queues instead of holding up the rest
+            sock.setblocking(False)
+            self.clear_outgoing(host)
+            host.last_reports = {}
+            host.last_sent = {}
+            if host.interrupt_watch is not None:
+                GLib.source_remove(host.interrupt_watch)
+            self.close_socket(host.cinterrupt)
+            host.cinterrupt = sock
+            host.interrupt_watch = GLib.io_add_watch(sock.fileno(), GLib.IO_IN, self.on_interrupt, host)
+
+        if host.ccontrol is not None and host.cinterrupt is not None and not host.connected:
+            host.connected = True
+            host.backoff = BTKbDevice.RECONNECT_MIN
+            self.cancel_outbound(host)
+            self.save_last_hosts()
+            if self.on_connect is not None:
+                self.on_connect(host.addr)
+
+    # A request on a host's control channel, or the host hanging up
+    def on_control(self, fd, condition, host):
+        data = None
+        if not condition & (GLib.IO_HUP | GLib.IO_ERR):
+            try:
+                data = host.ccontrol.recv(64)
+            except Exception as e:
+                if would_block(e):
+                    return True
+
+        if not data:
+            print("[BTKB] Host hung up: " + host.addr)
+            host.control_watch = None
+            self.disconnect(host)
+            return False
+
+        reply = self.control_request(host, bytearray(data))
+        if reply is not None:
+            try:
+                host.ccontrol.send(reply)
+            except Exception as e:
+                print("[BTKB] Could not answer " + host.addr + ": ", e)
+
+        # Unplugged, forget the host once we're out of its watch
+        if host.unplugged:
+            GLib.idle_add(self.unplug, host)
+        return True
+
+    # Answer a HIDP request, returns the reply or None if it doesn't get one
+    def control_request(self, host, data):
+        kind = data[0] & 0xF0
+        param = data[0] & 0x0F
+
+        if kind == hidp.HID_CONTROL:
+            if param == hidp.VIRTUAL_CABLE_UNPLUG:
+                print("[BTKB] Host unplugged: " + host.addr)
+                host.unplugged = True
+            elif param == hidp.SUSPEND:
+                host.suspended = True
+            elif param == hidp.EXIT_SUSPEND:
+                host.suspended = False
+            return None
+
+        if kind == hidp.GET_REPORT:
+            return self.get_report(host, param, data[1:])
+
+        if kind == hidp.SET_REPORT:
+            if param & 0x03 == hidp.REPORT_OUTPUT:
+                leds = hidp.parse_leds(data[1:])
+                if leds is not None:
+                    self.set_leds(host, leds)
+                    return hidp.handshake(hidp.SUCCESSFUL)
+            return hidp.handshake(hidp.ERR_INVALID_REPORT_ID)
+
+        if kind == hidp.GET_PROTOCOL:
+            return hidp.data(0, [host.protocol])
+
+        if kind == hidp.SET_PROTOCOL:
+            host.protocol = param & 0x01
+            print("[BTKB] " + host.addr + " set " + ("report" if host.protocol else "boot") + " protocol")
+            return hidp.handshake(hidp.SUCCESSFUL)
+
+        if kind == hidp.GET_IDLE:
+            return hidp.data(0, [host.idle])
+
+        if kind == hidp.SET_IDLE:
+            if len(data) < 2:
+                return hidp.handshake(hidp.ERR_INVALID_PARAMETER)
+            # Reports are only sent on change, the rate is kept for GET_IDLE
+            host.idle = data[1]
+            return hidp.handshake(hidp.SUCCESSFUL)
+
+        return hidp.handshake(hidp.ERR_UNSUPPORTED_REQUEST)
+
+    def get_report(self, host, param, body):
+        report_type, rid, size = hidp.parse_get_report(param, body)
+
+        if report_type == hidp.REPORT_INPUT:
+            report = host.last_reports.get(rid, hidp.IDLE_REPORTS.get(rid))
+            if report is not None and host.protocol == hidp.PROTOCOL_BOOT:
+                report = hidp.to_boot(report)
+        elif report_type == hidp.REPORT_OUTPUT and rid == hidp.KEYBOARD_ID:
+            report = hidp.data(hidp.REPORT_OUTPUT, [rid, host.leds])
+        else:
+            report = None
+
+        if report is None:
+            return hidp.handshake(hidp.ERR_INVALID_REPORT_ID)
+        if size is not None:
+            report = report[:1 + size]
+        return report
+
+    # Output reports from the host on the interrupt channel
+    def on_interrupt(self, fd, condition, host):
+        try:
+            data = bytearray(host.cinterrupt.recv(64))
+        except Exception as e:
+            if would_block(e):
+                return True
+            data = None
+
+        # Hangups are noticed on the control channel
+        if not data:
+            host.interrupt_watch = None
+            return False
+
+        if data[0] == hidp.DATA | hidp.REPORT_OUTPUT:
+            leds = hidp.parse_leds(data[1:])
+            if leds is not None:
+                self.set_leds(host, leds)
+        return True
+
+    def set_leds(self, host, leds):
+        if leds == host.leds:
+            return
+        host.leds = leds
+        if self.on_leds is not None:
+            self.on_leds(host.addr, leds)
+
+    # Drop a host for good, it won't be reconnected
+    def unplug(self, host):
+        self.disconnect(host, False)
+        self.hosts.pop(host.addr, None)
+        self.save_last_hosts(host.addr)
+        return False
+
+    # Drop a host's connection and start getting it back, unless reconnect is False
+    def disconnect(self, host, reconnect=True):
+        if host.control_watch is not None:
+            GLib.source_remove(host.control_watch)
+            host.control_watch = None
+        if host.interrupt_watch is not None:
+            GLib.source_remove(host.interrupt_watch)
+            host.interrupt_watch = None
+        self.clear_outgoing(host)
+        self.close_socket(host.ccontrol)
+        self.close_socket(host.cinterrupt)
+        host.ccontrol = None
+        host.cinterrupt = None
+
+        was_connected = host.connected
+        host.connected = False
+        if was_connected and self.on_disconnect is not None:
+            self.on_disconnect(host.addr)
+
+        if reconnect:
+            self.reconnect(host)
+
+    def close_socket(self, sock):
+        if sock is None:
+            return
+        try:
+            sock.close()
+        except Exception:
+            pass
 
-        self.cinterrupt, cinfo = self.sinterrupt.accept()
-        print ("[BTKB] Got a connection on the interrupt channel from " + cinfo[0])
+    # Open the control and interrupt channels to known hosts that aren't connected,
+    # retrying with backoff until that, or an incoming connection, works
+    def reconnect(self, host=None):
+        hosts = [host] if host is not None else list(self.hosts.values())
+        for host in hosts:
+            if host.connected or host.outbound is not None or host.retry_timer is not None:
+                continue
+            print("[BTKB] Reconnecting to " + host.addr)
+            self.connect_out(host, 'control')
+
+    def connect_out(self, host, channel):
+        if channel == 'control':
+            host.connect_started = monotonic()
+        port = self.p_ctrl if channel == 'control' else self.p_intr
+        sock = BluetoothSocket(L2CAP)
+        sock.setblocking(False)
+        try:
+            sock.connect((host.addr, int(port)))
+        except Exception as e:
+            # EINPROGRESS, finishes when the socket becomes writable
+            if "115" not in str(e):
+                self.close_socket(sock)
+                self.retry_outbound(host, e)
+                return
 
-    def reconnect(self):
-        print("[BTKB] reconnect()")
+        host.outbound = (sock, channel)
+        host.outbound_watch = GLib.io_add_watch(sock.fileno(), GLib.IO_OUT | GLib.IO_ERR | GLib.IO_HUP, self.on_connect_out, host)
 
-        self.ccontrol, cinfo = self.scontrol.accept()
-        print ("[BTKB] Reconnected to control channel " + cinfo[0])
+    def on_connect_out(self, fd, condition, host):
+        sock, channel = host.outbound
+        host.outbound = None
+        host.outbound_watch = None
 
-        self.cinterrupt, cinfo = self.sinterrupt.accept()
-        print ("[BTKB] Reconnected to interrupt channel " + cinfo[0])
+        try:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        except Exception as e:
+            err = e
+        if err or condition & (GLib.IO_ERR | GLib.IO_HUP):
+            self.close_socket(sock)
+            self.retry_outbound(host, err)
+            return False
+
+        print("[BTKB] Connected the " + channel + " channel to " + host.addr)
+        self.set_channel(host, channel, sock)
+        if channel == 'control' and not host.connected:
+            self.connect_out(host, 'interrupt')
+        return False
+
+    def retry_outbound(self, host, err):
+        print("[BTKB] Reconnect to %s failed, retrying in %.1fs: %s" % (host.addr, host.backoff, err))
+        if host.ccontrol is not None and host.cinterrupt is None:
+            if host.control_watch is not None:
+                GLib.source_remove(host.control_watch)
+                host.control_watch = None
+            self.close_socket(host.ccontrol)
+            host.ccontrol = None
+        host.retry_timer = GLib.timeout_add(int(host.backoff * 1000), self.on_retry, host)
+        host.backoff = min(host.backoff * 2, BTKbDevice.RECONNECT_MAX)
+
+    def on_retry(self, host):
+        host.retry_timer = None
+        self.reconnect(host)
+        return False
+
+    # Input for a host that is away, dial it now instead of waiting out the backoff,
+    # it may have just woken up
+    def wake(self, host):
+        if host.connected or host.retry_timer is None:
+            return
+        GLib.source_remove(host.retry_timer)
+        host.retry_timer = None
+        host.backoff = BTKbDevice.RECONNECT_MIN
+        self.reconnect(host)
+
+    def cancel_outbound(self, host):
+        if host.retry_timer is not None:
+            GLib.source_remove(host.retry_timer)
+            host.retry_timer = None
+        if host.outbound is not None:
+            GLib.source_remove(host.outbound_watch)
+            self.close_socket(host.outbound[0])
+            host.outbound = None
+            host.outbound_watch = None
+
+    # Last connected hosts, one address per line, most recent last
+    def load_last_hosts(self):
+        if self.last_host_file is None:
+            return []
+        try:
+            with open(self.last_host_file, 'r') as fh:
+                return [addr.strip().upper() for addr in fh if addr.strip()][-self.max_hosts:]
+        except IOError:
+            return []
+
+    # forget - address to leave out
+    def save_last_hosts(self, forget=None):
+        if self.last_host_file is None:
+            return
+        addrs = [addr for addr in self.load_last_hosts() if addr != forget and (not self.hosts.get(addr) or not self.hosts[addr].connected)]
+        addrs = (addrs + [host.addr for host in self.connected_hosts()])[-self.max_hosts:]
+        if addrs == self.load_last_hosts():
+            return
+        try:
+            d = os.path.dirname(self.last_host_file)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            with open(self.last_host_file, 'w') as fh:
+                fh.write('\n'.join(addrs) + '\n')
+        except (IOError, OSError) as e:
+            print("[BTKB] Could not save last hosts: ", e)
 
     def close(self):
         print("[BTKB] close()")
 
+        for host in self.hosts.values():
+            self.cancel_outbound(host)
+            self.clear_outgoing(host)
+            self.close_socket(host.ccontrol)
+            self.close_socket(host.cinterrupt)
         self.scontrol.close()
         self.sinterrupt.close()
 
-    # Send a string to the bluetooth host machine
-    def send_string(self, message):
-        self.cinterrupt.send(message)
+    # Send a string to a bluetooth host machine, or every connected one if addr is None
+    # Raises ENOTCONN if there is no such host connected, after dialing it
+    def send_string(self, message, addr=None):
+        if addr is None:
+            hosts = self.connected_hosts()
+        else:
+            host = self.hosts.get(addr)
+            hosts = [host] if host is not None and host.connected else []
+        if not hosts:
+            for host in (self.hosts.values() if addr is None else [self.hosts[addr]] if addr in self.hosts else []):
+                self.wake(host)
+            raise IOError(errno.ENOTCONN, "Transport endpoint is not connected (107)")
+
+        for host in hosts:
+            self.write(host, message)
+
+    # Write to a host's interrupt channel, queueing behind anything it hasn't taken yet
+    # and while its pacer holds reports back, see server/pacer.py
+    # Reports are kept for GET_REPORT, and cut down to boot form if the host asked for it
+    # The socket never blocks, queued reports are sent from the main loop. A full queue
+    # (queue_max_depth) drops its oldest report or the new one. With the block policy the
+    # caller holds its reports back until there is room instead, see has_room
+    def write(self, host, message):
+        report = message
+        if host.protocol == hidp.PROTOCOL_BOOT:
+            message = hidp.to_boot(message)
+            if message is None:
+                return
+        rid = hidp.report_id(message)
+
+        if host.outgoing or host.pacer.wait(monotonic()) > 0:
+            # Waiting anyway, a report that changes nothing can go
+            if message == self.last_queued(host, rid):
+                host.pacer.merged += 1
+                return
+            if self.enqueue(host, message):
+                host.last_reports[rid] = report
+            return
 
+        try:
+            host.cinterrupt.send(message)
+        except Exception as e:
+            if would_block(e):
+                host.pacer.blocked()
+                if self.enqueue(host, message):
+                    host.last_reports[rid] = report
+            elif is_disconnect(e):
+                print("[BTKB] Lost host " + host.addr + ": ", e)
+                self.disconnect(host)
+            else:
+                raise
+        else:
+            host.last_reports[rid] = report
+            host.last_sent[rid] = message
+            host.pacer.sent(monotonic())
+            if self.trace is not None:
+                self.trace.report(host.addr, message)
+
+    # The report a host will have seen last for a report ID once its queue is sent,
+    # as it goes on the wire. Reports the queue dropped don't count
+    def last_queued(self, host, rid):
+        for _, queued in reversed(host.outgoing):
+            if hidp.report_id(queued) == rid:
+                return queued
+        return host.last_sent.get(rid)
+
+    # Returns False if the report was dropped instead
+    def enqueue(self, host, message):
+        if self.queue_max_depth > 0 and len(host.outgoing) >= self.queue_max_depth:
+            self.queue_dropped += 1
+            # Under the block policy only a caller that didn't wait for room gets here
+            if self.queue_overflow != 'drop-oldest':
+                return False
+            host.outgoing.popleft()
+
+        host.outgoing.append((monotonic(), message))
+        self.queue_max_seen = max(self.queue_max_seen, len(host.outgoing))
+        self.flush(host)
+        return True
+
+    # Whether a report for a host can be written now under the block policy,
+    # if not on_room is called once the host has taken enough. The main loop
+    # never waits on a full queue
+    def has_room(self, addr):
+        if self.queue_overflow != 'block' or self.queue_max_depth <= 0:
+            return True
+        host = self.hosts.get(addr)
+        if host is None or len(host.outgoing) < self.queue_max_depth:
+            return True
+        self.queue_blocked += 1
+        return False
+
+    # The report at the head of a host's queue went out
+    def sent_queued(self, host):
+        queued_at, message = host.outgoing.popleft()
+        host.last_sent[hidp.report_id(message)] = message
+        if self.trace is not None:
+            self.trace.report(host.addr, message)
+        now = monotonic()
+        host.pacer.sent(now)
+        if self.stats.enabled:
+            self.stats.record('server.queue_wait', now - queued_at)
+        if self.on_room is not None and self.queue_overflow == 'block' and len(host.outgoing) < self.queue_max_depth:
+            self.on_room(host.addr)
+
+    # Queue depth and overflow counters, and each host's pacing gap
+    def queue_stats(self):
+        values = {
+            'queue_depth': sum([len(host.outgoing) for host in self.hosts.values()]),
+            'queue_max_depth': self.queue_max_seen,
+            'queue_dropped': self.queue_dropped,
+            'queue_blocked': self.queue_blocked
+        }
+        for host in self.hosts.values():
+            for name, value in host.pacer.stats().items():
+                values['pacer_' + name + '.' + host.addr] = value
+        return values
+
+    # Send what a host has queued, as fast as it takes it and its pacer lets it
+    # Sleeps on a writable watch or a pacing timer when it can't go on
+    def flush(self, host):
+        while host.outgoing:
+            if host.out_watch is not None or host.pace_timer is not None:
+                return
+            wait = host.pacer.wait(monotonic())
+            if wait > 0:
+                host.pace_timer = GLib.timeout_add(int(math.ceil(wait * 1000)), self.on_pace, host)
+                return
+
+            try:
+                host.cinterrupt.send(host.outgoing[0][1])
+            except Exception as e:
+                if would_block(e):
+                    host.pacer.blocked()
+                    host.out_watch = GLib.io_add_watch(host.cinterrupt.fileno(), GLib.IO_OUT, self.on_writable, host)
+                    return
+                print("[BTKB] Lost host " + host.addr + ": ", e)
+                self.disconnect(host)
+                return
+            self.sent_queued(host)
+
+    def on_writable(self, fd, condition, host):
+        host.out_watch = None
+        self.flush(host)
+        return False
+
+    def on_pace(self, host):
+        host.pace_timer = None
+        self.flush(host)
+        return False
+
+    def clear_outgoing(self, host):
+        if host.out_watch is not None:
+            GLib.source_remove(host.out_watch)
+            host.out_watch = None
+        if host.pace_timer is not None:
+            GLib.source_remove(host.pace_timer)
+            host.pace_timer = None
+        host.outgoing.clear()
+
+
+
+# One host: its channel pair, connection state and outbound reconnect state
+class HostConnection():
+    def __init__(self, addr):
+        self.addr = addr
+        self.ccontrol = None
+        self.cinterrupt = None
+        self.connected = False
+        self.control_watch = None
+        self.interrupt_watch = None
+
+        # HIDP state set by the host, see server/hidp.py
+        self.protocol = hidp.PROTOCOL_REPORT
+        self.idle = 0
+        self.leds = 0
+        self.suspended = False
+        self.unplugged = False
+
+        # Last report sent or queued per report ID, for GET_REPORT
+        self.last_reports = {}
+
+        # Last report that went out per report ID, as sent (boot form in boot protocol),
+        # for merging reports that change nothing, see BTKbDevice.write
+        self.last_sent = {}
+
+        # Reports the interrupt channel couldn't take yet, or held back by the pacer,
+        # as (monotonic time queued, report)
+        self.outgoing = deque()
+        self.out_watch = None
+        self.pacer = None
+        self.pace_timer = None
+
+        # Outbound reconnect state
+        self.outbound = None
+        self.outbound_watch = None
+        self.retry_timer = None
+        self.backoff = BTKbDevice.RECONNECT_MIN
+
+        # When the attempt that got the host back started, our dial or its first channel
+        self.connect_started = None
 
 
 # Define a dbus service that emulates a bluetooth keyboard.
 class  BTKbService(dbus.service.Object):
 
-    def __init__(self, out_queue, shutdown_flag, bd_addr, name, uuid, auto_release=False, dev_class='0x002540', p_control = 17, p_interrupt = 19):
+    def __init__(self, out_queue, shutdown_flag, bd_addr, name, uuid, auto_release=False, dev_class='0x002540', p_control = 17, p_interrupt = 19, fast_path=None, owner_uid=None, owner_gid=None, stats=False, stats_interval=10, stats_textfile=None, last_host_file=None, host_aliases=None, max_hosts=1, typematic=None, pacing=None, queue_max_depth=0, queue_overflow='drop-oldest', trace_file=None, profile_dir='/tmp', client_pid=None):
         print("[BTKB] Setting up service")
+        self.started_at = monotonic()
         self.queue = out_queue
 
         self.auto_release = auto_release
 
+        # Optional hot path instrumentation, client stats are pushed in
+        self.stats = Stats(stats)
+        self.stats_textfile = stats_textfile
+        if stats and stats_textfile:
+            GLib.timeout_add_seconds(stats_interval, self.write_stats)
+
+        # Optional trace of dbus calls and reports, see client/tracefile.py
+        self.trace = Trace(trace_file) if trace_file else None
+
+        # cProfile and tracemalloc on demand, with start_profiling and stop_profiling
+        # or SIGUSR1 and SIGUSR2. The fifo client process, if there is one, is signalled along
+        self.profiler = Profiler('btkb-server', profile_dir)
+        self.client_pid = client_pid
+        for sig_num in (signal.SIGUSR1, signal.SIGUSR2):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, sig_num, self.on_profile_signal, sig_num)
+
         # Det up as a dbus service
         bus_name = dbus.service.BusName("org.max.btkb", bus=dbus.SystemBus())
         dbus.service.Object.__init__(self, bus_name, "/org/max/btkb")
 
         self.update_state("DISCONNECTED")
 
+        # {alias: address}, for picking hosts by name
+        self.host_aliases = host_aliases or {}
+
+        # When each host went away, and the hosts back since then that haven't had
+        # a report yet with when their reconnect started, for the reconnect metrics.
+        # Reconnects are timed from the attempt that worked, not the disconnect,
+        # so a host asleep for an hour doesn't count as an hour long reconnect
+        self.disconnected_at = {}
+        self.woken = {}
+
+        # Reports waiting to go out per host address, as deques of (delay, report).
+        # Every send for a host goes through here so reports keep their order,
+        # delayed ones are sent from GLib timers and, under the block overflow
+        # policy, the rest wait here for room in the host's queue. The loop never sleeps
+        self.delayed = {}
+        self.delay_timers = {}
+
+        # Held remote buttons, pressed on top of what each host already has held
+        # and let go of on their own, with the modifier bits the press added per host
+        self.typematic = Typematic(self.typematic_press, self.typematic_release, typematic)
+        self.typematic_mods = {}
+
         # Create and setup our device
-        self.device = BTKbDevice(bd_addr, name, uuid, dev_class, p_control, p_interrupt)
+        self.device = BTKbDevice(bd_addr, name, uuid, dev_class, p_control, p_interrupt,
+            last_host_file, self.on_connect, self.on_disconnect, max_hosts, self.leds_changed, self.on_connectable,
+            pacing, queue_max_depth, queue_overflow, self.stats, self.trace, self.on_room)
+
+        # Optional unix socket straight to the interrupt channel
+        self.fast_path = None
+        if fast_path is not None:
+            self.fast_path = FastPathServer(self.queue_report, self.handle_error, fast_path, owner_uid, owner_gid, self.resolve_host)
 
-        # Start listening for connections
+        # Start listening for connections, the state goes to CONNECTED once a host is on
         self.device.listen()
 
-        # Mark state as active after connection received
-        self.update_state("CONNECTED")
+    # Adapter set up and listening, hosts can connect from here on
+    def on_connectable(self):
+        elapsed = monotonic() - self.started_at
+        self.stats.record('server.time_to_connectable', elapsed)
+        try:
+            with open('/proc/uptime', 'r') as fh:
+                uptime = float(fh.read().split()[0])
+            self.stats.set_value('uptime_at_connectable', uptime)
+            print("[BTKB] Connectable %.3fs after setup started, %.1fs after boot" % (elapsed, uptime))
+        except (IOError, ValueError):
+            print("[BTKB] Connectable %.3fs after setup started" % elapsed)
+
+    # The client is CONNECTED while any host is
+    def on_connect(self, addr):
+        if addr in self.disconnected_at:
+            now = monotonic()
+            started = self.device.hosts[addr].connect_started or now
+            print("[BTKB] Reconnected to %s in %.3fs, after %.1fs away" % (addr, now - started, now - self.disconnected_at.pop(addr)))
+            self.stats.record('server.reconnect', now - started)
+            self.woken[addr] = started
+        if len(self.device.connected_hosts()) == 1:
+            self.update_state("CONNECTED")
+
+    def on_disconnect(self, addr):
+        self.disconnected_at[addr] = monotonic()
+        self.typematic.stop(addr)
+        self.woken.pop(addr, None)
+        self.drop_delayed(addr)
+        if len(self.device.connected_hosts()) == 0:
+            self.update_state("DISCONNECTED")
+
+    # A host set its keyboard LEDs, bits from the lowest:
+    # num lock, caps lock, scroll lock, compose, kana
+    @dbus.service.signal('org.max.btkb', signature='sy')
+    def leds_changed(self, host, leds):
+        print("[BTKB] LEDs on %s: 0x%02x" % (host, leds))
+
+    # Record a call that came in over dbus, calls from inside the service have no sender
+    def trace_call(self, sender, method, *args):
+        if self.trace is not None and sender is not None:
+            self.trace.dbus_call(sender, method, *args)
+
+    # Address for a host name or alias, None for all hosts
+    def resolve_host(self, name):
+        return resolve_host(name, self.host_aliases)
 
     # Let client know that the state of the service has changed
     def update_state(self, state):
@@ -213,18 +977,40 @@ class  BTKbService(dbus.service.Object):
             }, False)
         
 
-    # Handle exceptions, sometimes by restarting the listening process
+    # Handle exceptions, lost hosts are dropped and reconnected in the background
     def handle_error(self, err):
-        # connection reset by peer or transport error
-        if "104" in err.message or "107" in err.message:
-            print("[BTKB] Closing and listening again...")
-            self.update_state("DISCONNECTED")
-            self.device.reconnect()
-            self.update_state("CONNECTED")
+        if is_disconnect(err):
+            print("[BTKB] Host not connected, report dropped")
         else:
             self.update_state("SHUTDOWN")
             raise err
 
+    # Send a report to a host by address, or all of them, timing the socket write if instrumented
+    def send_string(self, message, addr=None):
+        if self.stats.enabled:
+            t0 = monotonic()
+            self.device.send_string(message, addr)
+            self.stats.since('server.socket_send', t0)
+        else:
+            self.device.send_string(message, addr)
+
+        # First report since a host came back
+        if self.woken:
+            for woken, started in list(self.woken.items()):
+                if addr is None or addr == woken:
+                    elapsed = monotonic() - started
+                    print("[BTKB] First report to %s %.3fs after its reconnect started" % (woken, elapsed))
+                    self.stats.record('server.wake_to_first_report', elapsed)
+                    del self.woken[woken]
+
+    def write_stats(self):
+        try:
+            self.stats.set_values('server.', self.device.queue_stats())
+            self.stats.write_prometheus(self.stats_textfile)
+        except Exception as e:
+            print("[BTKB] Failed to write stats: ", e)
+        return True
+
     @dbus.service.method('org.freedesktop.DBus.Introspectable', out_signature='s')
     def Introspect(self):
         intro_path = os.path.dirname(os.path.abspath(__file__)) + '/org.max.btkb.introspection'
@@ -232,53 +1018,315 @@ class  BTKbService(dbus.service.Object):
         return ET.tostring(ET.parse(intro_path).getroot(), encoding='utf8', method='xml')
 
     # Send a string, probably a string of bytes
-    @dbus.service.method('org.max.btkb', in_signature='ay')
-    def send_bytes(self, b):
+    @dbus.service.method('org.max.btkb', in_signature='ay', sender_keyword='sender')
+    def send_bytes(self, b, sender=None):
+        self.trace_call(sender, 'send_bytes', b)
+        self.send_bytes_to('', b)
+
+    # Same as send_bytes, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='say', sender_keyword='sender')
+    def send_bytes_to(self, host, b, sender=None):
+        self.trace_call(sender, 'send_bytes_to', host, b)
         # print("[BTKB] send_bytes() ", b)
+        t0 = monotonic() if self.stats.enabled else 0
         try:
             bs = ''.join([chr(v) for v in b])
-            self.device.send_string(bs)
+            self.queue_reports(self.resolve_host(host), [bs])
+        except Exception as e:
+            self.handle_error(e)
+        if self.stats.enabled:
+            self.stats.since('server.send_bytes', t0)
+
+    # Send a sequence of reports back to back in one call
+    # delays[i] is the number of seconds to wait before sending reports[i],
+    # the call returns straight away and delayed reports go out from the main loop
+    @dbus.service.method('org.max.btkb', in_signature='aayad', byte_arrays=True, sender_keyword='sender')
+    def send_reports(self, reports, delays, sender=None):
+        self.trace_call(sender, 'send_reports', reports, delays)
+        self.send_reports_to('', reports, delays)
+
+    # Same as send_reports, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='saayad', byte_arrays=True, sender_keyword='sender')
+    def send_reports_to(self, host, reports, delays, sender=None):
+        self.trace_call(sender, 'send_reports_to', host, reports, delays)
+        t0 = monotonic() if self.stats.enabled else 0
+        try:
+            self.queue_reports(self.resolve_host(host), reports, delays)
+        except Exception as e:
+            self.handle_error(e)
+        if self.stats.enabled:
+            self.stats.since('server.send_reports', t0)
+
+    # Queue reports for a host behind the ones it is already waiting to send,
+    # reports for all hosts (addr None) are queued on each connected host
+    # delays[i] - seconds to wait before sending reports[i]
+    # Raises ENOTCONN if no host is connected to queue them on
+    def queue_reports(self, addr, reports, delays=()):
+        if addr is not None:
+            addrs = [addr]
+        else:
+            addrs = [host.addr for host in self.device.connected_hosts()]
+            if not addrs and reports:
+                self.send_string(reports[0], None)
+
+        for addr in addrs:
+            queue = self.delayed.setdefault(addr, deque())
+            for i in range(len(reports)):
+                queue.append((delays[i] if i < len(delays) else 0, reports[i]))
+            self.send_delayed(addr)
+
+    # One report, for the fast path
+    def queue_report(self, message, addr=None):
+        self.queue_reports(addr, [message])
+
+    # Send a host's queued reports up to the next one that has to wait
+    def send_delayed(self, addr):
+        if addr in self.delay_timers:
+            return
+        queue = self.delayed.get(addr)
+        # A host lost on the way drops its queue, see drop_delayed
+        while queue and self.delayed.get(addr) is queue:
+            delay, report = queue[0]
+            if delay > 0:
+                self.delay_timers[addr] = GLib.timeout_add(int(math.ceil(delay * 1000)), self.on_delay, addr)
+                return
+            if not self.device.has_room(addr):
+                return
+            queue.popleft()
+            try:
+                self.send_string(report, addr)
+            except Exception as e:
+                # The host isn't there, the rest would only fail too
+                if is_disconnect(e):
+                    self.drop_delayed(addr)
+                self.handle_error(e)
+        if self.delayed.get(addr) is queue:
+            del self.delayed[addr]
+
+    def on_delay(self, addr):
+        del self.delay_timers[addr]
+        queue = self.delayed.get(addr)
+        if queue:
+            queue[0] = (0, queue[0][1])
+            self.send_delayed(addr)
+        return False
+
+    # A host's full queue has room again, carry on from the main loop
+    def on_room(self, addr):
+        if addr in self.delayed and addr not in self.delay_timers:
+            self.delay_timers[addr] = GLib.idle_add(self.on_delay, addr)
+
+    # A host went away, its delayed reports would only fail
+    def drop_delayed(self, addr):
+        timer = self.delay_timers.pop(addr, None)
+        if timer is not None:
+            GLib.source_remove(timer)
+        self.delayed.pop(addr, None)
+
+    # Type out a string of text
+    @dbus.service.method('org.max.btkb', in_signature='s', sender_keyword='sender')
+    def type_text(self, text, sender=None):
+        self.trace_call(sender, 'type_text', text)
+        self.type_text_to('', text)
+
+    # Same as type_text, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='ss', sender_keyword='sender')
+    def type_text_to(self, host, text, sender=None):
+        self.trace_call(sender, 'type_text_to', host, text)
+        try:
+            self.queue_reports(self.resolve_host(host), list(encode_text(text)))
         except Exception as e:
             self.handle_error(e)
 
     # Send a string, probably a string of bytes
-    @dbus.service.method('org.max.btkb', in_signature='')
-    def release_keys(self):
+    @dbus.service.method('org.max.btkb', in_signature='', sender_keyword='sender')
+    def release_keys(self, sender=None):
+        self.trace_call(sender, 'release_keys')
+        self.release_keys_to('')
+
+    # Same as release_keys, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='s', sender_keyword='sender')
+    def release_keys_to(self, host, sender=None):
+        self.trace_call(sender, 'release_keys_to', host)
         try:
-            self.device.send_string(chr(0xA1)+chr(0x01)+chr(0x00))
+            self.queue_reports(self.resolve_host(host), [chr(0xA1)+chr(0x01)+chr(0x00)])
         except Exception as e:
             self.handle_error(e)
 
+    # Press consumer control keys by CC_ label (see fifo_keymap), in one report
+    # release - send the all-up report straight after
+    @dbus.service.method('org.max.btkb', in_signature='asb', sender_keyword='sender')
+    def send_consumer(self, keys, release, sender=None):
+        self.trace_call(sender, 'send_consumer', keys, release)
+        self.send_consumer_to('', keys, release)
+
+    # Same as send_consumer, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='sasb', sender_keyword='sender')
+    def send_consumer_to(self, host, keys, release, sender=None):
+        self.trace_call(sender, 'send_consumer_to', host, keys, release)
+        t0 = monotonic() if self.stats.enabled else 0
+        try:
+            reports = [build_consumer_report([str(k) for k in keys])]
+            if release:
+                reports.append(CONSUMER_RELEASE_REPORT)
+            self.queue_reports(self.resolve_host(host), reports)
+        except Exception as e:
+            self.handle_error(e)
+        if self.stats.enabled:
+            self.stats.since('server.send_consumer', t0)
+
+    # Connected hosts, {address: alias or ''}
+    @dbus.service.method('org.max.btkb', in_signature='', out_signature='a{ss}')
+    def list_hosts(self):
+        names = dict([(addr, alias) for alias, addr in self.host_aliases.items()])
+        return dict([(host.addr, names.get(host.addr, '')) for host in self.device.connected_hosts()])
+
     # Send a list of bytes
-    @dbus.service.method('org.max.btkb', in_signature='yayb')
-    def send_keys(self, modifier_byte, keys, auto_release=None):
+    # Keys are HID codes, modifier keys among them are sent as modifier bits
+    # and more than 6 keys are reported as ErrorRollOver, see client/key_state.py
+    @dbus.service.method('org.max.btkb', in_signature='yayb', sender_keyword='sender')
+    def send_keys(self, modifier_byte, keys, auto_release=None, sender=None):
+        self.trace_call(sender, 'send_keys', modifier_byte, keys, auto_release)
+        self.send_keys_to('', modifier_byte, keys, auto_release)
+
+    # Same as send_keys, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='syayb', sender_keyword='sender')
+    def send_keys_to(self, host, modifier_byte, keys, auto_release=None, sender=None):
+        self.trace_call(sender, 'send_keys_to', host, modifier_byte, keys, auto_release)
         if auto_release is None:
             auto_release = self.auto_release
+        t0 = monotonic() if self.stats.enabled else 0
 
-        cmd_str=""
-        cmd_str+=chr(0xA1)
-        cmd_str+=chr(0x01)
-        cmd_str+=chr(modifier_byte)
-        cmd_str+=chr(0x00)
+        state = KeyState(modifier_byte)
+        state.chord([int(key) for key in keys])
 
-        count=0
-        for key in keys:
-            if(count > 5):
+        # send the keys, and mark input as finished if specified
+        reports = [state.report()]
+        if auto_release:
+            reports.append(RELEASE_REPORT)
+        try:
+            self.queue_reports(self.resolve_host(host), reports)
+        except Exception as e:
+            self.handle_error(e)
+        if self.stats.enabled:
+            self.stats.since('server.send_keys', t0)
+
+    # A press or repeat event of a held remote button, by KEY_ label
+    # modifier_byte - modifiers to hold along with it, the sender's MOD_ state
+    # The key is held until events for it stop, see server/typematic.py
+    @dbus.service.method('org.max.btkb', in_signature='ys', sender_keyword='sender')
+    def typematic_key(self, modifier_byte, key, sender=None):
+        self.trace_call(sender, 'typematic_key', modifier_byte, key)
+        self.typematic_key_to('', modifier_byte, key)
+
+    # Same as typematic_key, to one host by address or alias, '' for all hosts
+    @dbus.service.method('org.max.btkb', in_signature='sys', sender_keyword='sender')
+    def typematic_key_to(self, host, modifier_byte, key, sender=None):
+        self.trace_call(sender, 'typematic_key_to', host, modifier_byte, key)
+        key = str(key)
+        if key not in keymap:
+            print("[BTKB] Unknown typematic key: ", key)
+            return
+        self.typematic.event(self.resolve_host(host), key, (int(modifier_byte), keymap[key]))
+
+    # What a host has held once its waiting reports are sent, from the last keyboard report
+    # Keys lost to ErrorRollOver can't be told apart and are left out
+    def host_key_state(self, addr):
+        report = None
+        for _, queued in reversed(self.delayed.get(addr, ())):
+            if hidp.report_id(queued) == hidp.KEYBOARD_ID:
+                report = queued
                 break
-            cmd_str += chr(key)
-            count += 1
+        if report is None and addr in self.device.hosts:
+            report = self.device.hosts[addr].last_reports.get(hidp.KEYBOARD_ID)
+        if report is None:
+            return KeyState()
+        b = bytearray(report)
+        return KeyState(b[2] if len(b) > 2 else 0x00, [code for code in b[4:] if code not in (0, ERROR_ROLLOVER)])
+
+    # Hosts a typematic key for addr is pressed on, None being every connected host
+    def typematic_hosts(self, addr):
+        if addr is not None:
+            return [addr]
+        return [host.addr for host in self.device.connected_hosts()]
+
+    # Hold the key down along with whatever the host has held
+    def typematic_press(self, addr, key):
+        modifier_byte, code = key
+        try:
+            addrs = self.typematic_hosts(addr)
+            if not addrs:
+                # Dials the hosts and raises ENOTCONN
+                self.queue_reports(None, [KeyState(modifier_byte, [code]).report()])
+            for target in addrs:
+                state = self.host_key_state(target)
+                self.typematic_mods[target] = modifier_byte & ~state.modifier_byte
+                state.modifier_byte |= modifier_byte
+                state.down(code)
+                self.queue_reports(target, [state.report()])
+        except Exception as e:
+            self.handle_error(e)
 
-        # send the keys
+    # Let go of the key and the modifiers its press added, leaving the rest held
+    def typematic_release(self, addr, key):
+        modifier_byte, code = key
         try:
-            self.device.send_string(cmd_str)
-            # mark input as finished if specified
-            if release:
-                self.device.send_string(chr(0xA1)+chr(0x01)+chr(0x00))
+            for target in self.typematic_hosts(addr):
+                state = self.host_key_state(target)
+                before = state.report()
+                state.modifier_byte &= ~self.typematic_mods.pop(target, 0)
+                state.up(code)
+                if state.report() != before:
+                    self.queue_reports(target, [state.report()])
         except Exception as e:
             self.handle_error(e)
 
+    # Latency histogram summaries for the service and pushed client stats
+    # {stage: {count, mean, p50, p95, p99, max}}, plus counters under 'values'
+    @dbus.service.method('org.max.btkb', in_signature='', out_signature='a{sa{sd}}')
+    def get_stats(self):
+        self.stats.set_values('server.', self.device.queue_stats())
+        return self.stats.summary()
+
+    # Stats pushed from another process, stored with source as a prefix
+    @dbus.service.method('org.max.btkb', in_signature='sa{s(tdatd)}a{sd}')
+    def push_stats(self, source, histograms, values):
+        self.stats.load(source, histograms, values)
+
+    # Start cProfile and tracemalloc here and in the fifo client, see client/profiler.py
+    # Returns False if already profiling
+    @dbus.service.method('org.max.btkb', in_signature='', out_signature='b')
+    def start_profiling(self):
+        self.signal_client(signal.SIGUSR1)
+        return self.profiler.start()
+
+    # Stop profiling and write the results, returns the files written here,
+    # the fifo client writes its own next to them
+    @dbus.service.method('org.max.btkb', in_signature='', out_signature='as')
+    def stop_profiling(self):
+        self.signal_client(signal.SIGUSR2)
+        return self.profiler.stop()
+
+    def on_profile_signal(self, sig_num):
+        self.profiler.on_signal(sig_num)
+        return True
+
+    def signal_client(self, sig_num):
+        if self.client_pid is None:
+            return
+        try:
+            os.kill(self.client_pid, sig_num)
+        except OSError as e:
+            print("[BTKB] Failed to signal the fifo client: ", e)
+
     def close(self):
         try:
+            for addr in list(self.delay_timers.keys()):
+                self.drop_delayed(addr)
+            self.profiler.stop()
+            self.typematic.close()
+            if self.fast_path is not None:
+                self.fast_path.close()
             self.device.close()
         except:
             pass
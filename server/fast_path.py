@@ -0,0 +1,111 @@
+#
+# Local fast path to the interrupt channel
+#
+# Clients connect to a unix SOCK_SEQPACKET socket and write one HID report
+# per packet, which is relayed straight to the connected host without
+# going through the dbus daemon. Control and state stay on dbus.
+#
+# A packet can start with "@<host>\n" to send the report to that host only,
+# host being an address or alias, otherwise it goes to every host.
+#
+# send - called with each report and host address or None, normally BTKbService.send_string
+# resolve_host - turns a host name from a packet into an address
+#
+
+from __future__ import absolute_import, print_function
+
+import errno
+import os
+import socket
+from gi.repository import GLib
+
+
+class FastPathServer():
+    def __init__(self, send, on_error, path='/tmp/btkb.sock', owner_uid=None, owner_gid=None, resolve_host=None):
+        print("[BTKB:FASTPATH] Setting up fast path at: ", path)
+
+        self.send = send
+        self.on_error = on_error
+        self.resolve_host = resolve_host
+        self.path = path
+        self.clients = {}
+
+        self.remove_socket()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        if owner_uid is not None or owner_gid is not None:
+            os.chown(self.path,
+                owner_uid if owner_uid is not None else -1,
+                owner_gid if owner_gid is not None else -1)
+        self.sock.listen(4)
+        self.sock.setblocking(False)
+
+        self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN, self.on_accept)
+
+    def remove_socket(self):
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != 2:
+                raise e
+
+    def on_accept(self, fd, condition):
+        try:
+            conn, _ = self.sock.accept()
+        except socket.error as e:
+            print("[BTKB:FASTPATH] accept failed: ", e)
+            return True
+
+        print("[BTKB:FASTPATH] Client connected")
+        conn.setblocking(False)
+        watch = GLib.io_add_watch(conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_packet)
+        self.clients[conn.fileno()] = (conn, watch)
+        return True
+
+    # Relay each packet to the host as one report
+    def on_packet(self, fd, condition):
+        conn, _ = self.clients[fd]
+
+        try:
+            data = conn.recv(128)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            data = None
+
+        if not data:
+            self.drop_client(fd)
+            return False
+
+        addr = None
+        if data[0:1] == b'@':
+            host, _, data = data[1:].partition(b'\n')
+            host = host.decode('utf-8')
+            addr = self.resolve_host(host) if self.resolve_host is not None else host.upper()
+
+        try:
+            self.send(data, addr)
+        except Exception as e:
+            print("[BTKB:FASTPATH] Failed to relay report: ", e)
+            try:
+                self.on_error(e)
+            except Exception:
+                pass
+
+        return True
+
+    def drop_client(self, fd):
+        print("[BTKB:FASTPATH] Client disconnected")
+        conn, _ = self.clients.pop(fd)
+        conn.close()
+
+    def close(self):
+        for fd in list(self.clients.keys()):
+            conn, watch = self.clients.pop(fd)
+            GLib.source_remove(watch)
+            conn.close()
+        GLib.source_remove(self.watch)
+        self.sock.close()
+        self.remove_socket()
@@ -0,0 +1,108 @@
+#
+# Bluetooth HID profile (HIDP) transactions
+#
+# The first byte of every message is a header, the transaction type in
+# the high nibble and a parameter in the low nibble. Requests arrive on
+# the control channel, one at a time, and each must be answered before
+# the host sends the next one. Input reports go out on the interrupt
+# channel as DATA (input) messages, the host sends output reports (LED
+# state) there as DATA (output) messages.
+#
+
+from __future__ import absolute_import, print_function
+
+# Transaction types
+HANDSHAKE = 0x00
+HID_CONTROL = 0x10
+GET_REPORT = 0x40
+SET_REPORT = 0x50
+GET_PROTOCOL = 0x60
+SET_PROTOCOL = 0x70
+GET_IDLE = 0x80
+SET_IDLE = 0x90
+DATA = 0xA0
+
+# HANDSHAKE results
+SUCCESSFUL = 0x00
+NOT_READY = 0x01
+ERR_INVALID_REPORT_ID = 0x02
+ERR_UNSUPPORTED_REQUEST = 0x03
+ERR_INVALID_PARAMETER = 0x04
+ERR_UNKNOWN = 0x0E
+ERR_FATAL = 0x0F
+
+# HID_CONTROL operations
+SUSPEND = 0x03
+EXIT_SUSPEND = 0x04
+VIRTUAL_CABLE_UNPLUG = 0x05
+
+# Report types, the low bits of the GET/SET_REPORT and DATA parameter
+REPORT_INPUT = 0x01
+REPORT_OUTPUT = 0x02
+REPORT_FEATURE = 0x03
+
+# GET_REPORT parameter bit, a 2 byte buffer size follows the report ID
+GET_REPORT_SIZE = 0x08
+
+PROTOCOL_BOOT = 0x00
+PROTOCOL_REPORT = 0x01
+
+# Report IDs in the SDP record's descriptor
+KEYBOARD_ID = 0x01
+CONSUMER_ID = 0x03
+
+# Input reports to answer GET_REPORT with before anything has been sent
+IDLE_REPORTS = {
+    KEYBOARD_ID: bytes(bytearray([DATA | REPORT_INPUT, KEYBOARD_ID, 0x00, 0x00])),
+    CONSUMER_ID: bytes(bytearray([DATA | REPORT_INPUT, CONSUMER_ID, 0x00, 0x00, 0x00]))
+}
+
+# Boot keyboard reports have a fixed size: modifiers, reserved and 6 keys
+BOOT_KEYBOARD_SIZE = 8
+
+
+def handshake(result):
+    return bytes(bytearray([HANDSHAKE | result]))
+
+
+def data(report_type, payload):
+    return bytes(bytearray([DATA | report_type]) + bytearray(payload))
+
+
+# Boot protocol form of an input report, or None if it has none
+# Only the keyboard report exists in boot protocol, padded to its fixed size
+def to_boot(report):
+    b = bytearray(report)
+    if len(b) < 2 or b[1] != KEYBOARD_ID:
+        return None
+    payload = b[2:2 + BOOT_KEYBOARD_SIZE]
+    return bytes(b[:2] + payload + bytearray(BOOT_KEYBOARD_SIZE - len(payload)))
+
+
+# Report ID of a report, given as it is sent (with its DATA header)
+def report_id(report):
+    b = bytearray(report)
+    return b[1] if len(b) > 1 else None
+
+
+# Split a GET_REPORT request into (report type, report ID, buffer size)
+# The report ID defaults to the keyboard's, buffer size is None if not given
+def parse_get_report(param, body):
+    body = bytearray(body)
+    size = None
+    if param & GET_REPORT_SIZE and len(body) >= 2:
+        size = body[-2] | (body[-1] << 8)
+        body = body[:-2]
+    rid = body[0] if len(body) > 0 else KEYBOARD_ID
+    return param & 0x03, rid, size
+
+
+# LED state from an output report payload (after the header), or None
+# The report ID is only there when the descriptor uses them, so both forms are taken
+def parse_leds(payload):
+    payload = bytearray(payload)
+    if len(payload) >= 2 and payload[0] == KEYBOARD_ID:
+        return payload[1]
+    if len(payload) == 1:
+        return payload[0]
+    return None
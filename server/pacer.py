@@ -0,0 +1,92 @@
+#
+# Report pacing, per host
+#
+# Some hosts (the Fire TV Stick among them) miss a report that comes
+# straight after another one, a press followed at once by its release
+# loses the press. A pacer keeps a minimum gap between the reports sent
+# to its host. Reports that come in sooner wait on the host's queue, and
+# a queued report that changes nothing (same as the report before it
+# with the same ID) is merged away instead of being sent.
+#
+# The gap adapts: each time the interrupt channel pushes back (the send
+# would block) the gap doubles, up to the profile's max_gap, and every
+# report that goes through without trouble shrinks it again by DECAY,
+# down to min_gap.
+#
+
+from __future__ import absolute_import, print_function
+
+from collections import namedtuple
+
+from client.hosts import resolve_host
+
+# min_gap - seconds to keep between reports, 0 sends them back to back
+# max_gap - most the gap can grow to under back-pressure
+Profile = namedtuple('Profile', ['min_gap', 'max_gap'])
+
+DEFAULT_PROFILE = Profile(0.0, 0.05)
+
+# Key the default profile is kept under
+DEFAULT_KEY = 'DEFAULT'
+
+# Smallest gap to widen to on the first push back, when min_gap is 0
+MIN_STEP = 0.002
+
+# Seconds taken off a widened gap per report sent without push back
+DECAY = 0.0005
+
+
+# Profile from "<min gap> <max gap>", a missing max gap comes from default
+def parse_profile(text, default=DEFAULT_PROFILE):
+    values = [float(v) for v in text.split()]
+    min_gap, max_gap = (values + list(default[len(values):]))[:2]
+    return Profile(min_gap, max(min_gap, max_gap))
+
+
+# {address: Profile} from a config section, or its items
+# Hosts are named by alias (addresses don't fit config keys),
+# a "default" entry is the profile for hosts that aren't listed
+def read_profiles(items, aliases=None):
+    items = list(items)
+    default = DEFAULT_PROFILE
+    for key, text in items:
+        if key.upper() == DEFAULT_KEY and text.strip():
+            default = parse_profile(text)
+
+    profiles = {DEFAULT_KEY: default}
+    for key, text in items:
+        if key.upper() != DEFAULT_KEY and text.strip():
+            profiles[resolve_host(key, aliases)] = parse_profile(text, default)
+    return profiles
+
+
+class Pacer():
+    def __init__(self, profile=DEFAULT_PROFILE):
+        self.profile = profile
+        self.gap = profile.min_gap
+        self.next_send = 0
+
+        self.pushbacks = 0
+        self.merged = 0
+
+    # Seconds until the next report can go
+    def wait(self, now):
+        return max(0, self.next_send - now)
+
+    # A report went out
+    def sent(self, now):
+        self.next_send = now + self.gap
+        if self.gap > self.profile.min_gap:
+            self.gap = max(self.profile.min_gap, self.gap - DECAY)
+
+    # The channel pushed back, widen the gap
+    def blocked(self):
+        self.pushbacks += 1
+        self.gap = min(self.profile.max_gap, max(self.gap * 2, MIN_STEP))
+
+    def stats(self):
+        return {
+            'gap': self.gap,
+            'pushbacks': self.pushbacks,
+            'merged': self.merged
+        }
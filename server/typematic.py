@@ -0,0 +1,147 @@
+#
+# Typematic keys, for remote buttons that send repeat events while held
+#
+# The first event for a key presses it and leaves it held, repeat events
+# only push back the release deadline, and the key is released once no
+# event has come for the key's timeout. While the key is held the host
+# repeats it with its own typematic settings, or, if the key has a rate,
+# the key is pressed again rate times a second after delay seconds.
+#
+# One key is held per host at a time, like a remote has one button down.
+# Pressing another key on the same host replaces the held one.
+#
+# press - called with (address or None, key) to press and hold a key, key
+#         being what event was given, the service passes (modifiers, HID code)
+# release - called with (address or None, key) to release it
+#
+
+from __future__ import absolute_import, print_function
+
+from collections import namedtuple
+
+from gi.repository import GLib
+
+# delay - seconds held before pressing again, if rate is set
+# rate - presses per second after the delay, 0 leaves repeating to the host
+# timeout - seconds after the last event to release the key
+Timing = namedtuple('Timing', ['delay', 'rate', 'timeout'])
+
+# Repeat events from lircd come about 110ms apart, one missed is fine
+DEFAULT_TIMING = Timing(0.5, 0, 0.25)
+
+
+# Timing from "<delay> <rate> <timeout>", missing values come from default
+def parse_timing(text, default=DEFAULT_TIMING):
+    values = [float(v) for v in text.split()]
+    return Timing(*(values + list(default[len(values):]))[:3])
+
+
+# Key the default timing is kept under
+DEFAULT_KEY = 'DEFAULT'
+
+
+# {KEY_ label: Timing} from a config section, or its items
+# A "default" entry sets the timing for keys that aren't listed
+def read_timings(items):
+    items = list(items)
+    default = DEFAULT_TIMING
+    for key, text in items:
+        if key.upper() == DEFAULT_KEY and text.strip():
+            default = parse_timing(text)
+
+    timings = {DEFAULT_KEY: default}
+    for key, text in items:
+        if key.upper() != DEFAULT_KEY and text.strip():
+            timings[key.upper()] = parse_timing(text, default)
+    return timings
+
+
+class HeldKey():
+    def __init__(self, key, timing):
+        self.key = key
+        self.timing = timing
+        self.release_timer = None
+        self.repeat_timer = None
+        self.events = 1
+
+
+class Typematic():
+    def __init__(self, press, release, timings=None):
+        self.press = press
+        self.release = release
+        self.timings = timings or {DEFAULT_KEY: DEFAULT_TIMING}
+
+        # address or None => HeldKey
+        self.held = {}
+
+        self.presses = 0
+        self.repeats = 0
+
+    def timing(self, label):
+        return self.timings.get(label.upper(), self.timings.get(DEFAULT_KEY, DEFAULT_TIMING))
+
+    # A press or repeat event for a key, an event for another key replaces the held one
+    def event(self, addr, label, key):
+        held = self.held.get(addr)
+        if held is not None and held.key == key:
+            held.events += 1
+            self.repeats += 1
+            self.arm_release(addr, held)
+            return
+
+        if held is not None:
+            self.stop(addr)
+
+        held = HeldKey(key, self.timing(label))
+        self.held[addr] = held
+        self.presses += 1
+        self.press(addr, key)
+        self.arm_release(addr, held)
+        if held.timing.rate > 0:
+            held.repeat_timer = GLib.timeout_add(int(held.timing.delay * 1000), self.on_delay, addr, held)
+
+    def arm_release(self, addr, held):
+        if held.release_timer is not None:
+            GLib.source_remove(held.release_timer)
+        held.release_timer = GLib.timeout_add(int(held.timing.timeout * 1000), self.on_timeout, addr, held)
+
+    # Delay over, keep pressing the key again at its rate
+    def on_delay(self, addr, held):
+        held.repeat_timer = GLib.timeout_add(max(1, int(1000 / held.timing.rate)), self.on_rate, addr, held)
+        self.on_rate(addr, held)
+        return False
+
+    # The host only sees a new keystroke after a release
+    def on_rate(self, addr, held):
+        self.release(addr, held.key)
+        self.press(addr, held.key)
+        return True
+
+    def on_timeout(self, addr, held):
+        held.release_timer = None
+        if self.held.get(addr) is held:
+            self.stop(addr)
+        return False
+
+    # Release the key held for an address, None being the one held on all hosts
+    def stop(self, addr):
+        held = self.held.pop(addr, None)
+        if held is None:
+            return
+        for timer in (held.release_timer, held.repeat_timer):
+            if timer is not None:
+                GLib.source_remove(timer)
+        held.release_timer = None
+        held.repeat_timer = None
+        self.release(addr, held.key)
+
+    def close(self):
+        for addr in list(self.held.keys()):
+            self.stop(addr)
+
+    def stats(self):
+        return {
+            'held': len(self.held),
+            'presses': self.presses,
+            'repeats': self.repeats
+        }
@@ -1,8 +1,13 @@
 # Script to start both server and FifoClient
 from server.btkb_server import BTKbService
 from client.fifo_client import FifoClient
+from client.hosts import read_aliases
+from client.lirc import read_buttons
+from server.typematic import read_timings
+from server.pacer import read_profiles
+from client.engine import Engine
 import multiprocessing
-from os import geteuid
+from os import geteuid, kill
 import sys
 import signal 
 from time import sleep
@@ -16,15 +21,85 @@ from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib
 
 
-def start_server(queue, shutdown_flag, bd_addr, name, uuid, auto_rel, dev_class, p_ctrl, p_intr):
+def start_server(queue, shutdown_flag, options):
     try:
         DBusGMainLoop(set_as_default=True)
         loop = GLib.MainLoop()
-        BTKbService(queue, shutdown_flag, bd_addr, name, uuid, auto_rel, dev_class, p_ctrl, p_intr)
+        BTKbService(queue, shutdown_flag, **options)
         loop.run()
     except:
         shutdown_flag.set()
 
+# BTKbService options from the config, by keyword so they can't shift
+def service_options(c, fast_path):
+    return {
+        'bd_addr': c['device_addr'],
+        'name': c['device_name'],
+        'uuid': c['device_uuid'],
+        'auto_release': c['auto_release'],
+        'dev_class': c['device_class'],
+        'p_control': c['port_control'],
+        'p_interrupt': c['port_interrupt'],
+        'fast_path': fast_path,
+        'owner_uid': c['fifo_owner_uid'],
+        'owner_gid': c['fifo_owner_gid'],
+        'stats': c['stats'],
+        'stats_interval': c['stats_interval'],
+        'stats_textfile': c['stats_textfile'],
+        'last_host_file': c['last_host_file'],
+        'host_aliases': c['host_aliases'],
+        'max_hosts': c['max_hosts'],
+        'typematic': c['typematic'],
+        'pacing': c['pacing'],
+        'queue_max_depth': c['queue_max_depth'],
+        'queue_overflow': c['queue_overflow'],
+        'trace_file': c['trace_file'],
+        'profile_dir': c['profile_dir']
+    }
+
+# Options shared by FifoClient and Engine
+def client_options(c):
+    return {
+        'fifo_path': c['fifo_path'],
+        'owner_uid': c['fifo_owner_uid'],
+        'owner_gid': c['fifo_owner_gid'],
+        'cache_size': c['fifo_cache_size'],
+        'stats': c['stats'],
+        'stats_interval': c['stats_interval'],
+        'command_socket': c['command_socket'],
+        'backlog_max_depth': c['backlog_max_depth'],
+        'backlog_ttl': c['backlog_ttl'],
+        'backlog_collapse': c['backlog_collapse'],
+        'backlog_max_repeat': c['backlog_max_repeat'],
+        'host_aliases': c['host_aliases'],
+        'default_host': c['default_host'],
+        'macro_file': c['macro_file'],
+        'lirc_socket': c['lirc_socket'],
+        'lirc_buttons': c['lirc_buttons'],
+        'lirc_repeats': c['lirc_repeats'],
+        'trace_file': c['trace_file']
+    }
+
+# Service and FifoClient in this process, sharing one main loop, see client/engine.py
+def start_single(shutdown_flag, c):
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+
+    engine = Engine(shutdown_flag, **client_options(c))
+    service = BTKbService(engine, shutdown_flag, **service_options(c, None))
+    engine.attach(service, loop)
+
+    def shutdown(sig_num, frame):
+        print('[BTKB:start] shut down')
+        shutdown_flag.set()
+        engine.close()
+        service.close()
+        loop.quit()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    loop.run()
+
 def read_config():
     try:
         config = configparser.ConfigParser()
@@ -38,10 +113,38 @@ def read_config():
             'device_class': config['Service'].get('DeviceClass', fallback='0x002540'),
             'port_control': config['Service'].getint('PortControl', fallback=17),
             'port_interrupt': config['Service'].get('PortInterrupt', fallback=19),
+            'fast_path': config['Service'].getboolean('FastPath', fallback=False),
+            'fast_path_socket': config['Service'].get('FastPathSocket', fallback='/tmp/btkb.sock'),
+            'stats': config['Service'].getboolean('Stats', fallback=False),
+            'stats_interval': config['Service'].getint('StatsInterval', fallback=10),
+            'stats_textfile': config['Service'].get('StatsTextfile', fallback=None) or None,
+            'last_host_file': config['Service'].get('LastHostFile', fallback=None) or None,
+            'max_hosts': config['Service'].getint('MaxHosts', fallback=1),
+            'engine': config['Service'].get('Engine', fallback='processes'),
+            'queue_max_depth': config['Service'].getint('QueueMaxDepth', fallback=0),
+            'queue_overflow': config['Service'].get('QueueOverflow', fallback='drop-oldest'),
+            'trace_file': config['Service'].get('TraceFile', fallback=None) or None,
+            'profile_dir': config['Service'].get('ProfileDir', fallback='/tmp') or '/tmp',
+            'host_aliases': read_aliases(config.items('Hosts')) if config.has_section('Hosts') else {},
+            'typematic': read_timings(config.items('Typematic')) if config.has_section('Typematic') else None,
+            'pacing': read_profiles(config.items('Pacing'), read_aliases(config.items('Hosts')) if config.has_section('Hosts') else {}) if config.has_section('Pacing') else None,
 
             'fifo_path': config['FifoClient'].get('Path', fallback='/tmp/btkb.fifo'),
             'fifo_owner_gid': config['FifoClient'].getint('OwnerGID', fallback=None),
-            'fifo_owner_uid': config['FifoClient'].getint('OwnerUID', fallback=None)
+            'fifo_owner_uid': config['FifoClient'].getint('OwnerUID', fallback=None),
+            'fifo_cache_size': config['FifoClient'].getint('LineCacheSize', fallback=64),
+            'fifo_batch': config['FifoClient'].getboolean('BatchReports', fallback=True),
+            'fifo_reader_mode': config['FifoClient'].get('ReaderMode', fallback='process'),
+            'command_socket': config['FifoClient'].get('CommandSocket', fallback=None) or None,
+            'backlog_max_depth': config['FifoClient'].getint('BacklogMaxDepth', fallback=0),
+            'backlog_ttl': config['FifoClient'].getfloat('BacklogTTL', fallback=0),
+            'backlog_collapse': config['FifoClient'].getboolean('BacklogCollapse', fallback=False),
+            'backlog_max_repeat': config['FifoClient'].getint('BacklogMaxRepeat', fallback=1),
+            'default_host': config['FifoClient'].get('DefaultHost', fallback=None) or None,
+            'macro_file': config['FifoClient'].get('MacroFile', fallback=None) or None,
+            'lirc_socket': config['FifoClient'].get('LircSocket', fallback=None) or None,
+            'lirc_repeats': config['FifoClient'].getboolean('LircRepeats', fallback=False),
+            'lirc_buttons': read_buttons(config.items('LircButtons')) if config.has_section('LircButtons') else {}
         }
 
     except Exception as e:
@@ -55,41 +158,38 @@ if __name__ == "__main__":
 
     c = read_config()
 
+    # Only hand the socket path around if the fast path is enabled
+    fast_path = c['fast_path_socket'] if c['fast_path'] else None
+
     shutdown_flag = multiprocessing.Event()
 
+    if c['engine'] == 'single':
+        start_single(shutdown_flag, c)
+        sys.exit(0)
+
     # Queue to pass data from FIFO to service
     queue = multiprocessing.Queue()
 
+    # Start FIFO client process, first so the service can signal it to start and stop profiling
+    fifo_options = client_options(c)
+    fifo_options.update(batch=c['fifo_batch'], fast_path=fast_path, reader_mode=c['fifo_reader_mode'],
+        profile_dir=c['profile_dir'])
+    fifo = multiprocessing.Process(
+        target=FifoClient, 
+        args=(queue, shutdown_flag),
+        kwargs=fifo_options
+    )
+    fifo.start()
+
     # Start service process
+    server_options = service_options(c, fast_path)
+    server_options['client_pid'] = fifo.pid
     server = multiprocessing.Process(
         target=start_server, 
-        args=(
-            queue, 
-            shutdown_flag,
-            c['device_addr'], 
-            c['device_name'], 
-            c['device_uuid'], 
-            c['auto_release'], 
-            c['device_class'], 
-            c['port_control'], 
-            c['port_interrupt']
-        )
+        args=(queue, shutdown_flag, server_options)
     )
     server.start()
 
-    # Start FIFO client process
-    fifo = multiprocessing.Process(
-        target=FifoClient, 
-        args=(
-            queue,
-            shutdown_flag,
-            c['fifo_path'],
-            c['fifo_owner_uid'],
-            c['fifo_owner_gid']
-        )
-    )
-    fifo.start()
-
     def shutdown(sig_num, frame):
         print('[BTKB:start] shut down')
         shutdown_flag.set()
@@ -98,3 +198,11 @@ if __name__ == "__main__":
         fifo.join()
 
     signal.signal(signal.SIGINT, shutdown)
+
+    # SIGUSR1 and SIGUSR2 start and stop profiling in both processes
+    def forward(sig_num, frame):
+        for proc in (server, fifo):
+            kill(proc.pid, sig_num)
+
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
@@ -0,0 +1,266 @@
+#
+# End-to-end latency benchmark, FIFO line to bytes on the host socket
+#
+# Runs BTKbService and FifoClient in their own processes, like start.py,
+# against the stand-ins in tools/fakes.py: a socketpair in place of the
+# L2CAP channels and a private dbus-daemon in place of the system bus.
+# No bluetooth adapter is needed, only dbus-daemon and the python
+# dependencies of the daemon itself.
+#
+# Stages:
+#   fifo   - line written to the fifo => FifoClient.send_line
+#   client - send_line => BTKbDevice.send_string, the line's first report
+#            (parse, scheduling and the dbus or fast path hop)
+#   air    - send_string => first report read on the host end
+#   total  - line written => last report read on the host end
+#
+# Usage: python tools/bench_latency.py [--count 500] [--rate 50] [--engine single]
+#
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import multiprocessing as mp
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import fakes
+
+from client.line_compiler import LineCompiler
+from client.scheduler import monotonic
+
+SCRIPT = [
+    'KEY_DOWN ACT_RELEASE',
+    'KEY_DOWN ACT_RELEASE',
+    'KEY_RIGHT ACT_RELEASE',
+    'KEY_ENTER ACT_RELEASE',
+    'MOD_LEFTCTRL KEY_ESC ACT_RELEASE MOD_RESET',
+    'KEY_UP ACT_RELEASE'
+]
+
+WARMUP_LINE = 'KEY_NONE'
+
+# Timestamps recorded in the service and client processes
+events = None
+
+
+def patch_stages():
+    from server.btkb_server import BTKbDevice
+    from client.fifo_client import FifoClient
+
+    send_string = BTKbDevice.send_string
+    def timed_send_string(self, message, addr=None):
+        events.put(('send', monotonic()))
+        return send_string(self, message, addr)
+    BTKbDevice.send_string = timed_send_string
+
+    send_line = FifoClient.send_line
+    def timed_send_line(self, line, *args):
+        events.put(('read', monotonic()))
+        return send_line(self, line, *args)
+    FifoClient.send_line = timed_send_line
+
+
+def run_server(queue, shutdown_flag, fast_path):
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from server.btkb_server import BTKbService
+
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+    BTKbService(queue, shutdown_flag, fakes.HOST_ADDR, 'btkb-bench', '00001124-0000-1000-8000-00805f9b34fb',
+        fast_path=fast_path)
+    loop.run()
+
+
+# Service and client on one main loop, see client/engine.py
+def run_single(shutdown_flag, fifo_path):
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from server.btkb_server import BTKbService
+    from client.engine import Engine
+
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+    engine = Engine(shutdown_flag, fifo_path)
+    service = BTKbService(engine, shutdown_flag, fakes.HOST_ADDR, 'btkb-bench', '00001124-0000-1000-8000-00805f9b34fb')
+    engine.attach(service, loop)
+    loop.run()
+
+
+def run_client(queue, shutdown_flag, fifo_path, batch, fast_path, reader_mode):
+    from client.fifo_client import FifoClient
+    FifoClient(queue, shutdown_flag, fifo_path, batch=batch, fast_path=fast_path, reader_mode=reader_mode)
+
+
+# Reads reports off the host end of the interrupt channel
+class Host(threading.Thread):
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.received = []
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(64)
+            except socket.error:
+                return
+            if not data:
+                return
+            self.received.append(monotonic())
+
+    def wait_quiet(self, quiet=0.3, timeout=10):
+        end = monotonic() + timeout
+        count = -1
+        while monotonic() < end and count != len(self.received):
+            count = len(self.received)
+            time.sleep(quiet)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def drain(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get(True, 0.05))
+        except Exception:
+            return items
+
+
+# Reports each line produces, in order
+def expected_reports(lines):
+    compiler = LineCompiler()
+    modifier_byte = 0x00
+    counts = []
+    for line in lines:
+        program = compiler.compile(line, modifier_byte)
+        modifier_byte = program.modifier_byte
+        counts.append(sum([len(reports) for _, reports in program.segments]))
+    return counts
+
+
+def main():
+    global events
+
+    parser = argparse.ArgumentParser(description='End-to-end FIFO to socket latency benchmark')
+    parser.add_argument('--count', type=int, default=500, help='lines to send')
+    parser.add_argument('--rate', type=float, default=50, help='lines per second, 0 for as fast as possible')
+    parser.add_argument('--reader-mode', default='select', choices=['select', 'process'])
+    parser.add_argument('--no-batch', action='store_true', help='send reports one dbus call at a time')
+    parser.add_argument('--fast-path', action='store_true', help='use the unix socket fast path')
+    parser.add_argument('--engine', default='processes', choices=['processes', 'single'],
+        help='service and client in their own processes, or on one main loop')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='btkb-bench-')
+    fifo_path = os.path.join(tmp, 'btkb.fifo')
+    fast_path = os.path.join(tmp, 'btkb.sock') if args.fast_path else None
+
+    bus = fakes.install()
+    events = mp.Queue()
+    patch_stages()
+
+    host_control, host_interrupt = fakes.connect_host()
+    host = Host(host_interrupt)
+    host.start()
+
+    queue = mp.Queue()
+    shutdown_flag = mp.Event()
+    if args.engine == 'single':
+        server = mp.Process(target=run_single, args=(shutdown_flag, fifo_path))
+        procs = [server]
+    else:
+        server = mp.Process(target=run_server, args=(queue, shutdown_flag, fast_path))
+        client = mp.Process(target=run_client,
+            args=(queue, shutdown_flag, fifo_path, not args.no_batch, fast_path, args.reader_mode))
+        procs = [server, client]
+    for proc in procs:
+        proc.start()
+
+    try:
+        while not os.path.exists(fifo_path):
+            time.sleep(0.05)
+        fifo = open(fifo_path, 'w')
+
+        # The client flushes the fifo once connected, keep poking it
+        # until reports come out the other end
+        print('[BTKB:BENCH] Waiting for the client')
+        while len(host.received) == 0:
+            fifo.write(WARMUP_LINE + '\n')
+            fifo.flush()
+            time.sleep(0.1)
+        host.wait_quiet()
+        drain(events)
+        del host.received[:]
+
+        lines = [SCRIPT[i % len(SCRIPT)] for i in range(args.count)]
+        counts = expected_reports(lines)
+        written = []
+
+        print('[BTKB:BENCH] Sending %d lines' % len(lines))
+        start = monotonic()
+        for i, line in enumerate(lines):
+            if args.rate > 0:
+                delay = start + i / args.rate - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            written.append(monotonic())
+            fifo.write(line + '\n')
+            fifo.flush()
+
+        host.wait_quiet()
+        elapsed = host.received[-1] - start if host.received else float('nan')
+        recorded = drain(events)
+    finally:
+        shutdown_flag.set()
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+        bus.terminate()
+
+    reads = [t for stage, t in recorded if stage == 'read']
+    sends = [t for stage, t in recorded if stage == 'send']
+    received = host.received
+
+    if len(received) != sum(counts):
+        print('[BTKB:BENCH] Expected %d reports, host got %d' % (sum(counts), len(received)))
+
+    stages = {'fifo': [], 'client': [], 'air': [], 'total': []}
+    first = 0
+    for i, count in enumerate(counts):
+        last = first + count - 1
+        if i < len(reads):
+            stages['fifo'].append(reads[i] - written[i])
+            if first < len(sends):
+                stages['client'].append(sends[first] - reads[i])
+        if first < len(sends) and first < len(received):
+            stages['air'].append(received[first] - sends[first])
+        if last < len(received):
+            stages['total'].append(received[last] - written[i])
+        first = last + 1
+
+    print('')
+    print('%-8s %8s %10s %10s %10s %10s' % ('stage', 'samples', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for stage in ('fifo', 'client', 'air', 'total'):
+        values = stages[stage]
+        print('%-8s %8d %10.3f %10.3f %10.3f %10.3f' % (stage, len(values),
+            percentile(values, 50) * 1000, percentile(values, 95) * 1000,
+            percentile(values, 99) * 1000, (max(values) if values else float('nan')) * 1000))
+
+    print('')
+    print('throughput: %.1f lines/s, %.1f reports/s' % (len(lines) / elapsed, len(received) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
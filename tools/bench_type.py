@@ -0,0 +1,84 @@
+#
+# Benchmark for ACT_TYPE text encoding
+#
+# Reports how fast text is encoded, how many reports it takes compared to
+# a press/release pair per character, and the chars per second that gives
+# on the air for a given time per report.
+#
+# Usage: python tools/bench_type.py [--report-ms 7.5] [--text "..."]
+#
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.text_encoder import encode_text, charmap
+
+SAMPLES = [
+    'the office',
+    'Stranger Things',
+    'correct horse battery staple',
+    'P@ssw0rd!2023',
+    'aaaa bbbb cccc',
+    'abcdefghijklmnopqrstuvwxyz0123456789'
+]
+
+
+# Press and release per character, plus a release for every shift change
+def naive_report_count(text):
+    count = 0
+    shift = False
+    for c in text:
+        if c not in charmap:
+            continue
+        shifted = charmap[c][1]
+        if shifted != shift:
+            count += 1
+            shift = shifted
+        count += 2
+    return count
+
+
+def bench(text, report_ms, number):
+    seconds = timeit.timeit(lambda: encode_text(text), number=number)
+    reports = len(encode_text(text))
+    naive = naive_report_count(text)
+
+    return {
+        'text': text,
+        'chars': len(text),
+        'encode_cps': len(text) * number / seconds,
+        'reports': reports,
+        'naive_reports': naive,
+        'air_cps': len(text) / (reports * report_ms / 1000.0),
+        'naive_air_cps': len(text) / (naive * report_ms / 1000.0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ACT_TYPE encoding')
+    parser.add_argument('--report-ms', type=float, default=7.5,
+        help='time to get one report to the host, in milliseconds')
+    parser.add_argument('--number', type=int, default=2000,
+        help='encodes per sample')
+    parser.add_argument('--text', action='append',
+        help='text to benchmark, can be repeated')
+    args = parser.parse_args()
+
+    print('%-38s %6s %12s %8s %8s %9s %9s' % (
+        'text', 'chars', 'encode c/s', 'reports', 'naive', 'air c/s', 'naive c/s'))
+
+    for text in args.text or SAMPLES:
+        r = bench(text, args.report_ms, args.number)
+        print('%-38s %6d %12.0f %8d %8d %9.1f %9.1f' % (
+            r['text'][:38], r['chars'], r['encode_cps'], r['reports'],
+            r['naive_reports'], r['air_cps'], r['naive_air_cps']))
+
+
+if __name__ == '__main__':
+    main()
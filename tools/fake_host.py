@@ -0,0 +1,157 @@
+#
+# Fake HID host, decodes what BTKbDevice sends and checks it
+#
+# Sits on the host end of the interrupt channel (a socketpair from
+# tools/fakes.py), rebuilds the key state a real host would see from
+# every report and records anything a host would choke on:
+#   - reports that aren't input reports, or have an unknown report ID
+#   - keyboard reports with more than 6 keys, a key twice, a modifier
+#     key in a key slot instead of its modifier bit, a reserved byte
+#     that isn't 0, or ErrorRollOver mixed with keys
+#   - consumer reports of the wrong size or with padding bits set
+#   - keys, modifiers or consumer keys still down once input has stopped
+#     (check_idle), the stuck keys a user would notice
+#
+# ErrorRollOver leaves the state as it was, like a host does.
+#
+
+from __future__ import absolute_import, print_function
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client.scheduler import monotonic
+
+DATA_INPUT = 0xA1
+KEYBOARD_ID = 0x01
+CONSUMER_ID = 0x03
+ERROR_ROLLOVER = 0x01
+SLOTS = 6
+CONSUMER_BITS = 13
+
+
+def is_modifier_key(code):
+    return 0xe0 <= code <= 0xe7
+
+
+class HidHost():
+    # max_violations - most violations kept, the count goes on
+    def __init__(self, max_violations=100):
+        self.keys = set()
+        self.modifiers = 0x00
+        self.consumer = 0
+
+        self.reports = 0
+        self.rollovers = 0
+        self.violation_count = 0
+        self.violations = []
+        self.max_violations = max_violations
+
+    def violation(self, text):
+        self.violation_count += 1
+        if len(self.violations) < self.max_violations:
+            self.violations.append('report %d: %s' % (self.reports, text))
+
+    # Decode one report as it came off the interrupt channel
+    def receive(self, data):
+        data = bytearray(data)
+        self.reports += 1
+        if len(data) < 2 or data[0] != DATA_INPUT:
+            self.violation('not an input report: %s' % hex_of(data))
+            return
+
+        if data[1] == KEYBOARD_ID:
+            self.keyboard(data[2:])
+        elif data[1] == CONSUMER_ID:
+            self.consumer_report(data[2:])
+        else:
+            self.violation('unknown report ID 0x%02x' % data[1])
+
+    # modifiers, reserved, keys - the reserved byte and keys can be left off
+    def keyboard(self, payload):
+        if len(payload) == 0:
+            self.violation('empty keyboard report')
+            return
+        if len(payload) > 1 and payload[1] != 0:
+            self.violation('reserved byte is 0x%02x' % payload[1])
+
+        slots = [code for code in payload[2:] if code != 0]
+        if len(payload) > 2 + SLOTS or len(slots) > SLOTS:
+            self.violation('%d keys in one report' % len(slots))
+            return
+
+        if ERROR_ROLLOVER in slots:
+            if any(code != ERROR_ROLLOVER for code in slots):
+                self.violation('ErrorRollOver mixed with keys')
+            self.rollovers += 1
+            self.modifiers = payload[0]
+            return
+
+        if len(set(slots)) != len(slots):
+            self.violation('key reported twice: %s' % hex_of(slots))
+        for code in slots:
+            if is_modifier_key(code):
+                self.violation('modifier key 0x%02x in a key slot' % code)
+
+        self.modifiers = payload[0]
+        self.keys = set(slots)
+
+    def consumer_report(self, payload):
+        if len(payload) != 3:
+            self.violation('consumer report of %d bytes' % len(payload))
+            return
+        bits = payload[0] | (payload[1] << 8) | (payload[2] << 16)
+        if bits >> CONSUMER_BITS:
+            self.violation('consumer padding bits set: 0x%06x' % bits)
+        self.consumer = bits & ((1 << CONSUMER_BITS) - 1)
+
+    # Once input has stopped, nothing should be held
+    def check_idle(self):
+        stuck = []
+        if self.keys:
+            stuck.append('keys %s' % hex_of(sorted(self.keys)))
+        if self.modifiers:
+            stuck.append('modifiers 0x%02x' % self.modifiers)
+        if self.consumer:
+            stuck.append('consumer keys 0x%04x' % self.consumer)
+        if stuck:
+            self.violation('still held once idle: ' + ', '.join(stuck))
+        return not stuck
+
+
+def hex_of(values):
+    return ' '.join(['%02x' % v for v in bytearray(values)])
+
+
+# Reads reports off a socket into a HidHost
+class HostThread(threading.Thread):
+    def __init__(self, sock, host=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.host = host if host is not None else HidHost()
+        self.last_received = 0
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(64)
+            except socket.error:
+                return
+            if not data:
+                return
+            self.host.receive(data)
+            self.last_received = monotonic()
+
+    # Wait until nothing has come in for quiet seconds
+    def wait_quiet(self, quiet=0.5, timeout=30):
+        end = monotonic() + timeout
+        count = -1
+        while monotonic() < end and count != self.host.reports:
+            count = self.host.reports
+            time.sleep(quiet)
@@ -0,0 +1,118 @@
+#
+# Stand-in for lircd, for trying the LIRC input without a receiver
+#
+# Listens on a unix socket like lircd's and writes button events to every
+# client in lircd's format, "<code> <repeat> <button> <remote>".
+# Each line typed on stdin is a button press:
+#
+#   KEY_UP            - one press
+#   KEY_DOWN 5        - a press followed by 5 repeats, as if held
+#   KEY_OK 0 firetv   - a press from a remote named firetv
+#
+# Repeats are sent REPEAT_INTERVAL apart, about what a NEC remote does.
+# FakeLircd can also be driven from python, see press().
+#
+# Usage: python tools/fake_lircd.py [--socket /tmp/lircd]
+#
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+
+REPEAT_INTERVAL = 0.108
+
+
+class FakeLircd():
+    def __init__(self, path='/tmp/lircd'):
+        self.path = path
+        self.clients = []
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+
+        self.thread = threading.Thread(target=self.accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            with self.lock:
+                self.clients.append(conn)
+
+    # Wait for a client to connect, returns False on timeout
+    def wait_client(self, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if self.clients:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def send(self, line):
+        data = (line + '\n').encode('utf-8')
+        with self.lock:
+            for conn in list(self.clients):
+                try:
+                    conn.sendall(data)
+                except socket.error:
+                    conn.close()
+                    self.clients.remove(conn)
+
+    def event(self, button, repeat=0, remote='fake'):
+        self.send('%016x %02x %s %s' % (zlib.crc32(button.encode('utf-8')) & 0xffffffff, repeat, button, remote))
+
+    # A press and its repeats, blocks until the last one is sent
+    def press(self, button, repeats=0, remote='fake', interval=REPEAT_INTERVAL):
+        for repeat in range(repeats + 1):
+            if repeat > 0:
+                time.sleep(interval)
+            self.event(button, repeat, remote)
+
+    def close(self):
+        self.sock.close()
+        with self.lock:
+            for conn in self.clients:
+                conn.close()
+            self.clients = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake lircd, one button press per line of stdin')
+    parser.add_argument('--socket', default='/tmp/lircd')
+    args = parser.parse_args()
+
+    lircd = FakeLircd(args.socket)
+    print("Listening on", args.socket, "- type <button> [repeats] [remote]")
+    try:
+        for line in iter(sys.stdin.readline, ''):
+            parts = line.split()
+            if not parts:
+                continue
+            repeats = int(parts[1]) if len(parts) > 1 else 0
+            remote = parts[2] if len(parts) > 2 else 'fake'
+            lircd.press(parts[0], repeats, remote)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lircd.close()
+
+
+if __name__ == '__main__':
+    main()
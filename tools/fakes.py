@@ -0,0 +1,110 @@
+#
+# Stand-ins for running the service and FifoClient on a plain Linux box
+#
+# - a fake `bluetooth` module whose L2CAP sockets hand out one end of a
+#   socketpair, the other end plays the host
+# - a private dbus-daemon in place of the system bus
+# - no-op adapter and bluez profile setup
+#
+# install() must be called before server.btkb_server is imported.
+#
+
+from __future__ import absolute_import, print_function
+
+import errno
+import os
+import socket
+import subprocess
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST_ADDR = '00:00:00:00:00:01'
+
+
+# L2CAP socket that accepts pre-made socketpair ends, keyed by port
+# A listening socket's fileno turns readable while connections are pending,
+# outbound connects are always refused
+class FakeBluetoothSocket():
+    pending = {}
+
+    def __init__(self, proto=None):
+        self.port = None
+        self.bell = None
+
+    def bind(self, addr):
+        self.port = int(addr[1])
+
+    def listen(self, backlog):
+        self.bell, ring = socket.socketpair()
+        ring.send(b'x' * len(FakeBluetoothSocket.pending.get(self.port, [])))
+        self.ring = ring
+
+    def fileno(self):
+        return self.bell.fileno()
+
+    def setblocking(self, flag):
+        pass
+
+    def accept(self):
+        if not FakeBluetoothSocket.pending.get(self.port):
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        self.bell.recv(1)
+        return FakeBluetoothSocket.pending[self.port].pop(0), (HOST_ADDR, self.port)
+
+    def connect(self, addr):
+        raise socket.error(errno.ECONNREFUSED, os.strerror(errno.ECONNREFUSED))
+
+    def close(self):
+        if self.bell is not None:
+            self.bell.close()
+            self.ring.close()
+            self.bell = None
+
+
+def make_bluetooth_module():
+    module = types.ModuleType('bluetooth')
+    module.BluetoothSocket = FakeBluetoothSocket
+    module.L2CAP = 0
+    module.__all__ = ['BluetoothSocket', 'L2CAP']
+    return module
+
+
+# Queue up a connection from the host on the control and interrupt ports,
+# returns the host's (control, interrupt) sockets
+def connect_host(p_control=17, p_interrupt=19):
+    host = []
+    for port in (p_control, p_interrupt):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        FakeBluetoothSocket.pending.setdefault(port, []).append(ours)
+        host.append(theirs)
+    return tuple(host)
+
+
+# Start a dbus-daemon of our own, returns (process, address)
+def start_private_bus():
+    proc = subprocess.Popen(
+        ['dbus-daemon', '--session', '--nofork', '--print-address'],
+        stdout=subprocess.PIPE)
+    address = proc.stdout.readline().strip()
+    if not isinstance(address, str):
+        address = address.decode('utf-8')
+    return proc, address
+
+
+# Swap in the fakes, returns the private bus process to stop when done
+def install():
+    sys.modules['bluetooth'] = make_bluetooth_module()
+
+    import dbus
+    import dbus.bus
+
+    proc, address = start_private_bus()
+    dbus.SystemBus = lambda: dbus.bus.BusConnection(address)
+
+    from server.btkb_server import BTKbDevice
+    BTKbDevice.init_bt_device = lambda self: self.setup_done('adapter')
+    BTKbDevice.init_bluez_profile = lambda self: None
+
+    return proc
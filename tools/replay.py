@@ -0,0 +1,326 @@
+#
+# Replay a trace and diff the reports against the recorded ones
+#
+# Takes a trace written with TraceFile set (see client/tracefile.py) and
+# feeds its inputs back in with their original spacing, divided by
+# --speed (0 sends them as fast as possible):
+#   - lines are written to the fifo
+#   - dbus calls from callers other than the fifo client are made again
+#
+# By default the daemon runs against the stand-ins in tools/fakes.py, like
+# tools/bench_latency.py, and the reports are read off the fake host's end
+# of the interrupt channel. The fake has a single host, so HOST_ tokens
+# and dbus host arguments are dropped and the recorded reports of one host
+# (--host, or the one that got the most) are compared.
+#
+# With --live the trace is fed to a running daemon instead, one with its
+# own TraceFile (--trace-out), and the reports it records are compared.
+#
+# The reports are compared as a diff of their hex, then the timing of the
+# reports both streams have in common, relative to the first report.
+#
+# Usage: python tools/replay.py trace [--speed 4] [--engine single]
+#        python tools/replay.py trace --live --trace-out /var/log/btkb.trace
+#
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import difflib
+import multiprocessing as mp
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import fakes
+
+from client.scheduler import monotonic
+from client.tracefile import LINE, DBUS, CLIENT, REPORT, read_trace, from_hex, to_hex
+
+WARMUP_LINE = 'KEY_NONE'
+
+# Argument types of the dbus methods a trace can have calls to,
+# the *_to methods take a host first
+ARG_TYPES = {
+    'send_bytes': ('ay',),
+    'send_bytes_to': ('s', 'ay'),
+    'send_reports': ('aay', 'ad'),
+    'send_reports_to': ('s', 'aay', 'ad'),
+    'type_text': ('s',),
+    'type_text_to': ('s', 's'),
+    'release_keys': (),
+    'release_keys_to': ('s',),
+    'send_consumer': ('as', 'b'),
+    'send_consumer_to': ('s', 'as', 'b'),
+    'send_keys': ('y', 'ay', 'b'),
+    'send_keys_to': ('s', 'y', 'ay', 'b'),
+    'typematic_key': ('y', 's'),
+    'typematic_key_to': ('s', 'y', 's')
+}
+
+
+# (inputs, {host: [(t, report hex)]}) of a trace
+# Inputs are (t, LINE, line) and (t, DBUS, method, args), calls from the
+# fifo client are left out, its lines are in the trace already
+def load(path):
+    events = list(read_trace(path))
+    clients = set([event[2] for event in events if event[1] == CLIENT])
+
+    inputs = []
+    reports = {}
+    for event in events:
+        t, kind = event[0], event[1]
+        if kind == LINE:
+            inputs.append((t, LINE, event[2]))
+        elif kind == DBUS and event[2] not in clients:
+            inputs.append((t, DBUS, event[3], event[4]))
+        elif kind == REPORT:
+            reports.setdefault(event[2], []).append((t, event[3]))
+    return inputs, reports
+
+
+# A line with its HOST_ token taken out, for a daemon with one host
+def untargeted(line):
+    return ' '.join([k for k in line.split(' ') if not k.startswith('HOST_')])
+
+
+# Arguments of a traced dbus call in the form the method takes, hex back to bytes
+def call_args(method, args, single_host):
+    out = []
+    for i, (kind, arg) in enumerate(zip(ARG_TYPES[method], args)):
+        if kind == 'ay':
+            arg = bytearray(from_hex(arg))
+        elif kind == 'aay':
+            arg = [bytearray(from_hex(a)) for a in arg]
+        elif i == 0 and single_host and method.endswith('_to'):
+            arg = ''
+        out.append(arg)
+    return out
+
+
+# Writes the trace's inputs with their spacing divided by speed
+def feed(inputs, fifo, interface, speed, single_host):
+    if not inputs:
+        return
+    t0 = inputs[0][0]
+    start = monotonic()
+    for event in inputs:
+        if speed > 0:
+            delay = start + (event[0] - t0) / speed - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if event[1] == LINE:
+            fifo.write((untargeted(event[2]) if single_host else event[2]) + '\n')
+            fifo.flush()
+        elif interface is not None and event[2] in ARG_TYPES:
+            method, args = event[2], event[3]
+            try:
+                getattr(interface, method)(*call_args(method, args, single_host))
+            except Exception as e:
+                print('[BTKB:REPLAY] %s failed: %s' % (method, e))
+
+
+# Reads reports off the fake host's end of the interrupt channel
+class Host(threading.Thread):
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.received = []
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(64)
+            except socket.error:
+                return
+            if not data:
+                return
+            self.received.append((monotonic(), to_hex(data)))
+
+    def wait_quiet(self, quiet=0.5, timeout=30):
+        end = monotonic() + timeout
+        count = -1
+        while monotonic() < end and count != len(self.received):
+            count = len(self.received)
+            time.sleep(quiet)
+
+
+def run_server(queue, shutdown_flag):
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from server.btkb_server import BTKbService
+
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+    BTKbService(queue, shutdown_flag, fakes.HOST_ADDR, 'btkb-replay', '00001124-0000-1000-8000-00805f9b34fb')
+    loop.run()
+
+
+def run_single(shutdown_flag, fifo_path):
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from server.btkb_server import BTKbService
+    from client.engine import Engine
+
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+    engine = Engine(shutdown_flag, fifo_path)
+    service = BTKbService(engine, shutdown_flag, fakes.HOST_ADDR, 'btkb-replay', '00001124-0000-1000-8000-00805f9b34fb')
+    engine.attach(service, loop)
+    loop.run()
+
+
+def run_client(queue, shutdown_flag, fifo_path):
+    from client.fifo_client import FifoClient
+    FifoClient(queue, shutdown_flag, fifo_path, reader_mode='select')
+
+
+def interface_for(bus):
+    import dbus
+    return dbus.Interface(bus.get_object('org.max.btkb', '/org/max/btkb'), 'org.max.btkb')
+
+
+# Replay against the fakes, returns the [(t, report hex)] the host got
+def replay_fake(inputs, speed, engine):
+    import dbus
+
+    tmp = tempfile.mkdtemp(prefix='btkb-replay-')
+    fifo_path = os.path.join(tmp, 'btkb.fifo')
+
+    bus = fakes.install()
+    host_control, host_interrupt = fakes.connect_host()
+    host = Host(host_interrupt)
+    host.start()
+
+    queue = mp.Queue()
+    shutdown_flag = mp.Event()
+    if engine == 'single':
+        procs = [mp.Process(target=run_single, args=(shutdown_flag, fifo_path))]
+    else:
+        procs = [mp.Process(target=run_server, args=(queue, shutdown_flag)),
+            mp.Process(target=run_client, args=(queue, shutdown_flag, fifo_path))]
+    for proc in procs:
+        proc.start()
+
+    try:
+        while not os.path.exists(fifo_path):
+            time.sleep(0.05)
+        fifo = open(fifo_path, 'w')
+
+        # The client flushes the fifo once connected, keep poking it
+        # until reports come out the other end
+        print('[BTKB:REPLAY] Waiting for the client')
+        while len(host.received) == 0:
+            fifo.write(WARMUP_LINE + '\n')
+            fifo.flush()
+            time.sleep(0.1)
+        host.wait_quiet()
+        del host.received[:]
+
+        print('[BTKB:REPLAY] Replaying %d inputs' % len(inputs))
+        feed(inputs, fifo, interface_for(dbus.SystemBus()), speed, True)
+        host.wait_quiet()
+        return list(host.received)
+    finally:
+        shutdown_flag.set()
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+        bus.terminate()
+
+
+# Replay against a running daemon, returns the reports it traced to trace_out
+def replay_live(inputs, speed, fifo_path, trace_out, host):
+    import dbus
+
+    offset = os.path.getsize(trace_out) if os.path.exists(trace_out) else 0
+    with open(fifo_path, 'w') as fifo:
+        print('[BTKB:REPLAY] Replaying %d inputs' % len(inputs))
+        feed(inputs, fifo, interface_for(dbus.SystemBus()), speed, False)
+
+    # Wait for the daemon to stop sending
+    count = -1
+    events = []
+    while True:
+        time.sleep(0.5)
+        events = [e for e in read_trace(trace_out, offset) if e[1] == REPORT and (host is None or e[2] == host)]
+        if len(events) == count:
+            break
+        count = len(events)
+    return [(e[0], e[3]) for e in events]
+
+
+# Print the difference between two report streams, returns True if they match
+def compare(recorded, replayed, speed, tolerance):
+    expected = [report for _, report in recorded]
+    got = [report for _, report in replayed]
+
+    diff = list(difflib.unified_diff(expected, got, 'recorded', 'replayed', lineterm=''))
+    for line in diff:
+        print(line)
+    print('[BTKB:REPLAY] %d reports recorded, %d replayed, %s' % (len(expected), len(got),
+        'same content' if not diff else 'content differs'))
+
+    # Timing of the reports both have, relative to the first report of each,
+    # recorded times are divided by the speed they were replayed at
+    late = []
+    if recorded and replayed:
+        r0, p0 = recorded[0][0], replayed[0][0]
+        scale = speed if speed > 0 else None
+        matcher = difflib.SequenceMatcher(None, expected, got, autojunk=False)
+        for a, b, size in matcher.get_matching_blocks():
+            for i in range(size):
+                if scale is None:
+                    continue
+                want = (recorded[a + i][0] - r0) / scale
+                took = replayed[b + i][0] - p0
+                late.append((took - want, a + i))
+
+    if late:
+        deviations = sorted([abs(d) for d, _ in late])
+        print('[BTKB:REPLAY] Timing deviation over %d reports: p50 %.3f ms, p95 %.3f ms, max %.3f ms' % (
+            len(deviations), deviations[len(deviations) // 2] * 1000,
+            deviations[min(len(deviations) - 1, int(len(deviations) * 0.95))] * 1000, deviations[-1] * 1000))
+        over = [(d, i) for d, i in late if abs(d) > tolerance]
+        for d, i in over[:10]:
+            print('[BTKB:REPLAY]   report %d (%s) %+.3f ms' % (i, expected[i], d * 1000))
+        if len(over) > 10:
+            print('[BTKB:REPLAY]   ... and %d more over %.1f ms' % (len(over) - 10, tolerance * 1000))
+    return not diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a btkb trace and diff the reports')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, default=1, help='times the recorded speed, 0 for as fast as possible')
+    parser.add_argument('--host', default=None, help='recorded host to compare against')
+    parser.add_argument('--tolerance', type=float, default=5, help='ms a report can be off before it is listed')
+    parser.add_argument('--engine', default='processes', choices=['processes', 'single'])
+    parser.add_argument('--live', action='store_true', help='replay into a running daemon')
+    parser.add_argument('--fifo', default='/tmp/btkb.fifo', help='fifo of the running daemon')
+    parser.add_argument('--trace-out', default=None, help='TraceFile of the running daemon')
+    args = parser.parse_args()
+
+    inputs, reports = load(args.trace)
+    host = args.host.upper() if args.host else None
+    if host is None and reports:
+        host = max(reports.keys(), key=lambda h: len(reports[h]))
+    recorded = reports.get(host, [])
+    print('[BTKB:REPLAY] %d inputs, %d reports to %s' % (len(inputs), len(recorded), host))
+
+    if args.live:
+        if args.trace_out is None:
+            sys.exit('--live needs the daemon\'s TraceFile as --trace-out')
+        replayed = replay_live(inputs, args.speed, args.fifo, args.trace_out, host)
+    else:
+        replayed = replay_fake(inputs, args.speed, args.engine)
+
+    sys.exit(0 if compare(recorded, replayed, args.speed, args.tolerance / 1000.0) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#
+# Soak test, thousands of lines a second through FifoClient
+#
+# Runs the daemon against the stand-ins in tools/fakes.py, like
+# tools/bench_latency.py, with the fake HID host of tools/fake_host.py on
+# the host end of the interrupt channel. For --duration seconds a seeded
+# random mix of lines is written to the fifo at --rate lines a second:
+# taps, chords, DOWN_/UP_ pairs, consumer keys, sticky modifiers, typing,
+# rollover runs of more than 6 keys, and keys held on one line and let go
+# by an ACT_RELEASE on the next. Every line, or pair of lines, leaves the
+# keyboard released, so once input stops the host must see nothing held.
+#
+# Every --interval seconds a row is printed with the RSS of each process
+# and the depth of the service's report queue, the client's backlog and
+# its scheduler. At the end the host's violations are listed along with
+# the RSS growth of each process, the exit status is 1 if there were any.
+#
+# Usage: python tools/soak.py [--rate 2000] [--duration 60] [--engine single]
+#
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import multiprocessing as mp
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fakes
+
+from client.scheduler import monotonic
+from fake_host import HidHost, HostThread
+
+WARMUP_LINE = 'KEY_NONE'
+
+KEYS = ['KEY_A', 'KEY_B', 'KEY_C', 'KEY_D', 'KEY_E', 'KEY_F', 'KEY_G', 'KEY_H',
+    'KEY_1', 'KEY_2', 'KEY_3', 'KEY_UP', 'KEY_DOWN', 'KEY_LEFT', 'KEY_RIGHT',
+    'KEY_ENTER', 'KEY_ESC', 'KEY_TAB', 'KEY_SPACE', 'KEY_BACKSPACE']
+MODIFIERS = ['MOD_LEFTCTRL', 'MOD_LEFTSHIFT', 'MOD_LEFTALT', 'MOD_RIGHTSHIFT']
+CONSUMER = ['CC_VOLUMEUP', 'CC_VOLUMEDOWN', 'CC_MUTE', 'CC_PLAYPAUSE', 'CC_HOME']
+WORDS = ['soak', 'btkb', 'hello', 'test 123']
+
+# Values sampled from get_stats, (column, stats name)
+QUEUES = [
+    ('queue', 'server.queue_depth'),
+    ('backlog', 'client.backlog_depth'),
+    ('sched', 'client.scheduler_pending')
+]
+
+
+# Random lines that leave nothing held
+def random_lines(rng):
+    kind = rng.randint(0, 8)
+    if kind == 7:
+        return ['%s ACT_HOLD_0.001' % rng.choice(CONSUMER), 'ACT_RELEASE']
+    if kind == 8:
+        return ['DOWN_' + rng.choice(KEYS), 'ACT_RELEASE']
+    return [random_line(rng, kind)]
+
+
+def random_line(rng, kind):
+    if kind == 0:
+        return rng.choice(KEYS) + ' ACT_RELEASE'
+    if kind == 1:
+        return ' '.join(rng.sample(KEYS, 2)) + ' ACT_RELEASE'
+    if kind == 2:
+        keys = rng.sample(KEYS, rng.randint(1, 3))
+        return ' '.join(['DOWN_' + k for k in keys] + ['UP_' + k for k in reversed(keys)])
+    if kind == 3:
+        return rng.choice(CONSUMER) + ' ACT_RELEASE'
+    if kind == 4:
+        return '%s %s ACT_RELEASE MOD_RESET' % (rng.choice(MODIFIERS), rng.choice(KEYS))
+    if kind == 5:
+        return 'ACT_TYPE ' + rng.choice(WORDS)
+    return ' '.join(['DOWN_' + k for k in rng.sample(KEYS, rng.randint(7, 9))]) + ' ACT_RELEASE'
+
+
+def run_server(queue, shutdown_flag):
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from server.btkb_server import BTKbService
+
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+    BTKbService(queue, shutdown_flag, fakes.HOST_ADDR, 'btkb-soak', '00001124-0000-1000-8000-00805f9b34fb',
+        stats=True, stats_interval=1)
+    loop.run()
+
+
+def run_single(shutdown_flag, fifo_path):
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from server.btkb_server import BTKbService
+    from client.engine import Engine
+
+    DBusGMainLoop(set_as_default=True)
+    loop = GLib.MainLoop()
+    engine = Engine(shutdown_flag, fifo_path, stats=True, stats_interval=1)
+    service = BTKbService(engine, shutdown_flag, fakes.HOST_ADDR, 'btkb-soak', '00001124-0000-1000-8000-00805f9b34fb',
+        stats=True, stats_interval=1)
+    engine.attach(service, loop)
+    loop.run()
+
+
+def run_client(queue, shutdown_flag, fifo_path):
+    from client.fifo_client import FifoClient
+    FifoClient(queue, shutdown_flag, fifo_path, reader_mode='select', stats=True, stats_interval=1)
+
+
+# Resident set size of a process in kB, None once it is gone
+def rss_kb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def queue_values(interface):
+    try:
+        values = interface.get_stats().get('values', {})
+    except Exception:
+        return [None] * len(QUEUES)
+    return [values.get(name) for _, name in QUEUES]
+
+
+def print_row(cells):
+    print('[BTKB:SOAK] ' + ' '.join(['%10s' % cell for cell in cells]))
+
+
+def cell(value):
+    return '-' if value is None else '%d' % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak the daemon against a fake HID host')
+    parser.add_argument('--rate', type=float, default=2000, help='lines a second')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to write lines for')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between samples')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--engine', default='processes', choices=['processes', 'single'])
+    args = parser.parse_args()
+
+    import dbus
+
+    tmp = tempfile.mkdtemp(prefix='btkb-soak-')
+    fifo_path = os.path.join(tmp, 'btkb.fifo')
+
+    bus = fakes.install()
+    host_control, host_interrupt = fakes.connect_host()
+    host = HostThread(host_interrupt)
+    host.start()
+
+    queue = mp.Queue()
+    shutdown_flag = mp.Event()
+    if args.engine == 'single':
+        procs = [('engine', mp.Process(target=run_single, args=(shutdown_flag, fifo_path)))]
+    else:
+        procs = [('server', mp.Process(target=run_server, args=(queue, shutdown_flag))),
+            ('client', mp.Process(target=run_client, args=(queue, shutdown_flag, fifo_path)))]
+    for _, proc in procs:
+        proc.start()
+
+    rng = random.Random(args.seed)
+    samples = []
+    try:
+        while not os.path.exists(fifo_path):
+            time.sleep(0.05)
+        fifo = open(fifo_path, 'w')
+
+        # The client flushes the fifo once connected, keep poking it
+        # until reports come out the other end
+        print('[BTKB:SOAK] Waiting for the client')
+        while host.host.reports == 0:
+            fifo.write(WARMUP_LINE + '\n')
+            fifo.flush()
+            time.sleep(0.1)
+        host.wait_quiet()
+        host.host = HidHost()
+
+        interface = dbus.Interface(dbus.SystemBus().get_object('org.max.btkb', '/org/max/btkb'), 'org.max.btkb')
+
+        print('[BTKB:SOAK] %g lines/s for %gs' % (args.rate, args.duration))
+        print_row(['time', 'lines', 'reports'] + ['%s kB' % name for name, _ in procs] +
+            [column for column, _ in QUEUES])
+
+        # Lines are written in batches every 10ms, to keep up with the rate
+        # without a syscall per line
+        start = monotonic()
+        end = start + args.duration
+        next_sample = start
+        written = 0
+        while True:
+            now = monotonic()
+            if now >= next_sample or now >= end:
+                sample = (now - start, [rss_kb(proc.pid) for _, proc in procs], queue_values(interface))
+                samples.append(sample)
+                print_row(['%.1f' % sample[0], written, host.host.reports] +
+                    [cell(v) for v in sample[1]] + [cell(v) for v in sample[2]])
+                next_sample += args.interval
+            if now >= end:
+                break
+
+            due = int((now - start) * args.rate) - written
+            if due > 0:
+                lines = []
+                while len(lines) < due:
+                    lines.extend(random_lines(rng))
+                fifo.write(''.join([line + '\n' for line in lines]))
+                fifo.flush()
+                written += len(lines)
+            time.sleep(0.01)
+
+        print('[BTKB:SOAK] Wrote %d lines, waiting for the reports to stop' % written)
+        host.wait_quiet(1.0, 120)
+        host.host.check_idle()
+    finally:
+        shutdown_flag.set()
+        for _, proc in procs:
+            proc.terminate()
+            proc.join()
+        bus.terminate()
+
+    result = host.host
+    print('[BTKB:SOAK] %d reports, %d rollovers, %d violations' % (result.reports, result.rollovers, result.violation_count))
+    for violation in result.violations:
+        print('[BTKB:SOAK]   ' + violation)
+
+    # RSS growth from the first sample to the last
+    if len(samples) > 1:
+        first, last = samples[0], samples[-1]
+        minutes = (last[0] - first[0]) / 60.0
+        for i, (name, _) in enumerate(procs):
+            if first[1][i] is not None and last[1][i] is not None and minutes > 0:
+                growth = last[1][i] - first[1][i]
+                print('[BTKB:SOAK] %s RSS %d kB -> %d kB, %+.1f kB/min' % (name, first[1][i], last[1][i], growth / minutes))
+
+    sys.exit(1 if result.violation_count else 0)
+
+
+if __name__ == '__main__':
+    main()